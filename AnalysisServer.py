@@ -0,0 +1,387 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from BatchAnalysis import BatchAnalysis
+from Board import Board
+from Engine import SearchAborted
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class AnalysisServer:
+    """
+    A local HTTP service that analyses positions on a pool of engine worker processes, so that other programs
+    can use the engine without starting a process per request.
+
+    POST /analyse takes a JSON object with a fen and optional depth, nodes and movetime limits and a deadline in
+    milliseconds. The answer is the result as JSON, or, if the request accepts text/event-stream or has ?stream=1
+    in its URL, server-sent events: an info event after every completed iteration and a result event at the end.
+    GET /health reports the workers and the number of jobs.
+
+    The workers are started with the server and load the network and the bitbases once, so a request only pays
+    for its search. Requests for the same position and limits that arrive while it is queued or searched share
+    one job, and all of them get its events and result. Every request has a deadline, DEFAULT_DEADLINE if it
+    gives none. The search stops at the deadline with the best move found so far, a job whose deadline passed
+    while it was queued is not searched, and a request still waiting at its deadline is answered with 504. Once
+    workers + queue_size jobs are unfinished, new positions are refused with 503 and a Retry-After header
+    rather than queued without bound.
+
+    Attributes:
+    - workers: The worker processes.
+    - tasks: The queue of jobs for the workers.
+    - results: The queue of the workers' events and results.
+    - queue_size: The number of jobs that may wait beyond one per worker.
+    - jobs: The unfinished jobs by key, each a dict of its id, its deadline and the queues of its subscribers.
+    - keys: The keys of the unfinished jobs by id.
+    - loop: The event loop of the server.
+    """
+
+    DEFAULT_DEPTH = 4
+    DEFAULT_DEADLINE = 10000
+    MAX_DEADLINE = 300000
+    MAX_BODY = 65536
+    RETRY_AFTER = 1
+    DEADLINE_MARGIN = 0.1
+    REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+               500: "Internal Server Error", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+    def __init__(self, workers=None, queue_size=64, hash_mb=16):
+        """
+        Starts the worker processes.
+
+        Parameters:
+        - workers: The number of worker processes, all cores if None.
+        - queue_size: The number of jobs that may wait beyond one per worker.
+        - hash_mb: The transposition table size of each worker in megabytes.
+        """
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.queue_size = queue_size
+        self.workers = [multiprocessing.Process(target=self.work, args=(self.tasks, self.results, hash_mb),
+                                                daemon=True) for _ in range(workers or os.cpu_count() or 1)]
+        for worker in self.workers:
+            worker.start()
+        self.jobs = {}
+        self.keys = {}
+        self.next_id = 0
+        self.loop = None
+
+    @classmethod
+    def work(cls, tasks, results, hash_mb):
+        """
+        Runs in a worker process: loads the evaluation, then searches jobs until it gets None.
+        """
+        WorkerPool.init_worker(hash_mb)
+        for task in iter(tasks.get, None):
+            job_id = task[0]
+            try:
+                results.put(("result", job_id, cls.analyse(task, results)))
+            except Exception as error:
+                results.put(("result", job_id, {"error": "analysis failed: %s" % error, "status": 500}))
+
+    @classmethod
+    def analyse(cls, task, results):
+        """
+        Runs in a worker process: searches a job's position, posting an info event after every iteration.
+
+        Parameters:
+        - task: A tuple (job id, fen, depth, nodes, movetime, deadline), the deadline in seconds since the epoch.
+        - results: The queue to post the events to.
+
+        Returns:
+        The result as a dict. An error result has the HTTP status to answer with.
+        """
+        job_id, fen, depth, nodes, movetime, deadline = task
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return {"error": "deadline exceeded before the search started", "status": 504}
+        try:
+            board = Board.from_fen(fen)
+            board.get_legal_moves()
+        except (ValueError, IndexError) as error:
+            return {"error": "invalid position: %s" % error, "status": 400}
+
+        engine = WorkerPool.engine(board)
+        engine.max_nodes = nodes
+        start = time.monotonic()
+        # The search ends a little before the deadline, so that its result reaches the waiting requests in time
+        remaining = max(0.01, remaining - cls.DEADLINE_MARGIN)
+        engine.deadline = start + min(remaining, movetime / 1000 if movetime else remaining)
+        completed = []
+
+        def iteration(current):
+            completed.append(current)
+            results.put(("info", job_id, cls.describe(engine, current, start)))
+
+        engine.on_iteration = iteration
+        try:
+            engine.search(depth)
+        except SearchAborted:
+            pass
+        if not engine.best_move:
+            moves = board.get_legal_moves()
+            return {"fen": fen, "bestmove": UCI.format_move(board, moves[0]) if moves else None, "depth": 0,
+                    "nodes": engine.nodes, "time": round(time.monotonic() - start, 3)}
+        result = cls.describe(engine, completed[-1], start)
+        result.update({"fen": fen, "bestmove": result["pv"][0]})
+        return result
+
+    @staticmethod
+    def describe(engine, depth, start):
+        """
+        Describes the engine's last completed iteration as a dict.
+        """
+        kind, value = UCI.format_score(engine.best_score).split()
+        return {"depth": depth, "score": {kind: int(value)}, "nodes": engine.nodes,
+                "time": round(time.monotonic() - start, 3),
+                "pv": [UCI.format_move(engine.board, move) for move in engine.pv] or
+                      [UCI.format_move(engine.board, engine.best_move)]}
+
+    def collect(self):
+        """
+        Runs in a thread: hands the workers' events and results over to the event loop until it gets None.
+        """
+        for message in iter(self.results.get, None):
+            self.loop.call_soon_threadsafe(self.dispatch, message)
+
+    def dispatch(self, message):
+        """
+        Sends a worker's event or result to the subscribers of its job, and ends the job with its result.
+        """
+        kind, job_id, data = message
+        key = self.keys.get(job_id)
+        if key is None:
+            return
+        job = self.jobs[key]
+        if kind == "result":
+            del self.keys[job_id]
+            del self.jobs[key]
+        for subscriber in job["subscribers"]:
+            subscriber.put_nowait((kind, data))
+
+    def parse_request(self, body):
+        """
+        Reads an analysis request.
+
+        Returns:
+        A tuple (key, deadline): the job key (fen, depth, nodes, movetime) and the deadline in seconds.
+
+        Raises:
+        ValueError: If the request is not valid.
+        """
+        try:
+            request = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError) as error:
+            raise ValueError("invalid JSON: %s" % error)
+        if not isinstance(request, dict) or not isinstance(request.get("fen"), str):
+            raise ValueError("expected a JSON object with a fen")
+        parsed = BatchAnalysis.parse_line(request["fen"])
+        if not parsed:
+            raise ValueError("empty fen")
+        limits = []
+        for name in ("depth", "nodes", "movetime", "deadline"):
+            value = request.get(name)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+                raise ValueError("%s must be a positive integer" % name)
+            limits.append(value)
+        depth, nodes, movetime, deadline = limits
+        if depth is None:
+            depth = UCI.MAX_DEPTH if nodes or movetime else self.DEFAULT_DEPTH
+        deadline = min(deadline or self.DEFAULT_DEADLINE, self.MAX_DEADLINE) / 1000
+        return (parsed[0], min(depth, UCI.MAX_DEPTH), nodes, movetime), deadline
+
+    def subscribe(self, key, deadline):
+        """
+        Adds a request to the job for its key, starting the job if there is none.
+
+        Returns:
+        The subscriber's queue of (kind, data) events, or None if the queue is full.
+        """
+        subscriber = asyncio.Queue()
+        job = self.jobs.get(key)
+        # A request that joins a job keeps its own deadline for waiting, but the search itself stops at the
+        # deadline of the request that started it
+        if not job:
+            if len(self.jobs) >= len(self.workers) + self.queue_size:
+                return None
+            self.next_id += 1
+            job = {"id": self.next_id, "deadline": time.time() + deadline, "subscribers": []}
+            self.jobs[key] = job
+            self.keys[job["id"]] = key
+            self.tasks.put((job["id"],) + key + (job["deadline"],))
+        job["subscribers"].append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, key, subscriber):
+        job = self.jobs.get(key)
+        if job and subscriber in job["subscribers"]:
+            job["subscribers"].remove(subscriber)
+
+    async def handle(self, reader, writer):
+        """
+        Serves one HTTP request on a connection, then closes it.
+        """
+        try:
+            request = await self.read_request(reader)
+            if request:
+                await self.route(writer, *request)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """
+        Reads an HTTP request.
+
+        Returns:
+        A tuple (method, target, headers, body), or None if the connection closed first.
+        """
+        line = await reader.readline()
+        if not line:
+            return None
+        method, target, _ = (line.decode("latin-1").split() + ["", "", ""])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", "0") or 0)
+        body = await reader.readexactly(min(length, self.MAX_BODY + 1)) if length else b""
+        return method, target, headers, body
+
+    async def route(self, writer, method, target, headers, body):
+        """
+        Answers a request.
+        """
+        url = urlsplit(target)
+        if url.path == "/health":
+            await self.respond(writer, 200, {"workers": sum(worker.is_alive() for worker in self.workers),
+                                             "jobs": len(self.jobs),
+                                             "capacity": len(self.workers) + self.queue_size})
+            return
+        if url.path != "/analyse":
+            await self.respond(writer, 404, {"error": "not found"})
+            return
+        if method != "POST":
+            await self.respond(writer, 405, {"error": "use POST"})
+            return
+        if len(body) > self.MAX_BODY:
+            await self.respond(writer, 413, {"error": "request too large"})
+            return
+        try:
+            key, deadline = self.parse_request(body)
+        except ValueError as error:
+            await self.respond(writer, 400, {"error": str(error)})
+            return
+        subscriber = self.subscribe(key, deadline)
+        if not subscriber:
+            await self.respond(writer, 503, {"error": "queue full"}, {"Retry-After": str(self.RETRY_AFTER)})
+            return
+        stream = "text/event-stream" in headers.get("accept", "") or "stream=1" in url.query
+        try:
+            if stream:
+                await self.stream(writer, subscriber, deadline)
+            else:
+                result = await self.wait(subscriber, deadline)
+                if result is None:
+                    await self.respond(writer, 504, {"error": "deadline exceeded"})
+                else:
+                    await self.respond(writer, result.get("status", 200),
+                                       {name: value for name, value in result.items() if name != "status"})
+        finally:
+            self.unsubscribe(key, subscriber)
+
+    async def wait(self, subscriber, deadline):
+        """
+        Waits for a job's result, skipping its info events.
+
+        Returns:
+        The result, or None if the deadline passed first.
+        """
+        end = time.monotonic() + deadline
+        while True:
+            try:
+                kind, data = await asyncio.wait_for(subscriber.get(), max(0.0, end - time.monotonic()))
+            except asyncio.TimeoutError:
+                return None
+            if kind == "result":
+                return data
+
+    async def stream(self, writer, subscriber, deadline):
+        """
+        Sends a job's info events and result as server-sent events.
+        """
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        await writer.drain()
+        end = time.monotonic() + deadline
+        while True:
+            try:
+                kind, data = await asyncio.wait_for(subscriber.get(), max(0.0, end - time.monotonic()))
+            except asyncio.TimeoutError:
+                kind, data = "error", {"error": "deadline exceeded"}
+            writer.write(("event: %s\ndata: %s\n\n" % (kind, json.dumps(data))).encode())
+            await writer.drain()
+            if kind != "info":
+                return
+
+    async def respond(self, writer, status, data, headers=None):
+        """
+        Sends a JSON response.
+        """
+        body = json.dumps(data).encode()
+        head = ["HTTP/1.1 %d %s" % (status, self.REASONS[status]), "Content-Type: application/json",
+                "Content-Length: %d" % len(body), "Connection: close"]
+        head += ["%s: %s" % item for item in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        """
+        Serves requests until cancelled.
+        """
+        self.loop = asyncio.get_running_loop()
+        threading.Thread(target=self.collect, daemon=True).start()
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """
+        Stops the workers and the result thread.
+        """
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self.results.put(None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve engine analysis over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--queue", type=int, default=64, help="jobs that may wait beyond one per worker")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    args = parser.parse_args()
+
+    WorkerPool.use_engine_directory()
+    service = AnalysisServer(args.workers, args.queue, args.hash)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
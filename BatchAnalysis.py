@@ -0,0 +1,181 @@
+import argparse
+import json
+import sys
+import time
+
+from Board import Board
+from Engine import SearchAborted
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class BatchAnalysis:
+    """
+    Analyses a stream of FEN or EPD positions on a pool of worker processes and writes one JSON object per
+    position (NDJSON).
+
+    Lines are read one at a time and handed to the workers of a WorkerPool as they become free, so memory stays
+    bounded however long the input is. Results are written in the order they complete, each with the line number
+    of its position.
+
+    Each worker's transposition table is cleared before every position, so a result does not depend on which
+    positions the worker analysed before.
+    """
+
+    DEFAULT_DEPTH = 3
+
+    @staticmethod
+    def parse_line(line):
+        """
+        Splits a FEN or EPD line into a FEN the board can read and the EPD operations.
+
+        An EPD line has the four position fields of a FEN followed by operations like bm e4; id "test 1";
+
+        Returns:
+        A tuple (fen, operations), operations being a dict from opcode to its operands as one string, or None if
+        the line is empty or a comment.
+        """
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return None
+        fields = line.split(maxsplit=4)
+        if len(fields) < 4:
+            raise ValueError("expected at least four FEN fields")
+        rest = fields[4] if len(fields) > 4 else ""
+        counters = rest.split(maxsplit=2)
+        if len(counters) >= 2 and counters[0].isdigit() and counters[1].isdigit():
+            # A full FEN, possibly followed by operations
+            fen = " ".join(fields[:4] + counters[:2])
+            rest = counters[2] if len(counters) > 2 else ""
+        else:
+            fen = " ".join(fields[:4]) + " 0 1"
+        operations = {}
+        for operation in rest.split(";"):
+            opcode, _, operands = operation.strip().partition(" ")
+            if opcode:
+                operations[opcode] = operands.strip().strip('"')
+        return fen, operations
+
+    @classmethod
+    def analyse(cls, task):
+        """
+        Runs in a worker: searches one position within the limits.
+
+        Parameters:
+        - task: A tuple (line number, line of the input).
+
+        Returns:
+        The result as a dict, with an error instead of the analysis if the position is invalid or the search
+        fails.
+        """
+        number, line = task
+        result = {"line": number}
+        try:
+            fen, operations = cls.parse_line(line)
+            board = Board.from_fen(fen)
+        except (ValueError, IndexError) as error:
+            result["error"] = "invalid position: %s" % error
+            return result
+        result["fen"] = fen
+        if "id" in operations:
+            result["id"] = operations["id"]
+
+        return cls.search_or_report(cls.search, board, result)
+
+    @staticmethod
+    def search_or_report(search, board, *args):
+        """
+        Runs in a worker: calls a tool's search on a position. A position the engine fails on is reported like
+        an invalid one instead of ending the run.
+
+        Parameters:
+        - search: The tool's search function, called with the board and the remaining arguments.
+        - board: The position.
+        - args: The other arguments of the search, the last one being the position's result.
+
+        Returns:
+        The search's result, or the position's result with an error if the search raised an exception.
+        """
+        try:
+            return search(board, *args)
+        except Exception as error:
+            result = args[-1]
+            result["error"] = "%s: %s" % (type(error).__name__, error)
+            return result
+
+    @classmethod
+    def search(cls, board, result):
+        """
+        Runs in a worker: searches a position within the limits and adds the analysis to its result.
+
+        Returns:
+        The result.
+        """
+        worker = WorkerPool.worker
+        engine = WorkerPool.engine(board)
+        engine.max_nodes = worker["nodes"]
+        start = time.monotonic()
+        if worker["movetime"]:
+            engine.deadline = start + worker["movetime"] / 1000
+        completed = []
+        engine.on_iteration = completed.append
+        try:
+            engine.search(worker["depth"])
+        except SearchAborted:
+            pass
+        result["time"] = round(time.monotonic() - start, 3)
+        result["nodes"] = engine.nodes
+        if not engine.best_move:
+            moves = board.get_legal_moves()
+            result["bestmove"] = UCI.format_move(board, moves[0]) if moves else None
+            result["depth"] = 0
+            return result
+        kind, value = UCI.format_score(engine.best_score).split()
+        result.update({"bestmove": UCI.format_move(board, engine.best_move), "depth": completed[-1],
+                       "score": {kind: int(value)}, "pv": [UCI.format_move(board, move) for move in engine.pv]})
+        return result
+
+    @classmethod
+    def run(cls, lines, output, workers=None, depth=None, nodes=None, movetime=None, hash_mb=16):
+        """
+        Analyses every position of the input and writes the results as they complete.
+
+        Parameters:
+        - lines: The input, any iterable of lines.
+        - output: The stream to write the results to.
+        - workers: The number of worker processes, all cores if None.
+        - depth: The depth limit. Without any limit, DEFAULT_DEPTH.
+        - nodes: The node limit per position, or None.
+        - movetime: The time limit per position in milliseconds, or None.
+        - hash_mb: The transposition table size of each worker in megabytes.
+
+        Returns:
+        The number of positions analysed.
+        """
+        if depth is None:
+            depth = UCI.MAX_DEPTH if nodes or movetime else cls.DEFAULT_DEPTH
+        tasks = ((number, line) for number, line in enumerate(lines, 1)
+                 if line.strip() and not line.lstrip().startswith("#"))
+        count = 0
+        for result in WorkerPool.map(cls.analyse, tasks, workers, hash_mb,
+                                     {"depth": depth, "nodes": nodes, "movetime": movetime}):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            count += 1
+        return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyse FEN or EPD positions and write NDJSON results.")
+    parser.add_argument("input", nargs="?", default="-", help="file of FEN or EPD lines, - for stdin")
+    parser.add_argument("--depth", type=int, help="depth limit per position")
+    parser.add_argument("--nodes", type=int, help="node limit per position")
+    parser.add_argument("--movetime", type=int, help="time limit per position in milliseconds")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    WorkerPool.use_engine_directory()
+    with source:
+        BatchAnalysis.run(source, sys.stdout, args.workers, args.depth, args.nodes, args.movetime, args.hash)
@@ -0,0 +1,117 @@
+import numpy as np
+from Pieces import Pieces
+from Engine import Engine
+
+
+class BatchEvaluator:
+    """
+    Vectorized static evaluation of many positions at once, computing the same material and piece-square
+    score as Engine.estimate. The positional terms of Engine.evaluate are not included.
+
+    A position is a row of 13 unsigned 64-bit integers: the twelve bitboards in the order of Board.pieces,
+    followed by the side to move (1 for white, 0 for black). Scores are from the point of view of the side
+    to move, like Engine.estimate.
+
+    Attributes:
+    - weights: A (768, 3) float32 matrix holding the midgame value, endgame value and phase weight of every
+      (piece, square) pair, indexed by piece * 64 + square.
+    - chunk_size: The number of positions unpacked at a time. Small chunks keep the unpacked bits in cache.
+    """
+
+    PIECES = [(Pieces.PAWN, True), (Pieces.PAWN, False), (Pieces.ROOK, True), (Pieces.ROOK, False),
+              (Pieces.KNIGHT, True), (Pieces.KNIGHT, False), (Pieces.BISHOP, True), (Pieces.BISHOP, False),
+              (Pieces.QUEEN, True), (Pieces.QUEEN, False), (Pieces.KING, True), (Pieces.KING, False)]
+    FEN_PIECES = "PpRrNnBbQqKk"
+
+    def __init__(self, chunk_size=256):
+        """
+        Builds the weight matrix from the engine's piece-square tables.
+
+        Parameters:
+        - chunk_size: The number of positions unpacked at a time.
+        """
+        mg, eg, phase = Engine.build_psqt(self.PIECES)
+        self.weights = np.empty((len(self.PIECES) * 64, 3), dtype=np.float32)
+        self.weights[:, 0] = np.array(mg).ravel()
+        self.weights[:, 1] = np.array(eg).ravel()
+        self.weights[:, 2] = np.repeat(phase, 64)
+        self.chunk_size = chunk_size
+
+    def evaluate(self, positions):
+        """
+        Evaluates an array of positions.
+
+        The scores are sums of small integers, so the float32 products are exact and the result matches the
+        scalar evaluation bit for bit.
+
+        Parameters:
+        - positions: An array-like of shape (N, 13) in the layout described on the class.
+
+        Returns:
+        An int32 array of N scores.
+        """
+        positions = np.asarray(positions, dtype=np.uint64).reshape(-1, 13)
+        scores = np.empty(len(positions), dtype=np.int32)
+        for start in range(0, len(positions), self.chunk_size):
+            chunk = positions[start:start + self.chunk_size]
+            # Least significant byte first, so bit i of every bitboard unpacks to column i.
+            bits = np.unpackbits(np.ascontiguousarray(chunk[:, :12], dtype='<u8').view(np.uint8), axis=1,
+                                 bitorder='little')
+            totals = np.rint(bits.astype(np.float32) @ self.weights).astype(np.int64)
+            phase = np.minimum(totals[:, 2], Engine.MAX_PHASE)
+            blended = (totals[:, 0] * phase + totals[:, 1] * (Engine.MAX_PHASE - phase)) // Engine.MAX_PHASE
+            scores[start:start + len(chunk)] = np.where(chunk[:, 12] != 0, blended, -blended)
+        return scores
+
+    @staticmethod
+    def position_from_board(board):
+        """
+        Converts a board into a position row.
+
+        Parameters:
+        - board: The board to convert.
+
+        Returns:
+        A list of 13 integers.
+        """
+        return [piece.get_board() for piece in board.pieces] + [int(board.is_white_turn)]
+
+    @classmethod
+    def position_from_fen(cls, fen):
+        """
+        Converts the placement and side-to-move fields of a FEN string into a position row.
+
+        The board is not flipped, so the row matches a board imported with the engine playing black.
+
+        Parameters:
+        - fen: The FEN string.
+
+        Returns:
+        A list of 13 integers.
+        """
+        fields = fen.split()
+        row = [0] * 13
+        square = 56
+        for char in fields[0]:
+            if char == '/':
+                square -= 16
+            elif char.isdigit():
+                square += int(char)
+            else:
+                row[cls.FEN_PIECES.index(char)] |= 1 << square
+                square += 1
+        row[12] = int(len(fields) < 2 or fields[1] == 'w')
+        return row
+
+    @classmethod
+    def positions_from_fens(cls, fens):
+        """
+        Converts FEN strings into an array of position rows.
+
+        Parameters:
+        - fens: An iterable of FEN strings.
+
+        Returns:
+        A uint64 array of shape (N, 13).
+        """
+        return np.array([cls.position_from_fen(fen) for fen in fens], dtype=np.uint64).reshape(-1, 13)
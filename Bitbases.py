@@ -0,0 +1,433 @@
+import argparse
+import multiprocessing
+import os
+
+import numpy as np
+
+from Pieces import Pieces
+
+
+class Bitbases:
+    """
+    Win/draw/loss tables for endings of a king and up to two pieces against a bare king, generated locally
+    by retrograde analysis.
+
+    A table is named after its material, strongest piece first, such as "KQK", "KBNK" or "KRPK". Tables are
+    built with the strong side as white and its pawns moving up the board. Positions where the strong side is
+    black are probed with the board mirrored. Each position is indexed by the squares of the white king,
+    the black king and the white pieces in name order, six bits each. A table file holds two bit arrays
+    over these indices, packed eight positions to a byte: whether white to move wins, and whether black to
+    move loses. Every other legal position is a draw. The bare king rules out en passant. Castling is not
+    modelled, so a side that may still castle is never probed.
+
+    Generation works backwards from the positions whose result is known without search: checkmates, and
+    moves into smaller tables (the bare king capturing a piece, or a pawn promoting). Newly lost black
+    positions are un-moved by white to find won white positions. Those are un-moved by the black king to
+    count down the black positions' remaining escapes, until no more positions change. Each step handles a
+    whole frontier of positions at once with NumPy. Tables are generated in parallel once the smaller tables
+    they depend on exist. Nothing is random, so every run writes the same files.
+
+    Attributes:
+    - directory: The directory holding the table files.
+    - tables: The memory-mapped tables loaded so far, None for tables that do not exist.
+    """
+
+    DIRECTORY = "bitbases"
+    ORDER = "QRBNP"
+    LETTERS = {Pieces.QUEEN: "Q", Pieces.ROOK: "R", Pieces.BISHOP: "B", Pieces.KNIGHT: "N", Pieces.PAWN: "P"}
+    MAX_PIECES = 4
+    DEFAULT_TABLES = ["KQK", "KRK", "KPK", "KBNK", "KBBK"]
+    CHUNK = 1 << 20
+
+    KING_STEPS = [(1, -1), (1, 0), (1, 1), (0, -1), (0, 1), (-1, -1), (-1, 0), (-1, 1)]
+    KNIGHT_STEPS = [(2, -1), (2, 1), (1, -2), (1, 2), (-1, -2), (-1, 2), (-2, -1), (-2, 1)]
+    # Rook directions first, then bishop directions
+    RAY_STEPS = [(1, 0), (-1, 0), (0, 1), (0, -1), (1, 1), (1, -1), (-1, 1), (-1, -1)]
+    SLIDER_RAYS = {"R": range(0, 4), "B": range(4, 8), "Q": range(0, 8)}
+
+    def __init__(self, directory=DIRECTORY):
+        """
+        Initializes the prober. Tables are loaded when first probed.
+
+        Parameters:
+        - directory: The directory holding the table files.
+        """
+        self.directory = directory
+        self.tables = {}
+
+    @classmethod
+    def table_name(cls, letters):
+        """
+        Names the table of a king and the given pieces against a bare king.
+        """
+        return "K" + "".join(sorted(letters, key=cls.ORDER.index)) + "K"
+
+    @classmethod
+    def dependencies(cls, name):
+        """
+        Finds the smaller tables a table's positions can move into: those left after the bare king captures
+        a piece, and those reached by promoting a pawn.
+
+        Returns:
+        A set of table names, not including the bare "KK".
+        """
+        letters = name[1:-1]
+        tables = set()
+        for i, letter in enumerate(letters):
+            if len(letters) > 1:
+                tables.add(cls.table_name(letters[:i] + letters[i + 1:]))
+            if letter == "P":
+                tables.update(cls.table_name(letters[:i] + promotion + letters[i + 1:]) for promotion in "QRBN")
+        return tables
+
+    @classmethod
+    def path(cls, name, directory):
+        return os.path.join(directory, name + ".bb")
+
+    def table(self, name):
+        """
+        Memory-maps a table file the first time it is needed.
+
+        Returns:
+        The table's bytes, or None if the table has not been generated.
+        """
+        if name not in self.tables:
+            path = self.path(name, self.directory)
+            self.tables[name] = np.memmap(path, dtype=np.uint8, mode="r") if os.path.exists(path) else None
+        return self.tables[name]
+
+    def probe(self, board):
+        """
+        Looks up the result of the board's current position.
+
+        Parameters:
+        - board: The board to probe.
+
+        Returns:
+        1 if the side to move wins, 0 for a draw, -1 if it loses, or None if no table covers the position.
+        """
+        pieces = {True: [], False: []}
+        for bitboard in board.pieces:
+            if bitboard.get_piece_type() == Pieces.KING:
+                continue
+            squares = bitboard.get_board()
+            while squares:
+                pieces[bitboard.is_white()].append((self.LETTERS[bitboard.get_piece_type()], board.lsb(squares)))
+                squares &= squares - 1
+        if bool(pieces[True]) == bool(pieces[False]) or len(pieces[True] + pieces[False]) > self.MAX_PIECES - 2:
+            return None
+        strong = bool(pieces[True])
+        if any(board.white_can_castle if strong else board.black_can_castle):
+            return None
+        ordered = sorted(pieces[strong], key=lambda piece: self.ORDER.index(piece[0]))
+        table = self.table(self.table_name("".join(letter for letter, _ in ordered)))
+        if table is None:
+            return None
+
+        # Mirror the board when the strong side is black, so that it plays white's role in the table
+        flip = 0 if strong else 56
+        strong_king, weak_king = (board.wk, board.bk) if strong else (board.bk, board.wk)
+        index = 0
+        for sq in [board.lsb(strong_king.get_board()), board.lsb(weak_king.get_board())] + [sq for _, sq in ordered]:
+            index = index * 64 + (sq ^ flip)
+        if board.is_white_turn == strong:
+            return 1 if table[index >> 3] >> (index & 7) & 1 else 0
+        offset = 64 ** (len(ordered) + 2) // 8
+        return -1 if table[offset + (index >> 3)] >> (index & 7) & 1 else 0
+
+    @staticmethod
+    def step(sq, dr, df):
+        """
+        Moves from a square by a number of ranks and files.
+
+        Returns:
+        The new square, or -1 if it is off the board.
+        """
+        rank, file = sq // 8 + dr, sq % 8 + df
+        return rank * 8 + file if 0 <= rank < 8 and 0 <= file < 8 else -1
+
+    @classmethod
+    def geometry(cls):
+        """
+        Builds the move and attack tables used by the generator.
+
+        Returns:
+        A dict of arrays: king and knight targets (64, 8) and rays (64, 8, 7), -1 past the edge of the board;
+        the attack bitboards of each piece from each square on an empty board; and the squares between two
+        squares on a line, as a (64, 64) array of bitboards.
+        """
+        geometry = {"king": np.full((64, 8), -1), "knight": np.full((64, 8), -1), "rays": np.full((64, 8, 7), -1),
+                    "between": np.zeros((64, 64), dtype=np.uint64)}
+        for letter in "KNPRBQ":
+            geometry[letter] = np.zeros(64, dtype=np.uint64)
+        for sq in range(64):
+            for d, (dr, df) in enumerate(cls.KING_STEPS):
+                geometry["king"][sq, d] = cls.step(sq, dr, df)
+            for d, (dr, df) in enumerate(cls.KNIGHT_STEPS):
+                geometry["knight"][sq, d] = cls.step(sq, dr, df)
+            for d, (dr, df) in enumerate(cls.RAY_STEPS):
+                to, passed = sq, 0
+                for k in range(7):
+                    to = cls.step(to, dr, df) if to >= 0 else -1
+                    geometry["rays"][sq, d, k] = to
+                    if to >= 0:
+                        geometry["between"][sq, to] = passed
+                        passed |= 1 << to
+            geometry["K"][sq] = sum(1 << to for to in geometry["king"][sq] if to >= 0)
+            geometry["N"][sq] = sum(1 << to for to in geometry["knight"][sq] if to >= 0)
+            geometry["P"][sq] = sum(1 << to for to in (cls.step(sq, 1, -1), cls.step(sq, 1, 1)) if to >= 0)
+            geometry["R"][sq] = sum(1 << to for to in geometry["rays"][sq, 0:4].ravel() if to >= 0)
+            geometry["B"][sq] = sum(1 << to for to in geometry["rays"][sq, 4:8].ravel() if to >= 0)
+            geometry["Q"][sq] = geometry["R"][sq] | geometry["B"][sq]
+        return geometry
+
+    @staticmethod
+    def bits(squares):
+        return np.left_shift(np.uint64(1), squares.astype(np.uint64))
+
+    @classmethod
+    def attacks(cls, geometry, letter, origin, target, occ):
+        """
+        Tests, for arrays of positions, whether a white piece attacks a square.
+
+        Parameters:
+        - geometry: The tables from geometry.
+        - letter: The piece's letter.
+        - origin: The piece's squares.
+        - target: The attacked squares.
+        - occ: The occupancy bitboards that block sliders.
+
+        Returns:
+        A boolean array.
+        """
+        attacked = geometry[letter][origin] & cls.bits(target) != 0
+        if letter in cls.SLIDER_RAYS:
+            attacked &= geometry["between"][origin, target] & occ == 0
+        return attacked
+
+    @classmethod
+    def load_bits(cls, name, directory):
+        """
+        Loads a generated table for use while generating a larger one.
+
+        Returns:
+        A tuple (white to move wins, black to move loses) of boolean arrays, or None for the bare kings.
+        """
+        if name == "KK":
+            return None
+        size = 64 ** len(name)
+        packed = np.fromfile(cls.path(name, directory), dtype=np.uint8)
+        bits = np.unpackbits(packed, bitorder="little").astype(bool)
+        return bits[:size], bits[size:]
+
+    @classmethod
+    def sub_index(cls, letters, squares):
+        """
+        Indexes positions in a smaller table, sorting its pieces into name order.
+
+        Parameters:
+        - letters: The letters of the white pieces, in the same order as squares[2:].
+        - squares: The square arrays of the white king, the black king and the white pieces.
+        """
+        ordered = sorted(range(len(letters)), key=lambda i: cls.ORDER.index(letters[i]))
+        index = squares[0] * 64 + squares[1]
+        for i in ordered:
+            index = index * 64 + squares[2 + i]
+        return index
+
+    @classmethod
+    def generate(cls, name, directory=DIRECTORY):
+        """
+        Generates a table by retrograde analysis and writes it to its file. The tables it depends on must
+        already exist.
+
+        Parameters:
+        - name: The name of the table.
+        - directory: The directory to write to and read the smaller tables from.
+        """
+        geometry = cls.geometry()
+        letters = name[1:-1]
+        slots = "Kk" + letters
+        n = len(slots)
+        size = 64 ** n
+        shifts = [6 * (n - 1 - j) for j in range(n)]
+        sub_tables = {sub: cls.load_bits(sub, directory) for sub in cls.dependencies(name) | {"KK"}}
+
+        valid_w = np.zeros(size, dtype=bool)  # Legal with white to move
+        won = np.zeros(size, dtype=bool)  # White to move wins
+        lost = np.zeros(size, dtype=bool)  # Black to move loses
+        escape = np.zeros(size, dtype=bool)  # Black to move has a drawing move
+        remaining = np.zeros(size, dtype=np.uint8)  # Black to move's moves not yet known to lose
+        marked = np.zeros(size, dtype=bool)
+
+        def squares_of(index):
+            return [(index >> shift) & 63 for shift in shifts]
+
+        def occupied(squares, target):
+            return np.logical_or.reduce([sq == target for sq in squares])
+
+        for start in range(0, size, cls.CHUNK):
+            index = np.arange(start, min(start + cls.CHUNK, size))
+            squares = squares_of(index)
+            wk, bk = squares[0], squares[1]
+            valid = geometry["K"][wk] & cls.bits(bk) == 0
+            for a in range(n):
+                for b in range(a + 1, n):
+                    valid &= squares[a] != squares[b]
+                if slots[a] == "P":
+                    valid &= (squares[a] >= 8) & (squares[a] < 56)
+            occ = np.bitwise_or.reduce([cls.bits(sq) for sq in squares])
+            in_check = np.logical_or.reduce([cls.attacks(geometry, slots[j], squares[j], bk, occ) for j in range(2, n)])
+            chunk = slice(start, start + len(index))
+            valid_w[chunk] = valid & ~in_check
+
+            # Count the black king's moves, settling captures with the smaller tables
+            occ_without_king = occ & ~cls.bits(bk)
+            legal_count = np.zeros(len(index), dtype=np.uint8)
+            quiet_count = np.zeros(len(index), dtype=np.uint8)
+            draws = np.zeros(len(index), dtype=bool)
+            for d in range(8):
+                target = geometry["king"][bk, d]
+                legal = valid & (target >= 0)
+                target = np.where(legal, target, 0)
+                legal &= geometry["K"][wk] & cls.bits(target) == 0
+                captured = [squares[j] == target for j in range(2, n)]
+                for j in range(2, n):
+                    legal &= captured[j - 2] | ~cls.attacks(geometry, slots[j], squares[j], target, occ_without_king)
+                legal_count += legal
+                quiet_count += legal & ~np.logical_or.reduce(captured)
+                for j in range(2, n):
+                    capture = legal & captured[j - 2]
+                    sub_letters = letters[:j - 2] + letters[j - 1:]
+                    sub_table = sub_tables[cls.table_name(sub_letters)]
+                    if sub_table is None:
+                        draws |= capture
+                    elif capture.any():
+                        sub_squares = [wk, target] + squares[2:j] + squares[j + 1:]
+                        sub_won = sub_table[0][cls.sub_index(sub_letters, sub_squares)]
+                        draws |= capture & ~sub_won
+            # Stalemates count as escapes so that they are never lost
+            escape[chunk] = valid & (draws | ((legal_count == 0) & ~in_check))
+            remaining[chunk] = quiet_count
+            lost[chunk] = valid & ~escape[chunk] & (quiet_count == 0) & ((legal_count > 0) | in_check)
+
+            # Promotions into lost positions of the smaller tables win for white
+            for j in range(2, n):
+                if slots[j] != "P":
+                    continue
+                target = squares[j] + 8
+                promotable = valid_w[chunk] & (squares[j] >= 48) & ~occupied(squares, target)
+                for promotion in "QRBN":
+                    sub_letters = letters[:j - 2] + promotion + letters[j - 1:]
+                    sub_squares = squares[:j] + [target] + squares[j + 1:]
+                    sub_lost = sub_tables[cls.table_name(sub_letters)][1]
+                    sub_index = np.where(promotable, cls.sub_index(sub_letters, sub_squares), 0)
+                    won[chunk] |= promotable & sub_lost[sub_index]
+
+        def white_sources(squares, j):
+            """ Yields the squares white's piece j could have come from, with a mask of where it could """
+            letter, origin = slots[j], squares[j]
+            if letter in "KN":
+                for d in range(8):
+                    source = geometry["king" if letter == "K" else "knight"][origin, d]
+                    yield source, source >= 0
+            elif letter == "P":
+                yield origin - 8, np.ones(len(origin), dtype=bool)
+                yield origin - 16, (origin >= 24) & (origin < 32) & ~occupied(squares, origin - 8)
+            else:
+                for d in cls.SLIDER_RAYS[letter]:
+                    clear = np.ones(len(origin), dtype=bool)
+                    for k in range(7):
+                        source = geometry["rays"][origin, d, k]
+                        yield source, clear
+                        clear = clear & (source >= 0) & ~occupied(squares, source)
+
+        # Frontiers are worked through in chunks, holding every candidate of a large frontier at once would
+        # take gigabytes
+        def white_unmoves(frontier):
+            for start in range(0, len(frontier), cls.CHUNK):
+                part = frontier[start:start + cls.CHUNK]
+                squares = squares_of(part)
+                for j in [0] + list(range(2, n)):
+                    for source, possible in white_sources(squares, j):
+                        possible = possible & (source >= 0) & ~occupied(squares, source)
+                        # Marking the predecessors is much faster than sorting them to remove duplicates
+                        marked[part[possible] + ((source[possible] - squares[j][possible]) << shifts[j])] = True
+            np.logical_and(marked, valid_w & ~won, out=marked)
+            newly_won = np.flatnonzero(marked)
+            marked[:] = False
+            return newly_won
+
+        def black_unmoves(frontier):
+            newly_lost = []
+            for start in range(0, len(frontier), cls.CHUNK):
+                part = frontier[start:start + cls.CHUNK]
+                squares = squares_of(part)
+                wk, bk = squares[0], squares[1]
+                predecessors = []
+                for d in range(8):
+                    source = geometry["king"][bk, d]
+                    possible = (source >= 0) & ~occupied(squares, source)
+                    possible &= geometry["K"][wk] & cls.bits(np.where(possible, source, 0)) == 0
+                    predecessors.append(part[possible] + ((source[possible] - bk[possible]) << shifts[1]))
+                predecessors, counts = np.unique(np.concatenate(predecessors), return_counts=True)
+                pending = ~escape[predecessors] & ~lost[predecessors]
+                predecessors, counts = predecessors[pending], counts[pending].astype(np.uint8)
+                remaining[predecessors] -= counts
+                newly_lost.append(predecessors[remaining[predecessors] == 0])
+                lost[newly_lost[-1]] = True
+            return np.concatenate(newly_lost) if newly_lost else frontier[:0]
+
+        new_won, new_lost = np.flatnonzero(won), np.flatnonzero(lost)
+        while len(new_won) or len(new_lost):
+            if len(new_lost):
+                newly_won = white_unmoves(new_lost)
+                won[newly_won] = True
+                new_won = np.concatenate([new_won, newly_won])
+            new_lost = black_unmoves(new_won) if len(new_won) else new_lost[:0]
+            new_won = new_won[:0]
+
+        os.makedirs(directory, exist_ok=True)
+        with open(cls.path(name, directory), "wb") as file:
+            np.packbits(won, bitorder="little").tofile(file)
+            np.packbits(lost, bitorder="little").tofile(file)
+
+    @classmethod
+    def generate_all(cls, names=DEFAULT_TABLES, directory=DIRECTORY, workers=None):
+        """
+        Generates tables and every smaller table they depend on, skipping those that already exist. Tables
+        whose dependencies are all done are generated in parallel.
+
+        Parameters:
+        - names: The names of the tables wanted.
+        - directory: The directory to write to.
+        - workers: The number of worker processes, all cores if None.
+
+        Returns:
+        The names of the tables generated, in order.
+        """
+        pending = set()
+        wanted = list(names)
+        while wanted:
+            name = wanted.pop()
+            if name not in pending and not os.path.exists(cls.path(name, directory)):
+                pending.add(name)
+                wanted.extend(cls.dependencies(name))
+        generated = []
+        with multiprocessing.Pool(workers) as pool:
+            while pending:
+                ready = sorted(name for name in pending if not cls.dependencies(name) & pending)
+                pool.starmap(cls.generate, [(name, directory) for name in ready])
+                pending -= set(ready)
+                generated += ready
+        return generated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate endgame bitbases by retrograde analysis.")
+    parser.add_argument("tables", nargs="*", default=Bitbases.DEFAULT_TABLES, help="table names such as KQK or KBNK")
+    parser.add_argument("--directory", default=Bitbases.DIRECTORY)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    for table in Bitbases.generate_all(args.tables, args.directory, args.workers):
+        print("generated", table)
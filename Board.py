@@ -1,9 +1,16 @@
+import copy
+import os
 import random
 from typing import List
 
+# The command-line tools write their results to stdout, which pygame's greeting would corrupt. The GUI imports
+# pygame itself first, so it still greets there.
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
 import pygame
 
 from BitBoard import BitBoard
+from GameStatus import GameStatus
 from Hashing import Hashing
 from Move import Move
 from Pieces import Pieces
@@ -48,6 +55,10 @@ class Board:
     RANK_5 = 1095216660480
     RANK_8 = -72057594037927936
     BOARD_SPAN = 0xFFFFFFFFFFFFFFFF
+    SEE_VALUES = {Pieces.PAWN: 100, Pieces.KNIGHT: 320, Pieces.BISHOP: 330, Pieces.ROOK: 500, Pieces.QUEEN: 950,
+                  Pieces.KING: 20000}
+    # The index of each piece type's white bitboard in self.pieces, the black one following it
+    PIECE_INDEX = {Pieces.PAWN: 0, Pieces.ROOK: 2, Pieces.KNIGHT: 4, Pieces.BISHOP: 6, Pieces.QUEEN: 8, Pieces.KING: 10}
 
     def __init__(self, gui):
         self.selected: (BitBoard, int) = None  # Tuple (selected_bitboard, position)
@@ -57,12 +68,26 @@ class Board:
         self.half_move_count = 0
         self.white_can_castle = (True, True)  # Tuple (short_castle, long_castle)
         self.black_can_castle = (True, True)  # Tuple (short_castle, long_castle)
-        self.last_castle_state = (True, True)
+        self.history = []  # Per-ply state saved by make_move and restored by undo_move
+        self.attack_cache = {}  # Attack data of the current position, filled on demand and saved with the ply
+        self.psqt_mg = None  # Material and piece-square tables, indexed [piece][square] in self.pieces order
+        self.psqt_eg = None
+        self.psqt_phase = None
+        self.mg_score = 0  # Running totals of the tables for the current position, from white's point of view
+        self.eg_score = 0
+        self.phase = 0
+        self.accumulator = None  # Optional network accumulator kept up to date by make_move and undo_move, see NNUE
+        self.key = None  # Zobrist key of the current position, kept up to date by make_move
+        self.en_passant_file = None  # File on which the side to move can capture en passant, kept by make_move
         self.RANK_NAMES = ["1", "2", "3", "4", "5", "6", "7", "8"]
         self.FILE_NAMES = ["a", "b", "c", "d", "e", "f", "g", "h"]
         self.SQUARE_NAMES = [f + r for r in self.RANK_NAMES for f in self.FILE_NAMES]
         self.PIECE_SYMBOLS = {Pieces.PAWN: "p", Pieces.KNIGHT: "n", Pieces.BISHOP: "b",
                               Pieces.ROOK: "r", Pieces.QUEEN: "q", Pieces.KING: "k"}
+        self.KNIGHT_ATTACKS = [self.knight_span(sq) for sq in self.SQUARES]
+        self.KING_ATTACKS = [self.king_span(sq) for sq in self.SQUARES]
+        self.PAWN_ATTACKS = {is_white: [self.pawn_span(sq, is_white) for sq in self.SQUARES]
+                             for is_white in (False, True)}
         self.gui = gui
 
         # Instantiating bitBoards for each color/type of material
@@ -332,32 +357,228 @@ class Board:
     def hv_moves(self, sq: Square, is_white: bool) -> int:
         if not self.is_valid_square(sq):
             return 0
-        binaryPos = 1 << sq
-        occ = self.get_occupied()
         teammate = self.get_white() if is_white else self.get_black()
-        hPoss = (occ - 2 * binaryPos) ^ self.reverse(self.reverse(occ) - (2 * self.reverse(binaryPos)))
-        vPoss = ((occ & self.FILE_MASKS[self.get_file(sq)]) - (2 * binaryPos)) ^ \
-                self.reverse(self.reverse(occ & self.FILE_MASKS[self.get_file(sq)]) - (2 * self.reverse(binaryPos)))
-        totalPoss = (hPoss & self.RANK_MASKS[self.get_rank(sq)]) | \
-                    (vPoss & self.FILE_MASKS[self.get_file(sq)])
-        totalPoss &= ~teammate
-        return totalPoss
+        return self.rook_attacks(sq, self.get_occupied()) & ~teammate
 
     def diag_moves(self, sq: Square, is_white: bool) -> int:
         if not self.is_valid_square(sq):
             return 0
-        binaryPos = 1 << sq
-        occ = self.get_occupied()
         teammate = self.get_white() if is_white else self.get_black()
+        return self.bishop_attacks(sq, self.get_occupied()) & ~teammate
+
+    def rook_attacks(self, sq: Square, occ: int) -> int:
+        """
+        Computes the squares a rook on the given square attacks, using hyperbola quintessence.
+
+        Parameters:
+        - sq: The index of the square the rook stands on.
+        - occ: A bitboard of the occupied squares that block the rook.
+
+        Returns:
+        A bitboard of the attacked squares, including the first blocker in each direction.
+        """
+        binaryPos = 1 << sq
+        hPoss = (occ - 2 * binaryPos) ^ self.reverse(self.reverse(occ) - (2 * self.reverse(binaryPos)))
+        vPoss = ((occ & self.FILE_MASKS[self.get_file(sq)]) - (2 * binaryPos)) ^ \
+                self.reverse(self.reverse(occ & self.FILE_MASKS[self.get_file(sq)]) - (2 * self.reverse(binaryPos)))
+        return (hPoss & self.RANK_MASKS[self.get_rank(sq)]) | (vPoss & self.FILE_MASKS[self.get_file(sq)])
+
+    def bishop_attacks(self, sq: Square, occ: int) -> int:
+        """
+        Computes the squares a bishop on the given square attacks, using hyperbola quintessence.
+
+        Parameters:
+        - sq: The index of the square the bishop stands on.
+        - occ: A bitboard of the occupied squares that block the bishop.
+
+        Returns:
+        A bitboard of the attacked squares, including the first blocker in each direction.
+        """
+        binaryPos = 1 << sq
         diag = self.get_rank(sq) + self.get_file(sq)
         antidiag = self.get_rank(sq) + 7 - self.get_file(sq)
         diagPoss = ((occ & self.DIAG_MASKS[diag]) - 2 * binaryPos) ^ \
                    self.reverse(self.reverse(occ & self.DIAG_MASKS[diag]) - 2 * self.reverse(binaryPos))
         antiDiagPoss = ((occ & self.ANTIDIAG_MASKS[antidiag]) - 2 * binaryPos) ^ \
                        self.reverse(self.reverse(occ & self.ANTIDIAG_MASKS[antidiag]) - 2 * self.reverse(binaryPos))
-        totalPoss = diagPoss & self.DIAG_MASKS[diag] | antiDiagPoss & self.ANTIDIAG_MASKS[antidiag]
-        totalPoss &= ~teammate
-        return totalPoss
+        return diagPoss & self.DIAG_MASKS[diag] | antiDiagPoss & self.ANTIDIAG_MASKS[antidiag]
+
+    def knight_span(self, sq: Square) -> int:
+        if sq > 18:
+            poss = self.KNIGHT_SPAN << (sq - 18)
+        else:
+            poss = self.KNIGHT_SPAN >> (18 - sq)
+        if sq % 8 < 4:
+            poss &= ~self.FILE_GH
+        else:
+            poss &= ~self.FILE_AB
+        return poss & self.BOARD_SPAN
+
+    def king_span(self, sq: Square) -> int:
+        if sq > 9:
+            poss = self.KING_SPAN << (sq - 9)
+        else:
+            poss = self.KING_SPAN >> (9 - sq)
+        if sq % 8 < 4:
+            poss &= ~self.FILE_GH
+        else:
+            poss &= ~self.FILE_AB
+        return poss & self.BOARD_SPAN
+
+    def pawn_span(self, sq: Square, is_white: bool) -> int:
+        binarySq = 1 << sq
+        if is_white:
+            poss = ((binarySq << 7) & ~self.FILE_H) | ((binarySq << 9) & ~self.FILE_A)
+        else:
+            poss = ((binarySq >> 7) & ~self.FILE_A) | ((binarySq >> 9) & ~self.FILE_H)
+        return poss & self.BOARD_SPAN
+
+    def attackers_to(self, sq: Square, occ: int) -> int:
+        """
+        Finds every piece of either color that attacks a square.
+
+        Parameters:
+        - sq: The index of the attacked square.
+        - occ: A bitboard of the occupied squares that block sliding pieces.
+
+        Returns:
+        A bitboard of the attacking pieces. Sliders hidden behind removed blockers (x-rays) are
+        discovered by passing an occupancy with those blockers cleared.
+        """
+        diag = self.wb.get_board() | self.bb.get_board() | self.wq.get_board() | self.bq.get_board()
+        straight = self.wr.get_board() | self.br.get_board() | self.wq.get_board() | self.bq.get_board()
+        return (self.PAWN_ATTACKS[False][sq] & self.wp.get_board()) | \
+               (self.PAWN_ATTACKS[True][sq] & self.bp.get_board()) | \
+               (self.KNIGHT_ATTACKS[sq] & (self.wkn.get_board() | self.bkn.get_board())) | \
+               (self.KING_ATTACKS[sq] & (self.wk.get_board() | self.bk.get_board())) | \
+               (self.bishop_attacks(sq, occ) & diag) | \
+               (self.rook_attacks(sq, occ) & straight)
+
+    def get_attack_map(self, by_white: bool, occ: int) -> int:
+        """
+        Finds every square attacked by one color. The map is kept in the attack cache of the position, by color
+        and occupancy, so the evaluation and the move generation only compute it once.
+
+        Parameters:
+        - by_white: The color of the attacking side.
+        - occ: A bitboard of the occupied squares that block sliding pieces.
+
+        Returns:
+        A bitboard of the attacked squares.
+        """
+        key = ("attacks", by_white, occ)
+        if key not in self.attack_cache:
+            self.attack_cache[key] = self.compute_attack_map(by_white, occ)
+        return self.attack_cache[key]
+
+    def compute_attack_map(self, by_white: bool, occ: int) -> int:
+        """
+        Computes the squares attacked by one color, see get_attack_map.
+        """
+        side = 0 if by_white else 1
+        pawns = self.pieces[side].get_board()
+        if by_white:
+            attacks = ((pawns << 7) & ~self.FILE_H) | ((pawns << 9) & ~self.FILE_A)
+        else:
+            attacks = ((pawns >> 7) & ~self.FILE_A) | ((pawns >> 9) & ~self.FILE_H)
+        for sq in self.get_squares(self.pieces[4 + side].get_board()):
+            attacks |= self.KNIGHT_ATTACKS[sq]
+        queens = self.pieces[8 + side].get_board()
+        for sq in self.get_squares(self.pieces[6 + side].get_board() | queens):
+            attacks |= self.bishop_attacks(sq, occ)
+        for sq in self.get_squares(self.pieces[2 + side].get_board() | queens):
+            attacks |= self.rook_attacks(sq, occ)
+        for sq in self.get_squares(self.pieces[10 + side].get_board()):
+            attacks |= self.KING_ATTACKS[sq]
+        return attacks & self.BOARD_SPAN
+
+    def is_square_attacked(self, sq: Square, by_white: bool, occ: int) -> bool:
+        """
+        Checks if any piece of one color attacks a square.
+
+        The square is looked at from the inside out, with the leaper tables and the slider rays from the square,
+        stopping at the first attacker found, so the cost does not depend on the size of the attacking army.
+
+        Parameters:
+        - sq: The index of the square.
+        - by_white: The color of the attacking side.
+        - occ: A bitboard of the occupied squares that block sliding pieces.
+
+        Returns:
+        True if the square is attacked, False otherwise.
+        """
+        side = 0 if by_white else 1
+        if self.PAWN_ATTACKS[not by_white][sq] & self.pieces[side].get_board():
+            return True
+        if self.KNIGHT_ATTACKS[sq] & self.pieces[4 + side].get_board():
+            return True
+        if self.KING_ATTACKS[sq] & self.pieces[10 + side].get_board():
+            return True
+        queens = self.pieces[8 + side].get_board()
+        diag = self.pieces[6 + side].get_board() | queens
+        if diag and self.bishop_attacks(sq, occ) & diag:
+            return True
+        straight = self.pieces[2 + side].get_board() | queens
+        return bool(straight and self.rook_attacks(sq, occ) & straight)
+
+    def see(self, move: Move) -> int:
+        """
+        Static exchange evaluation of a move for the side to move.
+
+        Plays out the sequence of captures on the destination square, always recapturing with the least
+        valuable attacker, without making any moves on the board. Sliders behind the pieces that have
+        already captured join the exchange as they are uncovered.
+
+        Parameters:
+        - move: The move to evaluate, normally a capture.
+
+        Returns:
+        The material balance of the exchange in centipawns. Negative values are losing captures.
+        """
+        is_white = self.is_white_turn
+        to_sq = move.end_square
+        occ = self.get_occupied()
+        if move.en_passant:
+            captured_value = self.SEE_VALUES[Pieces.PAWN]
+            occ ^= 1 << (to_sq - 8 if is_white else to_sq + 8)
+        else:
+            captured = self.get_opponent(to_sq, is_white)
+            captured_value = self.SEE_VALUES[captured.get_piece_type()] if captured else 0
+
+        diag = self.wb.get_board() | self.bb.get_board() | self.wq.get_board() | self.bq.get_board()
+        straight = self.wr.get_board() | self.br.get_board() | self.wq.get_board() | self.bq.get_board()
+        occ &= ~(1 << move.start_square)
+        attackers = self.attackers_to(to_sq, occ) & occ
+        gain = [captured_value]
+        on_square_value = self.SEE_VALUES[move.piece_type]
+        side = not is_white
+
+        while True:
+            side_pieces = self.get_white() if side else self.get_black()
+            if not attackers & side_pieces:
+                break
+            # Recapture with the least valuable attacker
+            for piece_type in (Pieces.PAWN, Pieces.KNIGHT, Pieces.BISHOP, Pieces.ROOK, Pieces.QUEEN, Pieces.KING):
+                candidates = attackers & self.get_bb(piece_type, side).get_board()
+                if candidates:
+                    break
+            # A king may only recapture when the square is no longer defended
+            if piece_type == Pieces.KING and attackers & ~side_pieces:
+                break
+            gain.append(on_square_value - gain[-1])
+            on_square_value = self.SEE_VALUES[piece_type]
+            occ &= ~(candidates & -candidates)
+            if piece_type in (Pieces.PAWN, Pieces.BISHOP, Pieces.QUEEN):
+                attackers |= self.bishop_attacks(to_sq, occ) & diag
+            if piece_type in (Pieces.ROOK, Pieces.QUEEN):
+                attackers |= self.rook_attacks(to_sq, occ) & straight
+            attackers &= occ
+            side = not side
+
+        while len(gain) > 1:
+            score = gain.pop()
+            gain[-1] = -max(-gain[-1], score)
+        return gain[0]
 
     def get_pawn_moves(self, bitboard, is_white) -> List[Move]:
         moves = []
@@ -421,26 +642,17 @@ class Board:
                 poss &= ~i
                 i = poss & ~(poss - 1)
 
-            if self.last_move:
-                e_file = self.get_file(self.last_move.end_square)
-                e_rank = self.get_rank(self.last_move.end_square)
-                if (
-                        self.last_move.piece_type == Pieces.PAWN and
-                        self.get_file(self.last_move.start_square) == e_file and
-                        abs(e_rank - self.get_rank(self.last_move.start_square)) == 2
-                ):
-
-                    poss = (bitboard >> 1) & self.bp.get_board() & self.RANK_5 \
-                           & ~self.FILE_H & self.FILE_MASKS[e_file]
-                    if poss:
-                        sq = poss.bit_length()
-                        moves.append(Move(sq, sq + 7, Pieces.PAWN, en_passant=True))
-
-                    poss = (bitboard << 1) & self.bp.get_board() & self.RANK_5 \
-                           & ~self.FILE_A & self.FILE_MASKS[e_file]
-                    if poss:
-                        sq = poss.bit_length() - 2
-                        moves.append(Move(sq, sq + 9, Pieces.PAWN, en_passant=True))
+            if self.en_passant_file is not None:
+                e_file = self.en_passant_file
+                poss = (bitboard >> 1) & self.bp.get_board() & self.RANK_5 & ~self.FILE_H & self.FILE_MASKS[e_file]
+                if poss:
+                    sq = poss.bit_length()
+                    moves.append(Move(sq, sq + 7, Pieces.PAWN, en_passant=True))
+
+                poss = (bitboard << 1) & self.bp.get_board() & self.RANK_5 & ~self.FILE_A & self.FILE_MASKS[e_file]
+                if poss:
+                    sq = poss.bit_length() - 2
+                    moves.append(Move(sq, sq + 9, Pieces.PAWN, en_passant=True))
         else:
             poss = (bitboard >> 7) & opp & ~self.FILE_A & ~self.RANK_1
             i = poss & ~(poss - 1)
@@ -498,26 +710,17 @@ class Board:
                 poss &= ~i
                 i = poss & ~(poss - 1)
 
-            if self.last_move:
-                e_file = self.get_file(self.last_move.end_square)
-                e_rank = self.get_rank(self.last_move.end_square)
-                if (
-                        self.last_move.piece_type == Pieces.PAWN and
-                        self.get_file(self.last_move.start_square) == e_file and
-                        abs(e_rank - self.get_rank(self.last_move.start_square)) == 2
-                ):
-
-                    poss = (bitboard << 1) & self.wp.get_board() & self.RANK_4 \
-                           & ~self.FILE_A & self.FILE_MASKS[e_file]
-                    if poss:
-                        sq = poss.bit_length() - 2
-                        moves.append(Move(sq, sq - 7, Pieces.PAWN, en_passant=True))
-
-                    poss = (bitboard >> 1) & self.wp.get_board() & self.RANK_4 \
-                           & ~self.FILE_H & self.FILE_MASKS[e_file]
-                    if poss:
-                        sq = poss.bit_length()
-                        moves.append(Move(sq, sq - 9, Pieces.PAWN, en_passant=True))
+            if self.en_passant_file is not None:
+                e_file = self.en_passant_file
+                poss = (bitboard << 1) & self.wp.get_board() & self.RANK_4 & ~self.FILE_A & self.FILE_MASKS[e_file]
+                if poss:
+                    sq = poss.bit_length() - 2
+                    moves.append(Move(sq, sq - 7, Pieces.PAWN, en_passant=True))
+
+                poss = (bitboard >> 1) & self.wp.get_board() & self.RANK_4 & ~self.FILE_H & self.FILE_MASKS[e_file]
+                if poss:
+                    sq = poss.bit_length()
+                    moves.append(Move(sq, sq - 9, Pieces.PAWN, en_passant=True))
 
         return moves
 
@@ -626,20 +829,18 @@ class Board:
     def get_castling_moves(self, sq: Square, is_white, can_castle) -> List[Move]:
         moves = []
         occ = self.get_occupied()
-        unsafe = self.get_unsafe(is_white)
         r = self.wr.get_board() if is_white else self.br.get_board()
         binarySq = 1 << sq
         short_castle, long_castle = can_castle
+        # The path is only tested for attacks once it is known to be clear, one square at a time
         if short_castle:
-            if (unsafe & binarySq == 0) & (unsafe & (binarySq << 1) == 0) & \
-                    (unsafe & (binarySq << 2) == 0) & (unsafe & (binarySq << 3) == 0):
-                if (occ & (binarySq << 1) == 0) & (occ & (binarySq << 2) == 0) & (r & (binarySq << 3) != 0):
+            if (occ & (binarySq << 1) == 0) & (occ & (binarySq << 2) == 0) & (r & (binarySq << 3) != 0):
+                if not any(self.is_square_attacked(path_sq, not is_white, occ) for path_sq in range(sq, sq + 3)):
                     moves.append(Move(sq, sq + 3, Pieces.KING, is_castle=True))
         if long_castle:
-            if (unsafe & binarySq == 0) & (unsafe & (binarySq >> 1) == 0) & (unsafe & (binarySq >> 2) == 0) & \
-                    (unsafe & (binarySq >> 3) == 0) & (unsafe & (binarySq >> 4) == 0):
-                if (occ & (binarySq >> 1) == 0) & (occ & (binarySq >> 2) == 0) & \
-                        (occ & (binarySq >> 3) == 0) & (r & (binarySq >> 4) != 0):
+            if (occ & (binarySq >> 1) == 0) & (occ & (binarySq >> 2) == 0) & \
+                    (occ & (binarySq >> 3) == 0) & (r & (binarySq >> 4) != 0):
+                if not any(self.is_square_attacked(path_sq, not is_white, occ) for path_sq in range(sq - 2, sq + 1)):
                     moves.append(Move(sq, sq - 4, Pieces.KING, is_castle=True))
         return moves
 
@@ -759,42 +960,31 @@ class Board:
         fifty-move rule, and insufficient material. If any of these conditions are met,
         it prints the result and exits the game.
         """
-        # Check for checkmate and exit the game if found
-
-        if self.is_checkmate(self.wk):
-            if self.engine_side:
+        status = self.get_game_status()
+        if status == GameStatus.CHECKMATE:
+            # The side to move has been mated
+            if self.is_white_turn == self.engine_side:
                 print("White won!")
             else:
                 print("Black won!")
-            return True
-        elif self.is_checkmate(self.bk):
-            if self.engine_side:
-                print("Black won!")
-            else:
-                print("White won!")
-            return True
-
-        # Check for stalemate and exit the game if found
-        elif self.is_stalemate(self.bk if self.is_white_turn else self.wk):
+        elif status == GameStatus.STALEMATE:
             print("Stalemate.")
-            return True
-
-        # Check for three-move repetition and exit the game if found
-        elif self.Hash.three_move_repetition():
+        elif status == GameStatus.THREE_MOVE_REPETITION:
             print("Draw - three move repetition.")
-            return True
-
-        # Check for the fifty-move rule and exit the game if found
-        elif self.half_move_count >= 100:
+        elif status == GameStatus.FIFTY_MOVE_RULE:
             print("Draw - fifty move rule.")
-            return True
-
-        # Check for insufficient material and exit the game if found
-        elif self.is_insufficient_material():
+        elif status == GameStatus.INSUFFICIENT_MATERIAL:
             print("Draw - insufficient material.")
-            return True
+        return status != GameStatus.ONGOING
 
-        return False
+    def is_repetition(self):
+        """
+        Checks whether the current position occurred before with the same side to move, since the last capture
+        or pawn move, on the moves made on this board.
+        """
+        key = self.get_key()
+        start = max(-1, len(self.history) - 1 - self.half_move_count)
+        return any(self.history[index][7] == key for index in range(len(self.history) - 2, start, -2))
 
     def is_insufficient_material(self):
         """
@@ -861,8 +1051,33 @@ class Board:
         return False
 
     def remove_check_moves(self, moves, king) -> List[Move]:
+        # Out of check, a move can only be illegal if it moves the king, a pinned piece or an en passant pawn
+        checkers = self.get_checkers(king)
+        pinned = self.get_pinned(king) if not checkers else 0
+        danger = None
         filtered_moves = []
         for move in moves:
+            if not checkers and not move.en_passant:
+                if move.piece_type == Pieces.KING:
+                    if danger is None:
+                        danger = self.get_king_danger(king)
+                    # Castling moves were only generated with a safe path
+                    if move.is_castle or not danger & (1 << move.end_square):
+                        filtered_moves.append(move)
+                    continue
+                if not pinned & (1 << move.start_square):
+                    filtered_moves.append(move)
+                    continue
+            if move.en_passant:
+                # Both pawns leave the rank, which can expose the king along it, so test the resulting position
+                sq = self.lsb(king.get_board())
+                captured_sq = move.end_square - 8 if king.is_white() else move.end_square + 8
+                occ_after = (self.get_occupied() & ~(1 << move.start_square) & ~(1 << captured_sq)) | \
+                            (1 << move.end_square)
+                enemy = self.get_black() if king.is_white() else self.get_white()
+                if not self.attackers_to(sq, occ_after) & enemy & ~(1 << captured_sq):
+                    filtered_moves.append(move)
+                continue
             piece = self.get_bb(move.piece_type, king.is_white())
             piece.clear_square(move.start_square)
             opponent = self.get_opponent(move.end_square, piece.is_white())
@@ -877,42 +1092,171 @@ class Board:
             piece.occupy_square(move.start_square)
         return filtered_moves
 
-    def is_check(self, king: BitBoard) -> bool:
-        unsafe = self.get_unsafe(king.is_white())
-        return unsafe & king.get_board()
+    def get_checkers(self, king: BitBoard) -> int:
+        """
+        Finds the enemy pieces giving check to a king.
 
-    def is_checkmate(self, king) -> bool:
-        if not self.is_check(king):
-            return False
-        for piece in self.pieces:
-            if piece.is_white() == king.is_white():
-                moves = self.get_moves(piece, (False, False))
-                for move in moves:
-                    piece.clear_square(move.start_square)
-                    opponent = self.get_opponent(move.end_square, king.is_white())
-                    if opponent:
-                        opponent.clear_square(move.end_square)
-                    piece.occupy_square(move.end_square)
-                    if not self.is_check(king):
-                        piece.clear_square(move.end_square)
-                        piece.occupy_square(move.start_square)
-                        if opponent:
-                            opponent.occupy_square(move.end_square)
-                        return False
-                    if opponent:
-                        opponent.occupy_square(move.end_square)
-                    piece.clear_square(move.end_square)
-                    piece.occupy_square(move.start_square)
-        return True
+        Parameters:
+        - king: The BitBoard of the king.
+
+        Returns:
+        A bitboard of the checking pieces, zero if the king is not in check.
+        """
+        key = ("checkers", king.is_white())
+        if key not in self.attack_cache:
+            enemy = self.get_black() if king.is_white() else self.get_white()
+            self.attack_cache[key] = self.attackers_to(self.lsb(king.get_board()), self.get_occupied()) & enemy
+        return self.attack_cache[key]
+
+    def get_king_danger(self, king: BitBoard) -> int:
+        """
+        Finds the squares a king may not move to, the squares attacked by the enemy with the king itself
+        removed so that it cannot step back along a checking ray.
+
+        Parameters:
+        - king: The BitBoard of the king.
+
+        Returns:
+        A bitboard of the attacked squares.
+        """
+        return self.get_attack_map(not king.is_white(), self.get_occupied() & ~king.get_board())
+
+    def between(self, sq1: Square, sq2: Square) -> int:
+        """
+        Gets the squares strictly between two squares on a shared rank, file or diagonal.
+
+        Returns:
+        A bitboard of the squares in between, zero if the squares are not aligned.
+        """
+        if self.get_rank(sq1) == self.get_rank(sq2) or self.get_file(sq1) == self.get_file(sq2):
+            return self.rook_attacks(sq1, 1 << sq2) & self.rook_attacks(sq2, 1 << sq1)
+        if abs(self.get_rank(sq1) - self.get_rank(sq2)) == abs(self.get_file(sq1) - self.get_file(sq2)):
+            return self.bishop_attacks(sq1, 1 << sq2) & self.bishop_attacks(sq2, 1 << sq1)
+        return 0
+
+    def get_pinned(self, king: BitBoard) -> int:
+        """
+        Finds the pieces pinned to a king by enemy sliders.
 
-    def is_stalemate(self, king):
+        Parameters:
+        - king: The BitBoard of the king.
+
+        Returns:
+        A bitboard of the king's own pieces that may not leave the line between the king and a slider.
+        """
+        key = ("pinned", king.is_white())
+        if key not in self.attack_cache:
+            self.attack_cache[key] = self.find_pinned(king)
+        return self.attack_cache[key]
+
+    def find_pinned(self, king: BitBoard) -> int:
+        """
+        Computes the pieces pinned to a king, without the cache used by get_pinned.
+        """
+        is_white = king.is_white()
+        sq = self.lsb(king.get_board())
+        own = self.get_white() if is_white else self.get_black()
+        enemy = self.get_black() if is_white else self.get_white()
+        queens = self.get_bb(Pieces.QUEEN, not is_white).get_board()
+        snipers = (self.rook_attacks(sq, enemy) & (self.get_bb(Pieces.ROOK, not is_white).get_board() | queens)) | \
+                  (self.bishop_attacks(sq, enemy) & (self.get_bb(Pieces.BISHOP, not is_white).get_board() | queens))
+        pinned = 0
+        for sniper in self.get_squares(snipers):
+            blockers = self.between(sq, sniper) & (own | enemy)
+            if blockers & own and not blockers & (blockers - 1):
+                pinned |= blockers
+        return pinned
+
+    def get_evasion_moves(self, king: BitBoard, checkers: int) -> List[Move]:
+        """
+        Generates the legal moves of a side whose king is in check.
+
+        Only king moves to safe squares, captures of a single checker and interpositions on the checking ray
+        are generated, so no further legality filtering is needed. A double check only allows king moves.
+
+        Parameters:
+        - king: The BitBoard of the king in check.
+        - checkers: A bitboard of the checking pieces, as returned by get_checkers.
+
+        Returns:
+        A list of the legal moves.
+        """
+        is_white = king.is_white()
+        sq = self.lsb(king.get_board())
+        own = self.get_white() if is_white else self.get_black()
+        enemy = self.get_black() if is_white else self.get_white()
+        occ = own | enemy
+        moves = []
+
+        for end_sq in self.get_squares(self.KING_ATTACKS[sq] & ~own & ~self.get_king_danger(king)):
+            moves.append(Move(sq, end_sq, Pieces.KING, 1 << end_sq & enemy))
+
+        # In double check only the king can move
+        if checkers & (checkers - 1):
+            return moves
+
+        checker_sq = self.lsb(checkers)
+        target = checkers | self.between(sq, checker_sq)
+        movable = ~self.get_pinned(king)
+        generators = {Pieces.PAWN: self.get_pawn_moves, Pieces.KNIGHT: self.get_knight_moves,
+                      Pieces.BISHOP: self.get_bishop_moves, Pieces.ROOK: self.get_rook_moves,
+                      Pieces.QUEEN: self.get_queen_moves}
         for piece in self.pieces:
-            if piece.is_white() == king.is_white():
-                moves = self.get_moves(piece, (False, False))
-                legal_moves = self.remove_check_moves(moves, king)
-                if len(legal_moves) != 0:
-                    return False
-        return True
+            if piece.is_white() != is_white or piece.get_piece_type() == Pieces.KING:
+                continue
+            for move in generators[piece.get_piece_type()](piece.get_board() & movable, is_white):
+                if move.en_passant:
+                    # The captured pawn is beside the destination, so test the resulting position directly
+                    captured_sq = move.end_square - 8 if is_white else move.end_square + 8
+                    occ_after = (occ & ~(1 << move.start_square) & ~(1 << captured_sq)) | (1 << move.end_square)
+                    if not self.attackers_to(sq, occ_after) & enemy & ~(1 << captured_sq):
+                        moves.append(move)
+                elif 1 << move.end_square & target:
+                    moves.append(move)
+        return moves
+
+    def is_check(self, king: BitBoard) -> bool:
+        return self.is_square_attacked(self.lsb(king.get_board()), not king.is_white(), self.get_occupied())
+
+    def get_legal_moves(self) -> List[Move]:
+        """
+        Generates the legal moves of the side to move.
+
+        The list is computed once per position and kept with the position's attack data, so the game status,
+        the GUI's move highlights and the engine's root search share it. It must not be modified.
+
+        Returns:
+        A list of the legal moves.
+        """
+        if "legal" not in self.attack_cache:
+            king = self.wk if self.is_white_turn else self.bk
+            checkers = self.get_checkers(king)
+            if checkers:
+                self.attack_cache["legal"] = self.get_evasion_moves(king, checkers)
+            else:
+                self.attack_cache["legal"] = self.remove_check_moves(self.get_all_moves(), king)
+        return self.attack_cache["legal"]
+
+    def get_game_status(self) -> GameStatus:
+        """
+        Works out whether the game has ended in the current position, and how.
+
+        Checkmate and stalemate follow from the legal move list and a single check test. The repetition test
+        only looks at the current position, the only one whose count can have just reached three.
+
+        Returns:
+        The GameStatus of the position.
+        """
+        if not self.get_legal_moves():
+            king = self.wk if self.is_white_turn else self.bk
+            return GameStatus.CHECKMATE if self.get_checkers(king) else GameStatus.STALEMATE
+        if self.Hash.three_move_repetition():
+            return GameStatus.THREE_MOVE_REPETITION
+        if self.half_move_count >= 100:
+            return GameStatus.FIFTY_MOVE_RULE
+        if self.is_insufficient_material():
+            return GameStatus.INSUFFICIENT_MATERIAL
+        return GameStatus.ONGOING
 
     def get_opponent(self, sq: Square, is_white):
         if not self.is_valid_square(sq):
@@ -932,11 +1276,8 @@ class Board:
 
         for m in moves:
             self.make_move(m, True)
-            wk = self.wk.get_board()
-
-            bk = self.bk.get_board()
-            if (((wk & self.get_unsafe(True)) == 0) & (not self.is_white_turn)) | (
-                    ((bk & self.get_unsafe(False)) == 0) & self.is_white_turn):
+            # The side that just moved may not have left its own king in check
+            if not self.get_checkers(self.bk if self.is_white_turn else self.wk):
                 self.update_can_castle(m, self.is_white_turn)
                 x = self.perft(depth - 1)
                 if depth == self.max_depth:
@@ -947,6 +1288,13 @@ class Board:
         return total_count
 
     def make_move(self, move: Move, isEngine: bool):
+        # Save the state that undo_move cannot work out from the move. The key is kept for every position of the
+        # game, so that the search can detect repetitions.
+        self.history.append((self.white_can_castle, self.black_can_castle, self.half_move_count,
+                             self.mg_score, self.eg_score, self.phase, self.attack_cache, self.get_key(),
+                             self.en_passant_file))
+        self.attack_cache = {}
+
         piece = self.get_bb(move.piece_type, self.is_white_turn)
         piece.clear_square(move.start_square)
         opponent_piece = self.get_opponent(move.end_square, piece.is_white())
@@ -957,13 +1305,12 @@ class Board:
         if move.en_passant:
             self.handle_en_passant(move, piece.is_white())
         if move.is_castle:
-            self.last_castle_state = self.white_can_castle if piece.is_white() else self.black_can_castle
             self.handle_castling(move.start_square, move.end_square, piece.is_white())
         if move.is_promotion:
             if isEngine:
-                self.gui.promote_pawn(piece, move.end_square, Pieces.QUEEN)
+                self.get_bb(move.promotion or Pieces.QUEEN, piece.is_white()).occupy_square(move.end_square)
             else:
-                self.gui.promote_pawn(piece, move.end_square)
+                self.gui.promote_pawn(piece, move.end_square, move.promotion)
 
         # Update game state, including handling game-ending conditions
         self.half_move_count += 1
@@ -983,13 +1330,24 @@ class Board:
         if not move.is_castle and not move.is_promotion:
             piece.occupy_square(move.end_square)
 
+        changes = self.get_move_changes(move, piece)
+        if self.psqt_mg:
+            self.update_psqt(changes)
+        if self.accumulator:
+            self.accumulator.push(self, changes)
+
         self.is_white_turn = not self.is_white_turn
+        en_passant_file = self.get_en_passant_file(move)
+        white_can_castle, black_can_castle = self.history[-1][:2]
+        self.key = self.Hash.update_key(self.key, changes, (white_can_castle, black_can_castle),
+                                        (self.white_can_castle, self.black_can_castle),
+                                        self.en_passant_file, en_passant_file)
+        self.en_passant_file = en_passant_file
 
         if not isEngine:
+            self.last_move = move
             if self.handle_game_state_endings():
                 self.gui.running = False
-            # Store information about the last move
-            self.last_move = move
 
     def move(self, piece_to_move: (BitBoard, Square), dest_square: Square) -> bool:
         """
@@ -1007,14 +1365,8 @@ class Board:
         and updates game-related parameters.
         """
         piece, start_square = piece_to_move
-        can_castle = self.white_can_castle if piece.is_white() else self.black_can_castle
 
-        # Get all possible moves for the piece and remove any that result in check
-        moves = self.get_moves(piece, can_castle)
-        king = self.wk if self.is_white_turn else self.bk
-        moves = self.remove_check_moves(moves, king)
-
-        move = self.is_valid_move(start_square, dest_square, piece.get_piece_type(), moves)
+        move = self.is_valid_move(start_square, dest_square, piece.get_piece_type(), self.get_legal_moves())
 
         # Check if the destination square is a valid move
         if not move:
@@ -1028,7 +1380,10 @@ class Board:
         piece = self.get_bb(move.piece_type, self.is_white_turn)
         opponent_piece = move.captured
 
-        self.half_move_count = 0
+        (self.white_can_castle, self.black_can_castle, self.half_move_count, self.mg_score, self.eg_score,
+         self.phase, self.attack_cache, self.key, self.en_passant_file) = self.history.pop()
+        if self.accumulator:
+            self.accumulator.pop()
 
         if not move.is_castle:
             piece.occupy_square(move.start_square)
@@ -1040,15 +1395,94 @@ class Board:
                 piece.clear_square(move.end_square)
         if move.is_castle:
             self.undo_castling(move.start_square, move.end_square, piece.is_white())
-        if self.is_white_turn:
-            self.white_can_castle = self.last_castle_state
-        else:
-            self.black_can_castle = self.last_castle_state
         if move.en_passant:
             self.undo_en_passant(move, piece.is_white())
         if move.is_capture:
             opponent_piece.occupy_square(move.end_square)
 
+    def set_psqt(self, mg, eg, phase):
+        """
+        Sets the tables kept as running totals and computes the totals for the current position.
+
+        Parameters:
+        - mg: The middlegame material plus piece-square value, indexed [piece][square] in self.pieces order,
+          positive for white and negative for black.
+        - eg: The endgame values, laid out like mg.
+        - phase: The game phase weight of each piece, in self.pieces order.
+        """
+        self.psqt_mg, self.psqt_eg, self.psqt_phase = mg, eg, phase
+        self.refresh_psqt()
+
+    def refresh_psqt(self):
+        """
+        Recomputes the running table totals and the network accumulator from scratch, after the bitboards were
+        changed directly. The position key is recomputed when it is next asked for.
+        """
+        self.key = None
+        self.mg_score = self.eg_score = self.phase = 0
+        self.attack_cache = {}
+        if self.psqt_mg:
+            self.update_psqt([(index, sq, True) for index, bitboard in enumerate(self.pieces)
+                              for sq in self.get_squares(bitboard.get_board())])
+        if self.accumulator:
+            self.accumulator.refresh(self)
+
+    def get_piece_index(self, piece: BitBoard):
+        """
+        Finds the index of a bitboard in self.pieces from its piece type and colour.
+        """
+        return self.PIECE_INDEX[piece.get_piece_type()] + (0 if piece.is_white() else 1)
+
+    def get_move_changes(self, move: Move, piece: BitBoard):
+        """
+        Lists the pieces a move added to and removed from the board, worked out from the move alone.
+
+        Parameters:
+        - move: The move, just made.
+        - piece: The bitboard of the moving piece.
+
+        Returns:
+        A list of tuples (index of the bitboard in self.pieces, square, whether the piece was added).
+        """
+        index = self.get_piece_index(piece)
+        start, end = move.start_square, move.end_square
+        if move.is_castle:
+            # Castling is encoded as the king moving to its rook's square
+            rook = self.PIECE_INDEX[Pieces.ROOK] + (index & 1)
+            king_dx, rook_dx = (2, -2) if start < end else (-2, 3)
+            return [(index, start, False), (index, start + king_dx, True),
+                    (rook, end, False), (rook, end + rook_dx, True)]
+        changes = [(index, start, False)]
+        if move.is_promotion:
+            # The GUI asks for the promotion piece, so it is read from the board
+            promoted = next(bitboard for bitboard in self.pieces if bitboard.is_occupied(end) and
+                            bitboard.is_white() == piece.is_white())
+            changes.append((self.get_piece_index(promoted), end, True))
+        else:
+            changes.append((index, end, True))
+        if move.en_passant:
+            changes.append((self.get_piece_index(move.captured), end - 8 if piece.is_white() else end + 8, False))
+        elif move.is_capture:
+            changes.append((self.get_piece_index(move.captured), end, False))
+        return changes
+
+    def update_psqt(self, changes):
+        """
+        Updates the running table totals with the pieces that were added to or removed from the board.
+
+        Parameters:
+        - changes: A list of tuples (index of the bitboard in self.pieces, square, whether the piece was added).
+        """
+        for index, sq, added in changes:
+            if added:
+                self.mg_score += self.psqt_mg[index][sq]
+                self.eg_score += self.psqt_eg[index][sq]
+                self.phase += self.psqt_phase[index]
+            else:
+                self.mg_score -= self.psqt_mg[index][sq]
+                self.eg_score -= self.psqt_eg[index][sq]
+                self.phase -= self.psqt_phase[index]
+
     def undo_castling(self, start_square: Square, end_square: Square, is_white: bool):
         king = self.wk if is_white else self.bk
         rook = self.wr if is_white else self.br
@@ -1073,6 +1507,107 @@ class Board:
         opponent_sq = move.end_square + 8 * direction
         move.captured.occupy_square(opponent_sq)
 
+    def import_fen(self, fen: str):
+        """
+        Sets up the position described by a FEN string.
+
+        Parameters:
+        - fen: The FEN string. The white pieces go on the white bitboards, whichever side the engine plays.
+        """
+        for piece in self.pieces:
+            piece.clear_board()
+        self.white_can_castle = (False, False)
+        self.black_can_castle = (False, False)
+
+        curr_char = 0
+        board_idx = 56
+        while fen[curr_char] != ' ':
+            match fen[curr_char]:
+                case 'P':
+                    self.wp.occupy_square(board_idx)
+                    board_idx += 1
+                case 'p':
+                    self.bp.occupy_square(board_idx)
+                    board_idx += 1
+                case 'N':
+                    self.wkn.occupy_square(board_idx)
+                    board_idx += 1
+                case 'n':
+                    self.bkn.occupy_square(board_idx)
+                    board_idx += 1
+                case 'R':
+                    self.wr.occupy_square(board_idx)
+                    board_idx += 1
+                case 'r':
+                    self.br.occupy_square(board_idx)
+                    board_idx += 1
+                case 'B':
+                    self.wb.occupy_square(board_idx)
+                    board_idx += 1
+                case 'b':
+                    self.bb.occupy_square(board_idx)
+                    board_idx += 1
+                case 'Q':
+                    self.wq.occupy_square(board_idx)
+                    board_idx += 1
+                case 'q':
+                    self.bq.occupy_square(board_idx)
+                    board_idx += 1
+                case 'K':
+                    self.wk.occupy_square(board_idx)
+                    board_idx += 1
+                case 'k':
+                    self.bk.occupy_square(board_idx)
+                    board_idx += 1
+                case '/':
+                    board_idx -= 16
+                case '1':
+                    board_idx += 1
+                case '2':
+                    board_idx += 2
+                case '3':
+                    board_idx += 3
+                case '4':
+                    board_idx += 4
+                case '5':
+                    board_idx += 5
+                case '6':
+                    board_idx += 6
+                case '7':
+                    board_idx += 7
+                case '8':
+                    board_idx += 8
+            curr_char += 1
+
+        curr_char += 1
+        self.is_white_turn = fen[curr_char] == 'w'
+        curr_char += 2
+        while fen[curr_char] != ' ':
+            match fen[curr_char]:
+                case '-':
+                    pass
+                case 'K':
+                    self.white_can_castle = (True, self.white_can_castle[1])
+                case 'Q':
+                    self.white_can_castle = (self.white_can_castle[0], True)
+                case 'k':
+                    self.black_can_castle = (True, self.black_can_castle[1])
+                case 'q':
+                    self.black_can_castle = (self.black_can_castle[0], True)
+            curr_char += 1
+
+        curr_char += 1
+        self.en_passant_file = None
+        if fen[curr_char] != '-':
+            file = fen[curr_char].lower()
+            file_idx = ord(file) - ord('a')
+            if self.is_white_turn:
+                self.en_passant_file = self.get_en_passant_file(Move(48 + file_idx, 32 + file_idx, Pieces.PAWN))
+            else:
+                self.en_passant_file = self.get_en_passant_file(Move(8 + file_idx, 24 + file_idx, Pieces.PAWN))
+
+        self.refresh_psqt()
+
     def export_fen(self):
         fen = ""
         empty_squares = 0
@@ -1166,6 +1701,112 @@ class Board:
 
         return new_fen
 
+    def get_key(self):
+        """
+        Gets the Zobrist key of the current position, used to index the transposition table. It is computed from
+        scratch the first time and then kept up to date by make_move and undo_move.
+        """
+        if self.key is None:
+            self.key = self.Hash.position_key(self.pieces, self.is_white_turn, self.white_can_castle,
+                                              self.black_can_castle, self.en_passant_file)
+        return self.key
+
+    def get_en_passant_file(self, move: Move):
+        """
+        Finds the file on which en passant is possible after a move, for the move generation and the position
+        key. Positions that only differ by a double pawn push that cannot be taken en passant get the same key.
+
+        Returns:
+        The file of a pawn that has just moved two squares next to an opponent's pawn, or None.
+        """
+        if not move or move.piece_type != Pieces.PAWN or abs(move.end_square - move.start_square) != 16:
+            return None
+        opponent = self.bp if move.end_square > move.start_square else self.wp
+        file = self.get_file(move.end_square)
+        if file > 0 and opponent.is_occupied(move.end_square - 1) or \
+                file < 7 and opponent.is_occupied(move.end_square + 1):
+            return file
+        return None
+
+    @classmethod
+    def from_fen(cls, fen: str):
+        """
+        Creates a board without a GUI, for analysis and tools that run headless. Such a board must only be
+        changed through engine moves, which promote to a queen instead of asking the GUI.
+
+        Parameters:
+        - fen: The FEN string of the position.
+
+        Returns:
+        The new Board, with the white pieces on the white bitboards.
+
+        Raises:
+        ValueError: If either side does not have exactly one king, which the move generation relies on.
+        """
+        board = cls(None)
+        board.engine_side = False
+        board.import_fen(fen)
+        if board.wk.get_board().bit_count() != 1 or board.bk.get_board().bit_count() != 1:
+            raise ValueError("each side must have exactly one king")
+        return board
+
+    def get_state(self):
+        """
+        Captures the current position in a form that can be pickled and sent to another process.
+
+        Returns:
+        A tuple of the bitboard values, the side to move, the castling rights, the half-move count and the
+        en passant file, or None.
+        """
+        return ([piece.get_board() for piece in self.pieces], self.is_white_turn, self.white_can_castle,
+                self.black_can_castle, self.half_move_count, self.en_passant_file)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Creates a board without a GUI from a position captured by get_state, like from_fen.
+
+        Parameters:
+        - state: The tuple returned by get_state.
+
+        Returns:
+        The new Board.
+        """
+        bitboards, is_white_turn, white_can_castle, black_can_castle, half_move_count, en_passant_file = state
+        board = cls(None)
+        board.engine_side = False
+        for piece, value in zip(board.pieces, bitboards):
+            piece.clear_board()
+            for sq in board.get_squares(value):
+                piece.occupy_square(sq)
+        board.is_white_turn = is_white_turn
+        board.white_can_castle = white_can_castle
+        board.black_can_castle = black_can_castle
+        board.half_move_count = half_move_count
+        board.en_passant_file = en_passant_file
+        board.refresh_psqt()
+        return board
+
+    def clone(self):
+        """
+        Copies the current position onto a new Board that can be searched independently of this one.
+
+        The copy shares the piece icons, the GUI and the game-state hash with this board, so it must only be
+        changed through engine moves.
+
+        Returns:
+        The new Board.
+        """
+        board = copy.copy(self)
+        board.pieces = [BitBoard(piece.get_board(), piece.get_icon(), piece.is_white(), piece.get_piece_type())
+                        for piece in self.pieces]
+        board.wp, board.bp, board.wr, board.br, board.wkn, board.bkn, \
+            board.wb, board.bb, board.wq, board.bq, board.wk, board.bk = board.pieces
+        board.history = list(self.history)
+        board.attack_cache = dict(self.attack_cache)
+        board.accumulator = self.accumulator.copy() if self.accumulator else None
+        return board
+
     def get_piece(self, square: Square):
         if not self.is_valid_square(square):
             return None
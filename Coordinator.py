@@ -0,0 +1,251 @@
+import argparse
+import asyncio
+import collections
+import json
+import socket
+import sys
+import time
+
+from BatchAnalysis import BatchAnalysis
+from Board import Board
+from Pieces import Pieces
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class Coordinator:
+    """
+    Hands out the work units of a large job to workers on any number of machines over TCP, and collects their
+    results. Workers are RemoteWorker processes that connect to the coordinator.
+
+    A job is a position set to analyse, one unit per position, or a perft count split into subtrees below the
+    first plies. The protocol is one JSON object per line. A worker says hello and is sent the job's options.
+    It then pulls one unit at a time with a request, and answers each with a result. While it works it sends a
+    heartbeat every HEARTBEAT seconds. A worker that says nothing for LAPSE seconds, or whose connection drops,
+    is given up on and its unit is issued again to the next worker that asks. A result for a unit that was
+    already completed elsewhere is ignored.
+
+    Units are taken from the job as workers ask for them, and results are handed to the caller as they arrive,
+    so memory use does not grow with the size of the job. Adding workers, on this machine or others, adds
+    throughput without any other queueing service.
+
+    Attributes:
+    - units: The iterator of the job's units, dicts with a kind and its parameters.
+    - options: The options sent to every worker.
+    - on_result: Called with each unit and its result as they arrive.
+    - reissued: The units to issue again before taking new ones.
+    - assigned: The units being worked on, by id, with the connection working on them.
+    - exhausted: Whether every unit has been taken from the iterator.
+    - done: Set when every unit has a result.
+    """
+
+    HEARTBEAT = 2.0
+    LAPSE = 10.0
+    # Seconds a worker is told to wait before asking again while all remaining units are being worked on
+    RETRY = 0.5
+    PROMOTIONS = (Pieces.QUEEN, Pieces.ROOK, Pieces.BISHOP, Pieces.KNIGHT)
+
+    def __init__(self, units, options, on_result):
+        """
+        Parameters:
+        - units: An iterable of the job's units.
+        - options: The options sent to every worker.
+        - on_result: Called with each unit and its result as they arrive.
+        """
+        self.units = iter(units)
+        self.options = options
+        self.on_result = on_result
+        self.reissued = collections.deque()
+        self.assigned = {}
+        self.exhausted = False
+        self.next_id = 0
+        self.done = None
+
+    @staticmethod
+    def analysis_units(lines):
+        """
+        Makes a unit of every position of a FEN or EPD file, keeping its line number.
+        """
+        for number, line in enumerate(lines, 1):
+            if line.strip() and not line.lstrip().startswith("#"):
+                yield {"kind": "analyse", "line": number, "text": line}
+
+    @classmethod
+    def perft_units(cls, fen, depth, split):
+        """
+        Splits a perft count into the subtrees below every line of split plies.
+
+        Parameters:
+        - fen: The root position.
+        - depth: The perft depth.
+        - split: The number of plies played out by the coordinator, less than the depth.
+
+        Returns:
+        A generator of units, each with the moves from the root in UCI notation and the depth left to count.
+        """
+        board = Board.from_fen(fen)
+
+        def lines(board, plies):
+            if not plies:
+                yield []
+                return
+            for move in board.get_legal_moves():
+                for promotion in cls.PROMOTIONS if move.is_promotion else (None,):
+                    move.promotion = promotion
+                    text = UCI.format_move(board, move)
+                    board.make_move(move, True)
+                    for line in lines(board, plies - 1):
+                        yield [text] + line
+                    board.undo_move(move)
+
+        for line in lines(board, split):
+            yield {"kind": "perft", "fen": fen, "moves": line, "depth": depth - len(line)}
+
+    def next_unit(self):
+        """
+        Takes the next unit to issue, a reissued one first.
+
+        Returns:
+        The unit, or None if every unit has been issued.
+        """
+        if self.reissued:
+            return self.reissued.popleft()
+        if self.exhausted:
+            return None
+        try:
+            unit = next(self.units)
+        except StopIteration:
+            self.exhausted = True
+            return None
+        self.next_id += 1
+        unit["id"] = self.next_id
+        return unit
+
+    def finished(self):
+        return self.exhausted and not self.reissued and not self.assigned
+
+    def give_up(self, connection):
+        """
+        Issues the units of a lapsed or disconnected worker again.
+        """
+        for unit_id, (unit, owner) in list(self.assigned.items()):
+            if owner is connection:
+                del self.assigned[unit_id]
+                self.reissued.append(unit)
+
+    async def send(self, writer, message):
+        writer.write((json.dumps(message) + "\n").encode())
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        """
+        Serves a worker's connection until the job is done or the worker is given up on.
+        """
+        peer = writer.get_extra_info("peername")
+        # Units and results are short lines, sent as soon as they are written rather than held back by Nagle
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), self.LAPSE)
+                except asyncio.TimeoutError:
+                    print("worker %s lapsed" % (peer,), file=sys.stderr)
+                    return
+                if not line:
+                    return
+                message = json.loads(line)
+                kind = message.get("type")
+                if kind == "hello":
+                    await self.send(writer, {"type": "welcome", "options": self.options, "heartbeat": self.HEARTBEAT})
+                elif kind == "request":
+                    unit = self.next_unit()
+                    if unit:
+                        self.assigned[unit["id"]] = (unit, writer)
+                        await self.send(writer, {"type": "unit", "unit": unit})
+                    elif self.finished():
+                        await self.send(writer, {"type": "done"})
+                        self.done.set()
+                        return
+                    else:
+                        await self.send(writer, {"type": "wait", "seconds": self.RETRY})
+                elif kind == "result":
+                    entry = self.assigned.get(message["id"])
+                    if entry and entry[1] is writer:
+                        del self.assigned[message["id"]]
+                        self.on_result(entry[0], message["result"])
+                        if self.finished():
+                            self.done.set()
+        except (ConnectionError, json.JSONDecodeError, KeyError):
+            pass
+        finally:
+            self.give_up(writer)
+            writer.close()
+
+    async def serve(self, host, port):
+        """
+        Serves workers until every unit has a result.
+        """
+        self.done = asyncio.Event()
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await self.done.wait()
+            # Lets the workers waiting for a unit hear that the job is done
+            await asyncio.sleep(self.RETRY * 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distribute an analysis or perft job to remote workers.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=9000)
+    commands = parser.add_subparsers(dest="command", required=True)
+    analyse = commands.add_parser("analyse", help="analyse a FEN or EPD file, one position per unit")
+    analyse.add_argument("input", nargs="?", default="-", help="file of FEN or EPD lines, - for stdin")
+    analyse.add_argument("--depth", type=int, help="depth limit per position")
+    analyse.add_argument("--nodes", type=int, help="node limit per position")
+    analyse.add_argument("--movetime", type=int, help="time limit per position in milliseconds")
+    analyse.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    perft = commands.add_parser("perft", help="count the leaves of a move tree, divided by root move")
+    perft.add_argument("depth", type=int)
+    perft.add_argument("--fen", default=UCI.START_FEN)
+    perft.add_argument("--split", type=int, default=2, help="plies played out by the coordinator")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    if args.command == "analyse":
+        depth = args.depth
+        if depth is None:
+            depth = UCI.MAX_DEPTH if args.nodes or args.movetime else BatchAnalysis.DEFAULT_DEPTH
+        source = sys.stdin if args.input == "-" else open(args.input)
+        WorkerPool.use_engine_directory()
+
+        def write(unit, result):
+            sys.stdout.write(json.dumps(result) + "\n")
+            sys.stdout.flush()
+
+        coordinator = Coordinator(Coordinator.analysis_units(source), {
+            "kind": "analyse", "depth": depth, "nodes": args.nodes, "movetime": args.movetime,
+            "hash_mb": args.hash}, write)
+        asyncio.run(coordinator.serve(args.host, args.port))
+    else:
+        if args.depth < 1:
+            parser.error("the depth must be at least 1")
+        WorkerPool.use_engine_directory()
+        counts = collections.Counter()
+        errors = []
+
+        def add(unit, result):
+            if isinstance(result, dict):
+                errors.append(unit)
+                print("unit %s failed: %s" % (" ".join(unit["moves"]), result["error"]), file=sys.stderr)
+            else:
+                counts[unit["moves"][0] if unit["moves"] else "total"] += result
+
+        units = Coordinator.perft_units(args.fen, args.depth, max(0, min(args.split, args.depth - 1)))
+        asyncio.run(Coordinator(units, {"kind": "perft"}, add).serve(args.host, args.port))
+        for move, count in sorted(counts.items()):
+            if move != "total":
+                print("%s: %d" % (move, count))
+        print("\nNodes searched: %d" % sum(counts.values()))
+        if errors:
+            print("%d units failed, the count is incomplete" % len(errors), file=sys.stderr)
+    print("%.1fs" % (time.monotonic() - start), file=sys.stderr)
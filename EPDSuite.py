@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from BatchAnalysis import BatchAnalysis
+from Board import Board
+from Engine import SearchAborted
+from PGN import PGN
+from Pieces import Pieces
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class EPDSuite:
+    """
+    Runs a tactical test suite: EPD positions with best move (bm) or avoid move (am) operations, searched on a
+    pool of worker processes within a fixed time or node limit per position.
+
+    A position is solved if the engine's move is one of its bm moves and none of its am moves. Its time and nodes
+    to solution are those of the first completed iteration from which the engine kept choosing a right move to
+    the end of the search, so a move found early and then abandoned does not count.
+
+    The results can be saved as JSON and compared with a saved baseline, position by position, to see whether a
+    change to the engine solves more positions in the same time.
+    """
+
+    DEFAULT_MOVETIME = 1000
+
+    @staticmethod
+    def move_key(move):
+        """
+        Identifies a move by its squares and promotion piece, so that moves from different move lists compare.
+        """
+        return move.start_square, move.end_square, (move.promotion or Pieces.QUEEN) if move.is_promotion else None
+
+    @classmethod
+    def parse_moves(cls, board, operands):
+        """
+        Reads the moves of a bm or am operation, in SAN or UCI notation.
+
+        Returns:
+        The set of their move keys.
+
+        Raises:
+        ValueError: If a move is not legal in the position.
+        """
+        moves = board.get_legal_moves()
+        table = PGN.lookup(moves)
+        keys = set()
+        for text in operands.split():
+            move = PGN.parse_san(board, text, table) or UCI.parse_move(board, text)
+            if not move:
+                raise ValueError("illegal move %s" % text)
+            keys.add(cls.move_key(move))
+        return keys
+
+    @classmethod
+    def solve(cls, task):
+        """
+        Runs in a worker: searches one position of the suite.
+
+        Parameters:
+        - task: A tuple (line number, line of the suite).
+
+        Returns:
+        The result as a dict, with an error instead of the outcome if the position is invalid or the search fails.
+        """
+        number, line = task
+        result = {"line": number}
+        try:
+            fen, operations = BatchAnalysis.parse_line(line)
+            board = Board.from_fen(fen)
+            result["id"] = operations.get("id") or fen
+            best = cls.parse_moves(board, operations.get("bm", ""))
+            avoid = cls.parse_moves(board, operations.get("am", ""))
+        except (ValueError, IndexError) as error:
+            result["error"] = "invalid position: %s" % error
+            return result
+        if not best and not avoid:
+            result["error"] = "no bm or am operation"
+            return result
+        return BatchAnalysis.search_or_report(cls.search, board, best, avoid, result)
+
+    @classmethod
+    def search(cls, board, best, avoid, result):
+        """
+        Runs in a worker: searches a position of the suite within the limits and adds the outcome to its result.
+
+        Parameters:
+        - board: The position.
+        - best: The keys of its bm moves.
+        - avoid: The keys of its am moves.
+        - result: The position's result so far.
+
+        Returns:
+        The result.
+        """
+        worker = WorkerPool.worker
+        engine = WorkerPool.engine(board)
+        engine.max_nodes = worker["nodes"]
+        start = time.monotonic()
+        if worker["movetime"]:
+            engine.deadline = start + worker["movetime"] / 1000
+        # The time and nodes of the first iteration of the current run of right moves
+        solution = {}
+
+        def iteration(depth):
+            key = cls.move_key(engine.best_move)
+            if (not best or key in best) and key not in avoid:
+                solution.setdefault("depth", depth)
+                solution.setdefault("time", round(time.monotonic() - start, 3))
+                solution.setdefault("nodes", engine.nodes)
+            else:
+                solution.clear()
+
+        engine.on_iteration = iteration
+        try:
+            engine.search(worker["depth"])
+        except SearchAborted:
+            pass
+        result.update({"solved": bool(solution), "move": UCI.format_move(board, engine.best_move)
+                       if engine.best_move else None, "time": round(time.monotonic() - start, 3),
+                       "nodes": engine.nodes})
+        if solution:
+            result.update({"solution_depth": solution["depth"], "solution_time": solution["time"],
+                           "solution_nodes": solution["nodes"]})
+        return result
+
+    @classmethod
+    def run(cls, lines, output, workers=None, depth=None, nodes=None, movetime=None, hash_mb=16):
+        """
+        Runs every position of the suite and writes a line per position as it completes.
+
+        Parameters:
+        - lines: The suite, any iterable of EPD lines.
+        - output: The stream to write the report to.
+        - workers: The number of worker processes, all cores if None.
+        - depth: The depth limit, UCI.MAX_DEPTH if None.
+        - nodes: The node limit per position, or None.
+        - movetime: The time limit per position in milliseconds. Without any limit, DEFAULT_MOVETIME.
+
+        Returns:
+        The results, in suite order.
+        """
+        if not (depth or nodes or movetime):
+            movetime = cls.DEFAULT_MOVETIME
+        depth = depth or UCI.MAX_DEPTH
+        tasks = ((number, line) for number, line in enumerate(lines, 1)
+                 if line.strip() and not line.lstrip().startswith("#"))
+        results = []
+        for result in WorkerPool.map(cls.solve, tasks, workers, hash_mb,
+                                     {"depth": depth, "nodes": nodes, "movetime": movetime}):
+            output.write(cls.format_result(result) + "\n")
+            output.flush()
+            results.append(result)
+        results.sort(key=lambda result: result["line"])
+        return results
+
+    @staticmethod
+    def format_result(result):
+        """
+        Writes a position's result as a line of the report.
+        """
+        name = "%5d %-24s" % (result["line"], str(result.get("id", ""))[:24])
+        if "error" in result:
+            return "%s error: %s" % (name, result["error"])
+        if result["solved"]:
+            return "%s solved  %-6s %8.3fs %10d nodes (depth %d)" % (
+                name, result["move"], result["solution_time"], result["solution_nodes"], result["solution_depth"])
+        return "%s failed  %-6s" % (name, result["move"] or "-")
+
+    @staticmethod
+    def summarize(results, limits):
+        """
+        Collects the results of a run into the JSON document that is saved and compared.
+
+        Parameters:
+        - results: The results of run.
+        - limits: The search limits of the run, as a dict.
+        """
+        positions = {str(result["id"]): result for result in results if "id" in result and "error" not in result}
+        solved = [result for result in positions.values() if result["solved"]]
+        return {"limits": limits, "total": len(positions), "solved": len(solved),
+                "solution_time": round(sum(result["solution_time"] for result in solved), 3),
+                "solution_nodes": sum(result["solution_nodes"] for result in solved),
+                "positions": positions}
+
+    @staticmethod
+    def compare(summary, baseline):
+        """
+        Compares a run with a baseline run of the same suite.
+
+        Returns:
+        The lines of the comparison report.
+        """
+        lines = []
+        if summary["limits"] != baseline.get("limits"):
+            lines.append("warning: the baseline was run with other limits: %s" % json.dumps(baseline.get("limits")))
+        lines.append("solved %d/%d, baseline %d/%d (%+d)" % (summary["solved"], summary["total"], baseline["solved"],
+                                                            baseline["total"], summary["solved"] - baseline["solved"]))
+        both = []
+        for key, result in summary["positions"].items():
+            before = baseline["positions"].get(key)
+            if not before or "error" in before:
+                continue
+            if result["solved"] and not before["solved"]:
+                lines.append("  newly solved: %s" % key)
+            elif before["solved"] and not result["solved"]:
+                lines.append("  newly failed: %s" % key)
+            elif result["solved"]:
+                both.append((result, before))
+        if both:
+            # Totals over the positions both runs solved, so that newly solved positions do not skew them
+            time_now, time_before = (sum(pair[side]["solution_time"] for pair in both) for side in (0, 1))
+            nodes_now, nodes_before = (sum(pair[side]["solution_nodes"] for pair in both) for side in (0, 1))
+            lines.append("solved by both (%d): time to solution %.3fs, baseline %.3fs; nodes %d, baseline %d" % (
+                len(both), time_now, time_before, nodes_now, nodes_before))
+        return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an EPD test suite with bm/am operations.")
+    parser.add_argument("input", nargs="?", default="-", help="EPD file, - for stdin")
+    parser.add_argument("--depth", type=int, help="depth limit per position")
+    parser.add_argument("--nodes", type=int, help="node limit per position")
+    parser.add_argument("--movetime", type=int, help="time limit per position in milliseconds")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--save", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare the results with this saved JSON file")
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    paths = [os.path.abspath(path) if path else None for path in (args.save, args.baseline)]
+    WorkerPool.use_engine_directory()
+    with source:
+        results = EPDSuite.run(source, sys.stdout, args.workers, args.depth, args.nodes, args.movetime, args.hash)
+    limits = {"depth": args.depth, "nodes": args.nodes,
+              "movetime": args.movetime or (None if args.depth or args.nodes else EPDSuite.DEFAULT_MOVETIME)}
+    summary = EPDSuite.summarize(results, limits)
+    print("solved %d/%d, time to solution %.3fs, nodes to solution %d" % (
+        summary["solved"], summary["total"], summary["solution_time"], summary["solution_nodes"]))
+    if paths[0]:
+        with open(paths[0], "w") as file:
+            json.dump(summary, file, indent=1)
+    if paths[1]:
+        with open(paths[1]) as file:
+            print("\n".join(EPDSuite.compare(summary, json.load(file))))
@@ -1,8 +1,20 @@
+import json
+import os
+import threading
+import time
+
 import chess as chess
 import chess.polyglot
 
 from Pieces import Pieces
 from Move import Move
+from TranspositionTable import TranspositionTable
+
+
+class SearchAborted(Exception):
+    """
+    Raised inside the search when it has been asked to stop.
+    """
 
 
 class Engine:
@@ -58,141 +70,728 @@ class Engine:
                 20, 20, 0, 0, 0, 0, 20, 20,
                 20, 30, 10, 0, 0, 10, 30, 20]
 
+    # Endgame tables, blended with the tables above by game phase. They start out equal to the middlegame
+    # tables, so the score does not depend on the phase until they are tuned.
+    PWEIGHTS_EG = PWEIGHTS
+    KNWEIGHTS_EG = KNWEIGHTS
+    BWEIGHTS_EG = BWEIGHTS
+    RWEIGHTS_EG = RWEIGHTS
+    QWEIGHTS_EG = QWEIGHTS
+    KWEIGHTS_EG = KWEIGHTS
+
+    # The phase is the sum of these weights over the pieces on the board, MAX_PHASE in the opening
+    PHASE_WEIGHTS = {Pieces.KNIGHT: 1, Pieces.BISHOP: 1, Pieces.ROOK: 2, Pieces.QUEEN: 4}
+    MAX_PHASE = 24
+
+    # Scores are small integers in [-INFINITY, INFINITY]. A mate delivered n plies from the root scores
+    # CHECKMATE_VALUE - n, so anything beyond MATE_BOUND is a mate score and faster mates score higher.
     DRAW_VALUE = 0
-    CHECKMATE_VALUE = 9223372036854775807
-    CHECK_VALUE = 150
+    MAX_PLY = 128
+    CHECKMATE_VALUE = 32000
+    MATE_BOUND = CHECKMATE_VALUE - MAX_PLY
+    INFINITY = CHECKMATE_VALUE + 1
+    # A position a bitbase proves won scores KNOWN_WIN plus the winning side's progress, above any ordinary
+    # evaluation and below the mate scores. The progress term steers the search towards mate, since the tables
+    # only hold the result.
+    KNOWN_WIN = 20000
+    DARK_SQUARES = 0xAA55AA55AA55AA55
+
+    # Positional terms, added to the material and piece-square estimate from white's point of view. Mobility
+    # is per square a piece attacks that is not occupied by its own side, passed pawns are scored by rank from
+    # their own side, and the king terms are scaled down with the phase as the pieces come off.
+    MOBILITY = {Pieces.KNIGHT: 4, Pieces.BISHOP: 5, Pieces.ROOK: 2, Pieces.QUEEN: 1}
+    DOUBLED_PAWN = 12
+    ISOLATED_PAWN = 10
+    PASSED_PAWN = [0, 5, 10, 20, 35, 60, 100, 0]
+    PAWN_SHIELD = 12
+    KING_ZONE_ATTACK = 6
+    ADJACENT_FILES = [(0x0101010101010101 << file - 1 if file > 0 else 0) |
+                      (0x0101010101010101 << file + 1 if file < 7 else 0) for file in range(8)]
+    # The squares in front of a pawn on its own and the adjacent files, for white and for black
+    PASSED_MASKS = [[sum(1 << rank * 8 + file for rank in range(sq // 8 + 1, 8)
+                         for file in range(max(0, sq % 8 - 1), min(8, sq % 8 + 2))) for sq in range(64)],
+                    [sum(1 << rank * 8 + file for rank in range(0, sq // 8)
+                         for file in range(max(0, sq % 8 - 1), min(8, sq % 8 + 2))) for sq in range(64)]]
+    # The positional terms are only computed when the estimate is within LAZY_MARGIN of the window, since
+    # they can rarely move the score further than that
+    LAZY_MARGIN = 300
+
+    # Tuned tables written by Tuner, loaded over the defaults above when the file exists
+    WEIGHTS_FILE = "weights.json"
+    TABLE_NAMES = {Pieces.PAWN: ("PWEIGHTS", "PWEIGHTS_EG"), Pieces.KNIGHT: ("KNWEIGHTS", "KNWEIGHTS_EG"),
+                   Pieces.BISHOP: ("BWEIGHTS", "BWEIGHTS_EG"), Pieces.ROOK: ("RWEIGHTS", "RWEIGHTS_EG"),
+                   Pieces.QUEEN: ("QWEIGHTS", "QWEIGHTS_EG"), Pieces.KING: ("KWEIGHTS", "KWEIGHTS_EG")}
+    # Black reads these tables from its own side of the board, and the others as they are
+    MIRRORED_TABLES = {Pieces.PAWN, Pieces.ROOK, Pieces.QUEEN, Pieces.KING}
 
-    def __init__(self, board):
+    def __init__(self, board, tt=None, nnue=None, bitbases=None):
         self.board = board
+        self.board.set_psqt(*self.build_psqt([(piece.get_piece_type(), piece.is_white()) for piece in board.pieces]))
+        if nnue:
+            # The network replaces the piece-square evaluation, see evaluate
+            self.board.accumulator = nnue
+            nnue.refresh(self.board)
+        self.tt = tt if tt else TranspositionTable()
+        self.bitbases = bitbases
+        # The piece counts of the root position, telling which positions of the search entered a bitbase
+        self.root_material = None
+        # A ParallelSearch whose helpers search alongside this engine, and how far a helper rotates its root moves
+        self.helpers = None
+        self.root_rotation = 0
+        # A RootSplitSearch that searches the root moves after the first one in worker processes
+        self.root_split = None
+        self.stop = threading.Event()
+        # Optional limits that abort the search: a node count, and a time.monotonic() time
+        self.max_nodes = None
+        self.deadline = None
+        # A multiprocessing.Value counting the nodes of several processes, which max_nodes then applies to
+        self.shared_nodes = None
+        # Called with the depth after every completed iteration of search
+        self.on_iteration = None
+        self.nodes = 0
+        self.lazy_exits = 0
+        self.full_evaluations = 0
+        self.depth = 0
+        self.best_move = None
+        self.best_score = -self.INFINITY
+        self.pv = []
+        self.ponder_move = None
+        self.ponder_engine = None
+        self.ponder_thread = None
 
-    def evaluate(self):
-        if self.board.is_insufficient_material():
-            return self.DRAW_VALUE
-        if self.board.is_white_turn and self.board.is_stalemate(self.board.wk):
-            return self.DRAW_VALUE
-        if not self.board.is_white_turn and self.board.is_stalemate(self.board.bk):
-            return self.DRAW_VALUE
-        if self.board.is_checkmate(self.board.wk):
-            return -self.CHECKMATE_VALUE
-        if self.board.is_checkmate(self.board.bk):
-            return self.CHECKMATE_VALUE
-
-        wp = self.board.get_squares(self.board.wp.get_board())
-        bp = self.board.get_squares(self.board.bp.get_board())
-
-        wkn = self.board.get_squares(self.board.wkn.get_board())
-        bkn = self.board.get_squares(self.board.bkn.get_board())
-
-        wb = self.board.get_squares(self.board.wb.get_board())
-        bb = self.board.get_squares(self.board.bb.get_board())
-
-        wr = self.board.get_squares(self.board.wr.get_board())
-        br = self.board.get_squares(self.board.br.get_board())
-
-        wq = self.board.get_squares(self.board.wq.get_board())
-        bq = self.board.get_squares(self.board.bq.get_board())
-
-        wk = self.board.get_squares(self.board.wk.get_board())
-        bk = self.board.get_squares(self.board.bk.get_board())
-
-        eval = (
-                self.VALUES[Pieces.PAWN] * (len(wp) - len(bp)) +
-                self.VALUES[Pieces.KNIGHT] * (len(wkn) - len(bkn)) +
-                self.VALUES[Pieces.BISHOP] * (len(wb) - len(bb)) +
-                self.VALUES[Pieces.ROOK] * (len(wr) - len(br)) +
-                self.VALUES[Pieces.QUEEN] * (len(wq) - len(bq)) +
-                sum(self.PWEIGHTS[sq] for sq in wp) + sum(-self.PWEIGHTS[63 - sq] for sq in bp) +
-                sum(self.KNWEIGHTS[sq] for sq in wkn) + sum(-self.KNWEIGHTS[sq] for sq in bkn) +
-                sum(self.BWEIGHTS[sq] for sq in wb) + sum(-self.BWEIGHTS[sq] for sq in bb) +
-                sum(self.RWEIGHTS[sq] for sq in wr) + sum(-self.RWEIGHTS[63 - sq] for sq in br) +
-                sum(self.QWEIGHTS[sq] for sq in wq) + sum(-self.QWEIGHTS[63 - sq] for sq in bq) +
-                sum(self.KWEIGHTS[sq] for sq in wk) + sum(-self.KWEIGHTS[63 - sq] for sq in bk) +
-                self.CHECK_VALUE * self.board.is_check(self.board.wk) -
-                self.CHECK_VALUE * self.board.is_check(self.board.bk)
-
-        )
+    def evaluate(self, alpha=-INFINITY, beta=INFINITY):
+        """
+        Statically scores the current position from the side to move's point of view.
+
+        This is a pure scoring function: it generates no moves and does not recognise mate, stalemate or
+        draws, which the search detects when a node has no legal moves.
+
+        Evaluation is lazy. The material and piece-square estimate is kept up to date by the board on every
+        move and is almost free. If it is more than LAZY_MARGIN outside the (alpha, beta) window, the
+        positional terms could not bring the score back into it and are skipped. lazy_exits and
+        full_evaluations count how often each case happens.
+
+        If the board has a network accumulator, the network's score is used instead, kept clear of the mate
+        scores.
+
+        Parameters:
+        - alpha: The lower bound of the search window.
+        - beta: The upper bound of the search window.
+        """
+        if self.board.accumulator:
+            return max(-self.MATE_BOUND + 1, min(self.MATE_BOUND - 1, self.board.accumulator.evaluate(self.board)))
+        estimate = self.estimate()
+        if estimate + self.LAZY_MARGIN <= alpha or estimate - self.LAZY_MARGIN >= beta:
+            self.lazy_exits += 1
+            return estimate
+        self.full_evaluations += 1
+        positional = self.positional()
+        return estimate + positional if self.board.is_white_turn else estimate - positional
+
+    def estimate(self):
+        """
+        Scores the current position by material and piece-square tables only, from the side to move's point
+        of view. Only the blend by game phase is computed here.
+        """
+        phase = min(self.board.phase, self.MAX_PHASE)
+        eval = (self.board.mg_score * phase + self.board.eg_score * (self.MAX_PHASE - phase)) // self.MAX_PHASE
         if self.board.is_white_turn:
             return eval
         else:
             return -eval
 
-    def alphabeta(self, alpha, beta, depth):
-        best_score = -float('inf')
+    def positional(self):
+        """
+        Scores mobility, pawn structure and king safety from white's point of view.
+        """
+        board = self.board
+        occ = board.get_occupied()
+        phase = min(board.phase, self.MAX_PHASE)
+        score = 0
+        for side, sign in ((0, 1), (1, -1)):
+            own = board.get_white() if side == 0 else board.get_black()
+            pawns = board.pieces[side].get_board()
+            enemy_pawns = board.pieces[1 - side].get_board()
+
+            mobility = 0
+            for sq in board.get_squares(board.pieces[4 + side].get_board()):
+                mobility += self.MOBILITY[Pieces.KNIGHT] * (board.KNIGHT_ATTACKS[sq] & ~own).bit_count()
+            for sq in board.get_squares(board.pieces[6 + side].get_board()):
+                mobility += self.MOBILITY[Pieces.BISHOP] * (board.bishop_attacks(sq, occ) & ~own).bit_count()
+            for sq in board.get_squares(board.pieces[2 + side].get_board()):
+                mobility += self.MOBILITY[Pieces.ROOK] * (board.rook_attacks(sq, occ) & ~own).bit_count()
+            for sq in board.get_squares(board.pieces[8 + side].get_board()):
+                attacks = board.rook_attacks(sq, occ) | board.bishop_attacks(sq, occ)
+                mobility += self.MOBILITY[Pieces.QUEEN] * (attacks & ~own).bit_count()
+
+            structure = 0
+            for file in range(8):
+                count = (pawns & board.FILE_MASKS[file]).bit_count()
+                if count > 1:
+                    structure -= self.DOUBLED_PAWN * (count - 1)
+                if count and not pawns & self.ADJACENT_FILES[file]:
+                    structure -= self.ISOLATED_PAWN * count
+            for sq in board.get_squares(pawns):
+                if not enemy_pawns & self.PASSED_MASKS[side][sq]:
+                    structure += self.PASSED_PAWN[sq // 8 if side == 0 else 7 - sq // 8]
+
+            zone = board.KING_ATTACKS[board.lsb(board.pieces[10 + side].get_board())]
+            attacked = board.get_attack_map(side == 1, occ)
+            king = self.PAWN_SHIELD * (pawns & zone).bit_count() - self.KING_ZONE_ATTACK * (zone & attacked).bit_count()
+
+            score += sign * (mobility + structure + king * phase // self.MAX_PHASE)
+        return score
+
+    @classmethod
+    def load_weights(cls, path=WEIGHTS_FILE):
+        """
+        Replaces the piece values and piece-square tables with tuned ones.
+
+        Engines created afterwards use the new tables. Tables missing from the file keep their defaults.
+
+        Parameters:
+        - path: The JSON file written by Tuner.save_weights.
+
+        Returns:
+        True if the file was found and loaded, False otherwise.
+        """
+        if not os.path.exists(path):
+            return False
+        with open(path) as file:
+            weights = json.load(file)
+        cls.VALUES = {**cls.VALUES, **{Pieces[name]: value for name, value in weights.get("VALUES", {}).items()}}
+        for names in cls.TABLE_NAMES.values():
+            for name in names:
+                if name in weights:
+                    setattr(cls, name, list(weights[name]))
+        return True
+
+    @classmethod
+    def build_psqt(cls, pieces):
+        """
+        Precomputes the material plus piece-square value of every piece on every square.
+
+        Black's values are negated, and mirrored for the pieces in MIRRORED_TABLES.
+
+        Parameters:
+        - pieces: The (piece_type, is_white) pairs to build tables for, in order.
+
+        Returns:
+        A tuple (mg, eg, phase) of per-piece lists, in the layout expected by Board.set_psqt.
+        """
+        mg, eg, phase = [], [], []
+        for piece_type, is_white in pieces:
+            mg_table, eg_table = (getattr(cls, name) for name in cls.TABLE_NAMES[piece_type])
+            mirrored = piece_type in cls.MIRRORED_TABLES
+            value = cls.VALUES.get(piece_type, 0)
+            if is_white:
+                mg.append([value + mg_table[sq] for sq in range(64)])
+                eg.append([value + eg_table[sq] for sq in range(64)])
+            else:
+                mg.append([-value - mg_table[63 - sq if mirrored else sq] for sq in range(64)])
+                eg.append([-value - eg_table[63 - sq if mirrored else sq] for sq in range(64)])
+            phase.append(cls.PHASE_WEIGHTS.get(piece_type, 0))
+        return mg, eg, phase
+
+    def alphabeta(self, alpha, beta, depth, ply=0):
+        self.check_stop()
+        if self.board.is_insufficient_material() or ply and self.board.is_repetition():
+            return self.DRAW_VALUE
+        # The endgame tables end the search where a capture or promotion enters them. With the root already in
+        # a table they only score the leaves, so that the search still looks for progress towards mate.
+        if ply and self.bitbases and self.board.get_occupied().bit_count() <= self.bitbases.MAX_PIECES and \
+                (depth <= 0 or self.get_material() != self.root_material):
+            # The tables only hold the result, so mate and stalemate are scored first to keep their exact scores
+            if not self.board.get_legal_moves():
+                king = self.board.wk if self.board.is_white_turn else self.board.bk
+                return -self.CHECKMATE_VALUE + ply if self.board.get_checkers(king) else self.DRAW_VALUE
+            result = self.bitbases.probe(self.board)
+            if result is not None:
+                return self.bitbase_score(result)
         if depth == 0:
-            return self.quiesce(alpha, beta)
+            return self.quiesce(alpha, beta, ply)
+
+        # Mate distance pruning, no line from here can beat a mate that was already found closer to the root
+        alpha = max(alpha, -self.CHECKMATE_VALUE + ply)
+        beta = min(beta, self.CHECKMATE_VALUE - ply - 1)
+        if alpha >= beta:
+            return alpha
 
-        moves = self.board.get_all_moves()
-        moves = self.board.remove_check_moves(moves, self.board.wk if self.board.is_white_turn else self.board.bk)
-        moves = sorted(reversed(moves), key=Move.move_sort_key)
+        key = self.board.get_key()
+        entry = self.tt.probe(key)
+        tt_move = TranspositionTable.NO_MOVE
+        if entry:
+            tt_score, tt_depth, flag, tt_move = entry
+            tt_score = self.score_from_tt(tt_score, ply)
+            if tt_depth >= depth and (flag == TranspositionTable.EXACT or
+                                      flag == TranspositionTable.LOWER and tt_score >= beta or
+                                      flag == TranspositionTable.UPPER and tt_score <= alpha):
+                return tt_score
+
+        best_score = -self.INFINITY
+        best_move = None
+        original_alpha = alpha
+        king = self.board.wk if self.board.is_white_turn else self.board.bk
+        checkers = self.board.get_checkers(king)
+        if checkers:
+            moves = self.board.get_evasion_moves(king, checkers)
+        else:
+            moves = self.board.get_all_moves()
+            moves = self.board.remove_check_moves(moves, king)
+        if not moves:
+            return -self.CHECKMATE_VALUE + ply if checkers else self.DRAW_VALUE
+        moves = self.order_moves(moves, tt_move)
 
         for move in moves:
             if 1 << move.end_square == self.board.wk.get_board() or 1 << move.end_square == self.board.bk.get_board():
                 continue
             self.board.make_move(move, True)
-            score = -self.alphabeta(-beta, -alpha, depth - 1)
-            self.board.undo_move(move)
+            try:
+                score = -self.alphabeta(-beta, -alpha, depth - 1, ply + 1)
+            finally:
+                self.board.undo_move(move)
             if score >= beta:
+                self.tt.store(key, depth, TranspositionTable.LOWER, self.score_to_tt(score, ply), move)
                 return score
             if score > best_score:
                 best_score = score
+                best_move = move
             if score > alpha:
                 alpha = score
+
+        flag = TranspositionTable.EXACT if best_score > original_alpha else TranspositionTable.UPPER
+        self.tt.store(key, depth, flag, self.score_to_tt(best_score, ply), best_move)
         return best_score
 
-    def quiesce(self, alpha, beta):
-        eval = self.evaluate()
-        if eval >= beta:
-            return beta
-        if alpha < eval:
-            alpha = eval
+    def get_material(self):
+        """
+        Counts the pieces on each bitboard, which only change with a capture or a promotion.
+        """
+        return tuple(piece.get_board().bit_count() for piece in self.board.pieces)
+
+    def keep_bitbase_result(self, moves):
+        """
+        Drops the root moves that throw away the result of a position in a bitbase, such as a win given up for
+        a draw. The search then only chooses between moves that keep the result.
 
-        moves = self.board.get_all_moves()
-        moves = self.board.remove_check_moves(moves, self.board.wk if self.board.is_white_turn else self.board.bk)
-        moves = sorted(reversed(moves), key=Move.move_sort_key)
+        Parameters:
+        - moves: The legal moves of the root.
 
+        Returns:
+        The moves that keep the result, or all of them if the position is not in a bitbase.
+        """
+        board = self.board
+        if not self.bitbases or board.get_occupied().bit_count() > self.bitbases.MAX_PIECES:
+            return moves
+        result = self.bitbases.probe(board)
+        if result is None:
+            return moves
+        kept = []
+        kings = board.wk.get_board() | board.bk.get_board()
         for move in moves:
-            if 1 << move.end_square == self.board.wk.get_board() or 1 << move.end_square == self.board.bk.get_board():
+            if kings & (1 << move.end_square):
+                # The position is not legal, the search takes the king
+                return moves
+            board.make_move(move, True)
+            try:
+                # A move that mates or stalemates keeps the result exactly when the table says so
+                if board.get_legal_moves():
+                    reply = self.bitbases.probe(board)
+                else:
+                    reply = -1 if board.get_checkers(board.wk if board.is_white_turn else board.bk) else 0
+            finally:
+                board.undo_move(move)
+            if reply is None or -reply == result:
+                kept.append(move)
+        return kept or moves
+
+    def bitbase_score(self, result):
+        """
+        Scores a bitbase result from the side to move's point of view.
+
+        Parameters:
+        - result: 1 if the side to move wins, 0 for a draw, -1 if it loses.
+        """
+        if result == 0:
+            return self.DRAW_VALUE
+        winner_is_white = self.board.is_white_turn == (result > 0)
+        return result * (self.KNOWN_WIN + self.mop_up(winner_is_white))
+
+    def mop_up(self, winner_is_white):
+        """
+        Measures the winning side's progress in a won bitbase ending, since the tables only hold the result.
+
+        Progress is material, with pawns counted by how far they have advanced, the bare king driven to the edge,
+        towards a corner of the bishop's colour when mating with bishop and knight, and the kings brought
+        together.
+
+        Parameters:
+        - winner_is_white: Whether white is the winning side.
+
+        Returns:
+        The progress, a positive score well below KNOWN_WIN.
+        """
+        board = self.board
+        winner = board.get_squares((board.wk if winner_is_white else board.bk).get_board())[0]
+        loser = board.get_squares((board.bk if winner_is_white else board.wk).get_board())[0]
+        progress = 0
+        bishops = 0
+        knights = []
+        for piece in board.pieces:
+            if piece.is_white() != winner_is_white or piece.get_piece_type() == Pieces.KING:
                 continue
-            if move.is_capture:
-                self.board.make_move(move, True)
-                score = -self.quiesce(-beta, -alpha)
+            for sq in board.get_squares(piece.get_board()):
+                progress += self.VALUES[piece.get_piece_type()]
+                if piece.get_piece_type() == Pieces.PAWN:
+                    progress += 20 * (board.get_rank(sq) if winner_is_white else 7 - board.get_rank(sq))
+                elif piece.get_piece_type() == Pieces.BISHOP:
+                    bishops |= 1 << sq
+                elif piece.get_piece_type() == Pieces.KNIGHT:
+                    knights.append(sq)
+        file, rank = board.get_file(loser), board.get_rank(loser)
+        progress += 10 * (max(3 - file, file - 4) + max(3 - rank, rank - 4))
+        distance = abs(file - board.get_file(winner)) + abs(rank - board.get_rank(winner))
+        progress += 4 * (14 - distance)
+        dark = bishops & self.DARK_SQUARES
+        light = bishops & ~self.DARK_SQUARES
+        if dark and not light or light and not dark:
+            # Mate is only forced in a corner the bishop covers: a1 and h8 are dark, a8 and h1 light. Driving the
+            # king there outweighs the rest, and the winning king and knight stay close to cut it off.
+            corners = (0, 63) if dark else (7, 56)
+            corner = min(abs(file - board.get_file(sq)) + abs(rank - board.get_rank(sq)) for sq in corners)
+            progress += 40 * (14 - corner) + 10 * (7 - self.king_distance(winner, loser))
+            progress += 4 * sum(7 - self.king_distance(sq, loser) for sq in knights)
+        return progress
+
+    def king_distance(self, sq1, sq2):
+        """
+        Returns the number of king moves between two squares.
+        """
+        board = self.board
+        return max(abs(board.get_file(sq1) - board.get_file(sq2)), abs(board.get_rank(sq1) - board.get_rank(sq2)))
+
+    def quiesce(self, alpha, beta, ply):
+        self.check_stop()
+        if self.board.is_insufficient_material():
+            return self.DRAW_VALUE
+
+        king = self.board.wk if self.board.is_white_turn else self.board.bk
+        checkers = self.board.get_checkers(king)
+        if checkers:
+            # No standing pat while in check: every evasion is searched, and having none is mate
+            moves = self.board.get_evasion_moves(king, checkers)
+            if not moves:
+                return -self.CHECKMATE_VALUE + ply
+            moves = self.order_moves(moves)
+        else:
+            eval = self.evaluate(alpha, beta)
+            if eval >= beta:
+                return beta
+            if alpha < eval:
+                alpha = eval
+            if ply >= self.MAX_PLY:
+                return alpha
+
+            captures = []
+            for move in reversed(self.board.get_all_moves()):
+                if 1 << move.end_square == self.board.wk.get_board() or \
+                        1 << move.end_square == self.board.bk.get_board():
+                    continue
+                if move.is_capture:
+                    # Losing captures are pruned without ever being made
+                    see = self.board.see(move)
+                    if see >= 0:
+                        captures.append((see, move))
+            captures.sort(key=lambda capture: -capture[0])
+            moves = self.board.remove_check_moves([move for _, move in captures], king)
+
+        for move in moves:
+            self.board.make_move(move, True)
+            try:
+                score = -self.quiesce(-beta, -alpha, ply + 1)
+            finally:
                 self.board.undo_move(move)
-                if score >= beta:
-                    return beta
-                if score > alpha:
-                    alpha = score
+            if score >= beta:
+                return beta
+            if score > alpha:
+                alpha = score
         return alpha
 
+    def order_moves(self, moves, tt_move=TranspositionTable.NO_MOVE):
+        """
+        Orders moves for the main search.
+
+        The best move stored in the transposition table comes first. Captures are split by static exchange
+        evaluation into winning, equal and losing buckets. Winning captures are searched next (best exchange
+        first), then equal captures, then the remaining moves in their usual order, and losing captures last.
+
+        Parameters:
+        - moves: The legal moves of the current position.
+        - tt_move: The encoded best move from the transposition table, if any.
+
+        Returns:
+        A new list with the moves in search order.
+        """
+        def key(move):
+            if TranspositionTable.matches(move, tt_move):
+                return -1, 0
+            if move.is_capture or move.en_passant:
+                see = self.board.see(move)
+                if see > 0:
+                    return 0, -see
+                if see == 0:
+                    return 1, 0
+                return 3, -see
+            return 2, move.move_sort_key()
+
+        return sorted(reversed(moves), key=key)
+
     def select_move(self, depth):
+        self.depth = depth
+        ponder_result = self.stop_pondering()
+        if ponder_result:
+            return ponder_result
         try:
             fen = self.board.export_fen()
             if self.board.engine_side:
                 fen = self.board.flip_fen(fen)
             board_rep = chess.Board(fen)
             polyglot_move = chess.polyglot.MemoryMappedReader("Titans.bin").weighted_choice(board_rep).move
+            self.pv = []
             return self.polyglot_to_move(polyglot_move)
         except:
-            best_move = None
-            best_value = -99999
-            alpha = -100000
-            beta = 100000
-            moves = self.board.get_all_moves()
-            moves = self.board.remove_check_moves(moves, self.board.wk if self.board.is_white_turn else self.board.bk)
-            moves = sorted(reversed(moves), key=Move.move_sort_key)
+            return self.search(depth)
 
-            for move in moves:
-                if 1 << move.end_square == self.board.wk.get_board() or 1 << move.end_square == self.board.bk.get_board():
-                    continue
+    def search(self, depth):
+        """
+        Searches the current position with iterative deepening.
+
+        Each iteration fills the transposition table, so the next, deeper iteration starts with the previous
+        best moves ordered first. The principal variation of the last completed iteration is kept in pv.
+
+        Parameters:
+        - depth: The depth of the last iteration.
+
+        Returns:
+        The best move of the deepest completed iteration.
+        """
+        self.nodes = 0
+        self.lazy_exits = 0
+        self.full_evaluations = 0
+        self.best_move = None
+        self.best_score = -self.INFINITY
+        self.pv = []
+        self.root_material = self.get_material()
+        if self.helpers:
+            self.helpers.start(self.board, depth)
+        completed = 0
+        try:
+            for current_depth in range(1, depth + 1):
+                self.search_root(current_depth)
+                self.pv = self.get_pv(current_depth)
+                completed = current_depth
+                if self.on_iteration:
+                    self.on_iteration(current_depth)
+        finally:
+            if self.helpers:
+                self.adopt_helper_results(self.helpers.finish(), completed)
+        return self.best_move
+
+    def adopt_helper_results(self, results, completed):
+        """
+        Adds the helpers' node counts to this engine's, and takes a helper's move if it searched deeper.
+
+        Parameters:
+        - results: The reports returned by ParallelSearch.finish.
+        - completed: The depth of this engine's last completed iteration.
+        """
+        for _, depth, score, move, nodes in results:
+            self.nodes += nodes
+            if depth > completed:
+                moves = self.board.get_legal_moves()
+                match = next((legal for legal in moves if TranspositionTable.matches(legal, move)), None)
+                if match:
+                    completed = depth
+                    self.best_move = match
+                    self.best_score = score
+                    self.pv = self.get_pv(depth)
+
+    def search_root(self, depth):
+        """
+        Searches every root move to the given depth and records the best move and score.
+        """
+        if self.root_split and depth > 1:
+            self.root_split.search_root(self, depth)
+            return
+        alpha = -self.INFINITY
+        beta = self.INFINITY
+        best_move = None
+        key = self.board.get_key()
+        entry = self.tt.probe(key)
+        moves = self.order_moves(self.keep_bitbase_result(self.board.get_legal_moves()),
+                                 entry[3] if entry else TranspositionTable.NO_MOVE)
+        if self.root_rotation and len(moves) > 2:
+            # Parallel helpers keep the best move first and vary the order of the rest
+            rotation = self.root_rotation % (len(moves) - 1)
+            moves = moves[:1] + moves[1 + rotation:] + moves[1:1 + rotation]
+
+        for move in moves:
+            if 1 << move.end_square == self.board.wk.get_board() or 1 << move.end_square == self.board.bk.get_board():
+                continue
+            self.board.make_move(move, True)
+            try:
+                board_value = -self.alphabeta(-beta, -alpha, depth - 1, 1)
+            finally:
+                self.board.undo_move(move)
+            if board_value > alpha:
+                alpha = board_value
+                best_move = move
+
+        if best_move:
+            self.tt.store(key, depth, TranspositionTable.EXACT, self.score_to_tt(alpha, 0), best_move)
+            self.best_move = best_move
+            self.best_score = alpha
+
+    def get_pv(self, depth):
+        """
+        Follows the best moves stored in the transposition table from the current position.
+
+        Parameters:
+        - depth: The maximum number of moves to follow.
+
+        Returns:
+        The list of moves of the principal variation.
+        """
+        pv = []
+        try:
+            while len(pv) < depth:
+                entry = self.tt.probe(self.board.get_key())
+                if not entry:
+                    break
+                moves = self.board.get_legal_moves()
+                move = next((move for move in moves if TranspositionTable.matches(move, entry[3])), None)
+                if not move:
+                    break
                 self.board.make_move(move, True)
-                board_value = -self.alphabeta(-beta, -alpha, depth - 1)
-                if board_value > best_value:
-                    best_value = board_value
-                    best_move = move
-                if board_value > alpha:
-                    alpha = board_value
+                pv.append(move)
+        finally:
+            for move in reversed(pv):
                 self.board.undo_move(move)
+        return pv
+
+    def check_stop(self):
+        """
+        Counts a searched node and aborts the search if it has been asked to stop or has reached its node or
+        time limit. The clock and the shared node count are only read every 32 nodes, a few milliseconds of
+        search.
+        """
+        self.nodes += 1
+        if self.stop.is_set() or self.max_nodes and self.nodes >= self.max_nodes:
+            raise SearchAborted()
+        if not self.nodes & 31:
+            if self.deadline and time.monotonic() >= self.deadline:
+                raise SearchAborted()
+            if self.shared_nodes is not None:
+                with self.shared_nodes.get_lock():
+                    self.shared_nodes.value += 32
+                    nodes = self.shared_nodes.value
+                if self.max_nodes and nodes >= self.max_nodes:
+                    raise SearchAborted()
+
+    def start_pondering(self):
+        """
+        Starts searching the opponent's predicted reply in the background.
+
+        The reply is the second move of the principal variation. It is made on a copy of the board, and the
+        search runs in a thread with its own Engine that shares this engine's transposition table.
+        """
+        if len(self.pv) < 2:
+            return
+        self.ponder_move = self.pv[1]
+        board = self.board.clone()
+        board.make_move(self.ponder_move, True)
+        self.ponder_engine = Engine(board, self.tt, bitbases=self.bitbases)
+        self.ponder_thread = threading.Thread(target=self.ponder_engine.ponder, args=(self.depth,), daemon=True)
+        self.ponder_thread.start()
+
+    def ponder(self, depth):
+        """
+        Runs the search of a ponder engine until it completes or is stopped.
+        """
+        try:
+            self.search(depth)
+        except SearchAborted:
+            pass
+
+    def stop_pondering(self):
+        """
+        Ends pondering once the opponent has moved.
+
+        On a ponder hit the background search is allowed to finish, within this engine's deadline if it has
+        one, and its result is kept. On a miss it is aborted, and only the entries it stored in the shared
+        transposition table remain.
+
+        Returns:
+        The best move of the ponder search on a ponder hit, None otherwise.
+        """
+        if not self.ponder_thread:
+            return None
+        hit = self.board.last_move == self.ponder_move
+        if not hit:
+            self.ponder_engine.stop.set()
+        else:
+            self.ponder_engine.deadline = self.deadline
+        self.ponder_thread.join()
+        ponder_engine = self.ponder_engine
+        self.ponder_thread = None
+        self.ponder_engine = None
+        if not hit or not ponder_engine.best_move:
+            return None
+        self.nodes = ponder_engine.nodes
+        self.lazy_exits = ponder_engine.lazy_exits
+        self.full_evaluations = ponder_engine.full_evaluations
+        self.best_score = ponder_engine.best_score
+        self.pv = ponder_engine.pv
+        return ponder_engine.best_move
+
+    @classmethod
+    def score_to_tt(cls, score, ply):
+        """
+        Converts a search score into the form stored in a transposition table.
+
+        Mate scores are made relative to the node instead of the root, so the entry stays valid when the
+        position is reached again at another ply. The result fits in a signed 16-bit field.
+
+        Parameters:
+        - score: The score returned by the search at this node.
+        - ply: The distance of the node from the root.
+
+        Returns:
+        The score to store.
+        """
+        if score >= cls.MATE_BOUND:
+            return score + ply
+        if score <= -cls.MATE_BOUND:
+            return score - ply
+        return score
+
+    @classmethod
+    def score_from_tt(cls, score, ply):
+        """
+        Converts a score read from a transposition table back into a root-relative search score.
+
+        Parameters:
+        - score: The stored score, as produced by score_to_tt.
+        - ply: The distance of the probing node from the root.
 
-            return best_move
+        Returns:
+        The search score.
+        """
+        if score >= cls.MATE_BOUND:
+            return score - ply
+        if score <= -cls.MATE_BOUND:
+            return score + ply
+        return score
 
     def polyglot_to_move(self, polyglot) -> Move:
         piece = self.board.get_piece(polyglot.from_square)
@@ -0,0 +1,165 @@
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+from Engine import Engine
+
+
+class EngineProcess:
+    """
+    A UCI engine running as a child process, such as this engine's UCI.py from any revision of the code.
+
+    The engine's output is read on a thread of its own into a queue, so that waiting for a reply can time out
+    when an engine hangs or loses on time, and a dead engine is noticed instead of blocking the caller.
+
+    Attributes:
+    - command: The command line that starts the engine.
+    - process: The child process.
+    - lines: The queue of the engine's output lines. None is put when the output ends.
+    - name: The engine's name, from its id name reply.
+    """
+
+    # Seconds an engine gets to answer uci, isready and quit
+    STARTUP_TIME = 30.0
+
+    def __init__(self, command, options=None, cwd=None):
+        """
+        Starts the engine and initializes it.
+
+        Parameters:
+        - command: The command line that starts the engine.
+        - options: A dict of UCI options to set, like {"Hash": 16}.
+        - cwd: The working directory of the engine, the current one if None.
+        """
+        self.command = command
+        self.process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True, bufsize=1, cwd=cwd)
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read, daemon=True).start()
+        self.name = command
+        self.send("uci")
+        for line in self.expect("uciok", self.STARTUP_TIME):
+            if line.startswith("id name "):
+                self.name = line[len("id name "):].strip()
+        for name, value in (options or {}).items():
+            self.send("setoption name %s value %s" % (name, value))
+        self.ready()
+
+    def read(self):
+        """
+        Runs in the reading thread: queues the engine's output lines until it ends.
+        """
+        for line in self.process.stdout:
+            self.lines.put(line.rstrip("\n"))
+        self.lines.put(None)
+
+    def send(self, line):
+        """
+        Sends a command to the engine.
+
+        Raises:
+        EOFError: If the engine has exited.
+        """
+        try:
+            self.process.stdin.write(line + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError):
+            raise EOFError("engine exited: " + self.command)
+
+    def expect(self, token, timeout):
+        """
+        Reads the engine's output up to the line starting with the token.
+
+        Parameters:
+        - token: The first word of the awaited line.
+        - timeout: The time to wait in seconds.
+
+        Returns:
+        The lines read, the awaited one last.
+
+        Raises:
+        TimeoutError: If the line did not come in time.
+        EOFError: If the engine exited.
+        """
+        deadline = time.monotonic() + timeout
+        lines = []
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("no %s from %s" % (token, self.name))
+            if line is None:
+                raise EOFError("engine exited: " + self.command)
+            lines.append(line)
+            if line.split(maxsplit=1)[:1] == [token]:
+                return lines
+
+    def ready(self):
+        """
+        Waits until the engine has handled every command sent so far.
+        """
+        self.send("isready")
+        self.expect("readyok", self.STARTUP_TIME)
+
+    def new_game(self):
+        """
+        Tells the engine that the next search is from a new game.
+        """
+        self.send("ucinewgame")
+        self.ready()
+
+    def go(self, fen, moves, wtime, btime, winc, binc, timeout):
+        """
+        Searches a position under a clock.
+
+        Parameters:
+        - fen: The FEN of the game's start position.
+        - moves: The moves played since, in UCI notation.
+        - wtime, btime, winc, binc: The clocks and increments in seconds.
+        - timeout: The time to wait for bestmove in seconds.
+
+        Returns:
+        A tuple (move, score, depth, elapsed): the move in UCI notation, the last reported score in centipawns
+        from the engine's point of view, mates as Engine.CHECKMATE_VALUE less the distance, or None, the last
+        reported depth, and the seconds the search took.
+
+        Raises:
+        TimeoutError: If bestmove did not come in time.
+        EOFError: If the engine exited.
+        """
+        self.send("position fen %s%s" % (fen, " moves " + " ".join(moves) if moves else ""))
+        self.send("go wtime %d btime %d winc %d binc %d" % (max(1, wtime * 1000), max(1, btime * 1000),
+                                                              winc * 1000, binc * 1000))
+        start = time.monotonic()
+        lines = self.expect("bestmove", timeout)
+        elapsed = time.monotonic() - start
+        score = depth = None
+        for line in lines:
+            words = line.split()
+            if words[:1] != ["info"]:
+                continue
+            if "depth" in words:
+                depth = int(words[words.index("depth") + 1])
+            if "score" in words:
+                kind, value = words[words.index("score") + 1:words.index("score") + 3]
+                value = int(value)
+                if kind == "cp":
+                    score = value
+                elif kind == "mate":
+                    # The Engine's mate scores, so that they compare with centipawns
+                    score = Engine.CHECKMATE_VALUE - (2 * value - 1) if value > 0 else \
+                        -Engine.CHECKMATE_VALUE - 2 * value
+        return (lines[-1].split() + ["0000"])[1], score, depth, elapsed
+
+    def close(self):
+        """
+        Asks the engine to quit, and kills it if it does not.
+        """
+        try:
+            self.send("quit")
+            self.process.wait(self.STARTUP_TIME)
+        except (EOFError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
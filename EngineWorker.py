@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+
+from Engine import SearchAborted
+from Pieces import Pieces
+
+
+class EngineWorker:
+    """
+    Runs the engine's move searches on a background thread, so that the GUI keeps drawing and handling events
+    while the engine thinks.
+
+    The engine searches a copy of the game board, never the board the GUI draws. Instead of a fixed depth it
+    deepens until its thinking time runs out. It starts no new iteration after half of that time, since the
+    next one would rarely finish. Progress and the result are posted to a queue that the GUI polls every
+    frame:
+    - ("info", depth, score, pv) after every completed iteration, the score from the engine's point of view.
+    - ("move", move) when the search ends. The move is None if there is no legal move.
+
+    Attributes:
+    - engine: The engine, which keeps its transposition table, helpers and pondering between moves.
+    - think_time: The thinking time per move in seconds.
+    - messages: The queue of progress and results.
+    - thread: The thread of the current search, or None.
+    - busy: Whether a search was started and its move has not been polled yet.
+    """
+
+    MAX_DEPTH = 64
+    THINK_TIME = 10.0
+
+    def __init__(self, engine, think_time=THINK_TIME):
+        """
+        Parameters:
+        - engine: The engine to run.
+        - think_time: The thinking time per move in seconds.
+        """
+        self.engine = engine
+        self.think_time = think_time
+        self.messages = queue.Queue()
+        self.thread = None
+        self.busy = False
+
+    def start(self, board):
+        """
+        Starts searching for the engine's move in the board's position.
+        """
+        self.engine.board = board.clone()
+        self.engine.stop.clear()
+        self.busy = True
+        self.thread = threading.Thread(target=self.search, daemon=True)
+        self.thread.start()
+
+    def search(self):
+        """
+        Runs in the worker thread: selects the move, from the book, a ponder hit or a search, and posts it.
+        """
+        engine = self.engine
+        start = time.monotonic()
+        engine.deadline = start + self.think_time
+        engine.on_iteration = lambda depth: self.report(depth, start)
+        try:
+            move = engine.select_move(self.MAX_DEPTH)
+        except SearchAborted:
+            move = engine.best_move
+        if move and move.is_promotion:
+            # The GUI board would ask the player which piece the engine promotes to
+            move.promotion = move.promotion or Pieces.QUEEN
+        self.messages.put(("move", move))
+
+    def report(self, depth, start):
+        engine = self.engine
+        self.messages.put(("info", depth, engine.best_score, list(engine.pv)))
+        if time.monotonic() - start >= self.think_time / 2:
+            engine.stop.set()
+
+    def stop(self):
+        """
+        Makes the engine move now, with the best move of its last completed iteration.
+        """
+        self.engine.stop.set()
+        ponder_engine = self.engine.ponder_engine
+        if ponder_engine:
+            ponder_engine.stop.set()
+
+    def poll(self):
+        """
+        Takes the messages posted since the last poll without waiting.
+
+        Returns:
+        The list of messages, oldest first.
+        """
+        messages = []
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                return messages
+            if message[0] == "move":
+                self.busy = False
+            messages.append(message)
+
+    def ponder(self, board):
+        """
+        Starts pondering on the player's time, after the engine's move has been made on the board.
+        """
+        self.engine.board = board.clone()
+        self.engine.start_pondering()
+
+    def close(self):
+        """
+        Stops the search and pondering and waits for them to end.
+        """
+        self.stop()
+        if self.thread:
+            self.thread.join()
+        self.engine.stop_pondering()
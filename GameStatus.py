@@ -0,0 +1,13 @@
+from enum import Enum
+
+
+class GameStatus(Enum):
+    """
+    Enumeration representing the state of a game after a move.
+    """
+    ONGOING = 0
+    CHECKMATE = 1
+    STALEMATE = 2
+    THREE_MOVE_REPETITION = 3
+    FIFTY_MOVE_RULE = 4
+    INSUFFICIENT_MATERIAL = 5
@@ -11,11 +11,18 @@ class Hashing:
     Attributes:
     - zobrist_table: A 2D table of random bitstrings for each piece at each square.
     - black_move_bitstring: A random bitstring representing the color to move.
+    - castle_bitstrings: Random bitstrings for each of the four castling rights.
+    - en_passant_bitstrings: Random bitstrings for each file on which en passant is possible.
     - is_black_turn: A flag indicating whether it is currently black's turn.
     - hash_value: The hash value based on the current game state.
     - game_states: A dictionary storing unique hash values for encountered game states.
+
+    The bitstrings come from a fixed seed, so every process computes the same keys for the same position
+    and processes can share one transposition table.
     """
 
+    ZOBRIST_SEED = 0x5EED
+
     def __init__(self, pieces):
         """
         Initialize the Zobrist hashing for chess game states.
@@ -23,22 +30,27 @@ class Hashing:
         Parameters:
         - pieces: The initial configuration of chess pieces.
         """
-        self.zobrist_table, self.black_move_bitstring = self.initialize_zobrist()
+        self.zobrist_table, self.black_move_bitstring, self.castle_bitstrings, self.en_passant_bitstrings = \
+            self.initialize_zobrist()
         self.is_black_turn = False
         self.hash_value = self.initialize_hash(pieces)
         self.game_states = {self.hash_value: 1}
 
-    @staticmethod
-    def initialize_zobrist():
+    @classmethod
+    def initialize_zobrist(cls):
         """
-        Initialize the Zobrist table and the bitstring for black to move.
+        Initialize the Zobrist table, the bitstring for black to move, the castling and the en passant bitstrings.
 
         Returns:
-        A tuple containing the Zobrist table and the bitstring for black to move.
+        A tuple containing the Zobrist table, the bitstring for black to move, the castling bitstrings and the
+        en passant bitstrings.
         """
-        table = [[random.getrandbits(64) for _ in range(12)] for _ in range(64)]
-        black_to_move_bitstring = random.getrandbits(64)
-        return table, black_to_move_bitstring
+        rng = random.Random(cls.ZOBRIST_SEED)
+        table = [[rng.getrandbits(64) for _ in range(12)] for _ in range(64)]
+        black_to_move_bitstring = rng.getrandbits(64)
+        castle_bitstrings = [rng.getrandbits(64) for _ in range(4)]
+        en_passant_bitstrings = [rng.getrandbits(64) for _ in range(8)]
+        return table, black_to_move_bitstring, castle_bitstrings, en_passant_bitstrings
 
     def initialize_hash(self, bitboards):
         """
@@ -102,14 +114,87 @@ class Hashing:
         else:
             self.game_states[self.hash_value] = 1
 
+    def position_key(self, bitboards, is_white_turn, white_can_castle, black_can_castle, en_passant_file=None):
+        """
+        Compute the Zobrist key of a position for the search's transposition table.
+
+        Unlike the game-state hash, the key tells the colors apart and includes the castling rights and the en
+        passant file.
+
+        Parameters:
+        - bitboards: The twelve BitBoard instances, in the board's fixed order.
+        - is_white_turn: True if white is to move.
+        - white_can_castle: Tuple (short_castle, long_castle) for white.
+        - black_can_castle: Tuple (short_castle, long_castle) for black.
+        - en_passant_file: The file on which en passant is possible, or None.
+
+        Returns:
+        The 64-bit key of the position.
+        """
+        key = 0
+        for piece in range(12):
+            n = bitboards[piece].get_board()
+            while n:
+                square = (n & -n).bit_length() - 1
+                key ^= self.zobrist_table[square][piece]
+                n &= n - 1
+
+        if not is_white_turn:
+            key ^= self.black_move_bitstring
+
+        for can_castle, bitstring in zip(tuple(white_can_castle) + tuple(black_can_castle), self.castle_bitstrings):
+            if can_castle:
+                key ^= bitstring
+
+        if en_passant_file is not None:
+            key ^= self.en_passant_bitstrings[en_passant_file]
+
+        return key
+
+    def update_key(self, key, changes, castling_before, castling_after, en_passant_before, en_passant_after):
+        """
+        Compute the key of the position after a move from the key before it, like position_key.
+
+        Parameters:
+        - key: The key before the move.
+        - changes: The pieces the move added and removed, as (bitboard index, square, added) tuples.
+        - castling_before: The castling rights before the move, a tuple (white_can_castle, black_can_castle).
+        - castling_after: The castling rights after the move, laid out like castling_before.
+        - en_passant_before: The en passant file before the move, or None.
+        - en_passant_after: The en passant file after the move, or None.
+
+        Returns:
+        The key after the move.
+        """
+        for piece, square, _ in changes:
+            key ^= self.zobrist_table[square][piece]
+
+        key ^= self.black_move_bitstring
+
+        if castling_before != castling_after:
+            rights = zip(castling_before[0] + castling_before[1], castling_after[0] + castling_after[1],
+                         self.castle_bitstrings)
+            for before, after, bitstring in rights:
+                if before != after:
+                    key ^= bitstring
+
+        if en_passant_before is not None:
+            key ^= self.en_passant_bitstrings[en_passant_before]
+        if en_passant_after is not None:
+            key ^= self.en_passant_bitstrings[en_passant_after]
+
+        return key
+
     def three_move_repetition(self):
         """
-        Check if any board state has occurred three or more times during the game.
+        Check if the current board state has occurred three or more times during the game.
+
+        Only the current state's count changes with a move, so no other state needs to be looked at.
 
         Returns:
-        True if s board state has occurred three or more times, False otherwise.
+        True if the current board state has occurred three or more times, False otherwise.
         """
-        return any(value >= 3 for value in self.game_states.values())
+        return self.game_states.get(self.hash_value, 0) >= 3
 
     @staticmethod
     def piece_to_index(piece):
@@ -0,0 +1,394 @@
+import argparse
+import datetime
+import os
+import random
+import sys
+import threading
+
+import chess
+import chess.polyglot
+
+from BatchAnalysis import BatchAnalysis
+from Board import Board
+from EngineProcess import EngineProcess
+from GameStatus import GameStatus
+from PGN import PGN
+from PGNAnnotator import PGNAnnotator
+from SPRT import SPRT
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class Match:
+    """
+    Plays games between two UCI engines, each game on a pair of engine processes of its own, and tests the result
+    with an SPRT.
+
+    The engines may be two configurations of this engine or two revisions of its code: each is just a command
+    line. Games are played in pairs from the same opening with the colours reversed. The openings come from an
+    EPD or FEN file or are sampled from a polyglot book by weighted random book moves. Several games run at once,
+    one per slot, and every slot keeps its two engine processes from one game to the next. Only one engine of a
+    game thinks at a time, so one slot per core keeps a machine busy.
+
+    Both engines play under time plus increment, with clocks kept by the harness. A game ends by the rules
+    (mate, stalemate, repetition, the fifty move rule, insufficient material), by time forfeit, an illegal move
+    or a crash, or is adjudicated from the engines' scores: as a win when both engines agree for resign_moves
+    moves each that one side is ahead by resign_score, or as a draw when both scores stay within draw_score for
+    draw_moves moves each from move draw_start on.
+
+    Every game is written as PGN as soon as it ends, and the state of the SPRT after it to the status stream.
+    The match stops when the SPRT accepts a hypothesis or all games have been played.
+
+    Attributes:
+    - commands: The command lines of the two engines.
+    - options: The UCI options of the two engines, as dicts.
+    - names: The names of the engines in the PGN, or None for their id names.
+    - base, increment: The time control in seconds.
+    - openings: An iterator of opening FENs, one per pair.
+    - games: The maximum number of games.
+    - sprt: The SPRT, counting the results of the first engine.
+    - output: The PGN stream.
+    - status: The stream the SPRT state is written to.
+    - lock: Guards the schedule, the SPRT and the streams, shared by the slots.
+    - stopped: Set when the match is over.
+    """
+
+    MAX_PLIES = 600
+    # Seconds of lag allowed beyond the clock before an engine loses on time
+    TIME_MARGIN = 0.1
+
+    def __init__(self, commands, options, names, base, increment, openings, games, sprt, output, status,
+                 resign_score=1000, resign_moves=3, draw_score=10, draw_moves=8, draw_start=40, cwd=None):
+        """
+        Parameters:
+        - commands: The command lines of the two engines.
+        - options: The UCI options of the two engines, as dicts.
+        - names: The names of the engines in the PGN, or None for their id names.
+        - base, increment: The time control in seconds.
+        - openings: An iterator of opening FENs, one per pair.
+        - games: The maximum number of games.
+        - sprt: The SPRT.
+        - output: The PGN stream.
+        - status: The stream the SPRT state is written to.
+        - resign_score, resign_moves: The win adjudication, in centipawns and moves per engine.
+        - draw_score, draw_moves, draw_start: The draw adjudication, in centipawns, moves per engine and the
+          first move number where it applies.
+        - cwd: The working directory of the engines.
+        """
+        self.commands = commands
+        self.options = options
+        self.names = names
+        self.base = base
+        self.increment = increment
+        self.openings = openings
+        self.games = games
+        self.sprt = sprt
+        self.output = output
+        self.status = status
+        self.resign_score = resign_score
+        self.resign_moves = resign_moves
+        self.draw_score = draw_score
+        self.draw_moves = draw_moves
+        self.draw_start = draw_start
+        self.cwd = cwd
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.scheduled = 0
+        self.opening = None
+        self.pending = {}
+
+    @staticmethod
+    def read_openings(lines, shuffle=None):
+        """
+        Reads an opening set from FEN or EPD lines, and cycles through it.
+
+        Parameters:
+        - lines: The lines of the file.
+        - shuffle: A random.Random to shuffle the openings with, or None to keep their order.
+
+        Returns:
+        An endless generator of FENs.
+        """
+        fens = [parsed[0] for parsed in map(BatchAnalysis.parse_line, lines) if parsed]
+        if not fens:
+            raise ValueError("no openings")
+        if shuffle:
+            shuffle.shuffle(fens)
+        while True:
+            yield from fens
+
+    @staticmethod
+    def sample_book(path, plies, rng):
+        """
+        Samples openings from a polyglot book by playing weighted random book moves from the start position.
+
+        Parameters:
+        - path: The book file, like Titans.bin.
+        - plies: The number of book moves to play, fewer where the book ends.
+        - rng: The random.Random to choose the moves with.
+
+        Returns:
+        An endless generator of FENs.
+        """
+        with chess.polyglot.open_reader(path) as reader:
+            while True:
+                board = chess.Board()
+                for _ in range(plies):
+                    try:
+                        board.push(reader.weighted_choice(board, random=rng).move)
+                    except IndexError:
+                        break
+                yield board.fen()
+
+    def next_game(self):
+        """
+        Takes the next game of the schedule, with the first engine playing white in the first game of a pair.
+
+        Returns:
+        A tuple (game number from 0, opening FEN), or None when the match is over.
+        """
+        with self.lock:
+            if self.stopped.is_set() or self.scheduled >= self.games:
+                return None
+            number = self.scheduled
+            self.scheduled += 1
+            if number % 2 == 0:
+                self.opening = next(self.openings)
+            return number, self.opening
+
+    def run(self, concurrency):
+        """
+        Plays the match on several slots at once and waits for it to end.
+
+        Returns:
+        The SPRT.
+        """
+        slots = [threading.Thread(target=self.play_slot, daemon=True) for _ in range(concurrency)]
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+        return self.sprt
+
+    def play_slot(self):
+        """
+        Runs in a slot's thread: plays games until the match is over.
+        """
+        engines = [None, None]
+        try:
+            while True:
+                game = self.next_game()
+                if not game:
+                    break
+                for index in (0, 1):
+                    if not engines[index]:
+                        engines[index] = EngineProcess(self.commands[index], self.options[index], self.cwd)
+                number, fen = game
+                # The first engine plays white in the first game of every pair
+                players = engines if number % 2 == 0 else engines[::-1]
+                result, termination, movetext, crashed = self.play(players, fen)
+                for index in crashed:
+                    engine = players[index]
+                    engines[engines.index(engine)] = None
+                    engine.close()
+                self.record(number, fen, players, result, termination, movetext)
+        except Exception:
+            # Without a slot the remaining games would never be played
+            self.stopped.set()
+            raise
+        finally:
+            for engine in engines:
+                if engine:
+                    engine.close()
+
+    def play(self, players, fen):
+        """
+        Plays a game.
+
+        Parameters:
+        - players: The white and the black engine.
+        - fen: The start position.
+
+        Returns:
+        A tuple (result, termination, movetext, crashed): the PGN result, a description of how the game ended,
+        the movetext tokens, and the indexes of the players whose process has to be restarted.
+        """
+        for engine in players:
+            engine.new_game()
+        board = Board.from_fen(fen)
+        fields = fen.split()
+        number = int(fields[5]) if len(fields) > 5 and fields[5].isdigit() else 1
+        clocks = [self.base, self.base]
+        moves = []
+        movetext = []
+        repetitions = {board.get_key(): 1}
+        resign_streak = draw_streak = 0
+        while True:
+            status = board.get_game_status()
+            white = board.is_white_turn
+            if status == GameStatus.CHECKMATE:
+                return ("0-1" if white else "1-0"), "%s mates" % ("Black" if white else "White"), movetext, []
+            if status != GameStatus.ONGOING:
+                return "1/2-1/2", status.name.lower().replace("_", " "), movetext, []
+            if repetitions[board.get_key()] >= 3:
+                return "1/2-1/2", "three move repetition", movetext, []
+            if len(moves) >= self.MAX_PLIES:
+                return "1/2-1/2", "adjudication, game too long", movetext, []
+
+            side = 0 if white else 1
+            loss = ("0-1" if white else "1-0"), ("White" if white else "Black")
+            engine = players[side]
+            try:
+                text, score, depth, elapsed = engine.go(fen, moves, clocks[0], clocks[1], self.increment,
+                                                        self.increment, clocks[side] + self.TIME_MARGIN + 1)
+            except TimeoutError:
+                return loss[0], "%s loses on time" % loss[1], movetext, self.drain(engine, side)
+            except EOFError:
+                return loss[0], "%s's engine crashed" % loss[1], movetext, [side]
+            clocks[side] -= elapsed
+            if clocks[side] < -self.TIME_MARGIN:
+                return loss[0], "%s loses on time" % loss[1], movetext, []
+            clocks[side] = max(clocks[side], 0) + self.increment
+            legal = board.get_legal_moves()
+            move = UCI.parse_move(board, text)
+            if not move:
+                return loss[0], "%s plays an illegal move %s" % (loss[1], text), movetext, []
+
+            if white or not movetext:
+                movetext.append("%d.%s" % (number, "" if white else ".."))
+            movetext.append(PGN.to_san(board, move, legal))
+            comment = "%.2fs" % elapsed
+            if score is not None:
+                comment = "%s/%d %s" % (PGNAnnotator.format_score(score, True), depth or 0, comment)
+            movetext.append("{%s}" % comment)
+            board.make_move(move, True)
+            moves.append(text)
+            key = board.get_key()
+            repetitions[key] = repetitions.get(key, 0) + 1
+            if not white:
+                number += 1
+
+            # Adjudication, from the scores of consecutive moves of both engines
+            if score is None:
+                resign_streak = draw_streak = 0
+                continue
+            score = score if white else -score
+            sign = (score >= self.resign_score) - (score <= -self.resign_score)
+            resign_streak = resign_streak + sign if sign and resign_streak * sign >= 0 else sign
+            if abs(resign_streak) >= 2 * self.resign_moves:
+                return ("1-0" if sign > 0 else "0-1"), "adjudication, %s wins" % (
+                    "White" if sign > 0 else "Black"), movetext, []
+            draw_streak = draw_streak + 1 if abs(score) <= self.draw_score and number >= self.draw_start else 0
+            if draw_streak >= 2 * self.draw_moves:
+                return "1/2-1/2", "adjudication, draw", movetext, []
+
+    @staticmethod
+    def drain(engine, side):
+        """
+        Stops an engine that ran out of time and reads its late bestmove, so that it cannot be taken for the
+        reply of the next game.
+
+        Returns:
+        [side] if the engine does not answer and has to be restarted, otherwise [].
+        """
+        try:
+            engine.send("stop")
+            engine.expect("bestmove", EngineProcess.STARTUP_TIME)
+            return []
+        except (TimeoutError, EOFError):
+            return [side]
+
+    def record(self, number, fen, players, result, termination, movetext):
+        """
+        Writes a finished game and counts it in the SPRT.
+        """
+        pair, game = divmod(number, 2)
+        names = [self.names[index] if self.names and self.names[index] else players[0 if index == game else 1].name
+                 for index in (0, 1)]
+        white, black = (names[0], names[1]) if game == 0 else (names[1], names[0])
+        tags = [("Event", "Match"), ("Site", "?"), ("Date", datetime.date.today().strftime("%Y.%m.%d")),
+                ("Round", "%d.%d" % (pair + 1, game + 1)), ("White", white), ("Black", black), ("Result", result)]
+        if fen != PGN.START_FEN:
+            tags += [("SetUp", "1"), ("FEN", fen)]
+        tags += [("TimeControl", "%g+%g" % (self.base, self.increment)), ("Termination", termination)]
+        # The first engine's score: it plays white in the first game of a pair
+        score = {"1-0": 1, "0-1": 0, "1/2-1/2": 0.5}[result]
+        score = score if game == 0 else 1 - score
+        with self.lock:
+            self.output.write(PGN.write(tags, movetext + ["{%s}" % termination, result]))
+            self.output.flush()
+            self.sprt.add_game(score)
+            if pair in self.pending:
+                self.sprt.add_pair(self.pending.pop(pair), score)
+            else:
+                self.pending[pair] = score
+            self.status.write(self.sprt.status() + "\n")
+            self.status.flush()
+            if self.sprt.decision():
+                self.stopped.set()
+
+    @staticmethod
+    def parse_options(options):
+        """
+        Reads NAME=VALUE option arguments into a dict.
+        """
+        return dict(option.split("=", 1) for option in options or [])
+
+    @staticmethod
+    def parse_time_control(text):
+        """
+        Reads a time control like 10+0.1, in seconds.
+
+        Returns:
+        A tuple (base, increment).
+        """
+        base, _, increment = text.partition("+")
+        return float(base), float(increment or 0)
+
+
+if __name__ == "__main__":
+    engine = "%s %s" % (sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "UCI.py"))
+    parser = argparse.ArgumentParser(description="Play an engine match with an SPRT.")
+    parser.add_argument("--engine1", default=engine, help="command of the first engine, the one tested")
+    parser.add_argument("--engine2", default=engine, help="command of the second engine, the baseline")
+    parser.add_argument("--option1", action="append", help="UCI option NAME=VALUE of the first engine")
+    parser.add_argument("--option2", action="append", help="UCI option NAME=VALUE of the second engine")
+    parser.add_argument("--name1", help="name of the first engine in the PGN")
+    parser.add_argument("--name2", help="name of the second engine in the PGN")
+    parser.add_argument("--tc", default="10+0.1", help="time control: seconds+increment")
+    parser.add_argument("--games", type=int, default=20000, help="maximum number of games")
+    parser.add_argument("--concurrency", type=int, default=os.cpu_count() or 1, help="games played at once")
+    parser.add_argument("--openings", help="FEN or EPD file of openings, instead of sampling the book")
+    parser.add_argument("--book", help="polyglot book to sample openings from, Titans.bin if not given")
+    parser.add_argument("--book-plies", type=int, default=8, help="book moves per sampled opening")
+    parser.add_argument("--seed", type=int, help="seed of the opening choice")
+    parser.add_argument("--elo0", type=float, default=0.0)
+    parser.add_argument("--elo1", type=float, default=5.0)
+    parser.add_argument("--alpha", type=float, default=0.05)
+    parser.add_argument("--beta", type=float, default=0.05)
+    parser.add_argument("--resign-score", type=int, default=1000, help="win adjudication score in centipawns")
+    parser.add_argument("--resign-moves", type=int, default=3, help="moves of each engine beyond the score")
+    parser.add_argument("--draw-score", type=int, default=10, help="draw adjudication score in centipawns")
+    parser.add_argument("--draw-moves", type=int, default=8, help="moves of each engine within the score")
+    parser.add_argument("--draw-start", type=int, default=40, help="first move number of draw adjudication")
+    parser.add_argument("--pgn", help="file to write the games to, stdout if not given")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    rng = random.Random(args.seed)
+    if args.openings:
+        with open(args.openings) as file:
+            openings = Match.read_openings(list(file), rng)
+    else:
+        book = os.path.abspath(args.book) if args.book else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                         "Titans.bin")
+        openings = Match.sample_book(book, args.book_plies, rng)
+    output = open(args.pgn, "a") if args.pgn else sys.stdout
+    WorkerPool.use_engine_directory()
+    base, increment = Match.parse_time_control(args.tc)
+    match = Match([args.engine1, args.engine2], [Match.parse_options(args.option1), Match.parse_options(args.option2)],
+                  [args.name1, args.name2], base, increment, openings, args.games,
+                  SPRT(args.elo0, args.elo1, args.alpha, args.beta), output, sys.stderr, args.resign_score,
+                  args.resign_moves, args.draw_score, args.draw_moves, args.draw_start, cwd)
+    with output:
+        match.run(args.concurrency)
@@ -0,0 +1,194 @@
+import argparse
+
+from Board import Board
+from Engine import SearchAborted
+
+
+class MateSolver:
+    """
+    Finds forced mates with depth-first proof-number search (df-pn), for puzzles and mate-in-N problems.
+
+    The side to move at the root is the attacker. A position is proven if the attacker can force mate within
+    the move limit and disproven if the defender can avoid it. Every node holds two numbers from the point of
+    view of its side to move: phi, the number of leaves that must still be resolved to show that the side to
+    move succeeds, and delta, the same for showing that it fails. The search always expands the child that is
+    cheapest to resolve, and only returns to the parent once the child's numbers cross thresholds that say
+    another child has become more promising.
+
+    Positions are stored by their bitboards and remaining plies, so results from different move limits never mix. Mate
+    limits are tried from one move upwards, so the first proof is the shortest mate. Resolved positions also
+    store the number of plies to mate, which the line is read back from. The defender picks the longest
+    resistance and the attacker the fastest mate.
+
+    Engine moves promote to a queen, so mates that need an underpromotion are not found.
+
+    Attributes:
+    - board: A copy of the position being solved.
+    - max_nodes: The number of nodes to expand before giving up.
+    - max_entries: The number of positions to store before giving up. When the table is full, unresolved
+      positions are dropped first.
+    - table: The stored positions, (position, plies) -> (phi, delta, plies to mate or None).
+    - nodes: The number of nodes expanded so far.
+    - pv: The mating line once a mate is found.
+    """
+
+    INFINITY = 1 << 30
+
+    def __init__(self, board, max_nodes=1_000_000, max_entries=2_000_000):
+        """
+        Initializes the solver.
+
+        Parameters:
+        - board: The position to solve. It is copied, so the board itself is not changed.
+        - max_nodes: The node budget.
+        - max_entries: The memory budget, in stored positions.
+        """
+        self.board = board.clone()
+        self.max_nodes = max_nodes
+        self.max_entries = max_entries
+        self.table = {}
+        self.nodes = 0
+        self.pv = []
+
+    def solve(self, max_moves):
+        """
+        Searches for the shortest forced mate of at most max_moves moves by the side to move.
+
+        Returns:
+        True if a mate was found, with the line in pv; False if there is no mate within max_moves; None if a
+        budget ran out first.
+        """
+        self.pv = []
+        try:
+            for moves in range(1, max_moves + 1):
+                plies = 2 * moves - 1
+                self.mid(plies, self.INFINITY, self.INFINITY)
+                if self.lookup(self.position(), plies)[0] == 0:
+                    self.pv = self.principal_variation(plies)
+                    return True
+        except SearchAborted:
+            return None
+        return False
+
+    def position(self):
+        """
+        Identifies the current position exactly, which is faster than computing its hash key.
+        """
+        board = self.board
+        return tuple(piece.get_board() for piece in board.pieces), board.is_white_turn, \
+            board.white_can_castle, board.black_can_castle
+
+    def lookup(self, key, plies):
+        return self.table.get((key, plies), (1, 1, None))
+
+    def store(self, key, plies, phi, delta, distance):
+        if len(self.table) >= self.max_entries:
+            self.table = {entry: value for entry, value in self.table.items() if value[0] == 0 or value[1] == 0}
+            if len(self.table) >= self.max_entries:
+                raise SearchAborted()
+        self.table[(key, plies)] = (phi, delta, distance)
+
+    def mid(self, plies, th_phi, th_delta):
+        """
+        Expands the current position until its numbers reach the thresholds, then stores them.
+
+        Parameters:
+        - plies: The plies left, odd when the attacker is to move.
+        - th_phi: The threshold for phi.
+        - th_delta: The threshold for delta.
+        """
+        self.nodes += 1
+        if self.nodes > self.max_nodes:
+            raise SearchAborted()
+        key = self.position()
+        attacker = plies % 2 == 1
+        moves = self.board.get_legal_moves()
+
+        if not moves:
+            king = self.board.wk if self.board.is_white_turn else self.board.bk
+            if attacker or self.board.get_checkers(king):
+                # The attacker cannot mate without a move, the defender is mated
+                self.store(key, plies, self.INFINITY, 0, None if attacker else 0)
+            else:
+                self.store(key, plies, 0, self.INFINITY, None)
+            return
+        if plies == 0:
+            # The attacker's moves are used up and the defender is not mated
+            self.store(key, plies, 0, self.INFINITY, None)
+            return
+
+        children = []
+        for move in moves:
+            self.board.make_move(move, True)
+            children.append(self.position())
+            self.board.undo_move(move)
+
+        while True:
+            entries = [self.lookup(child, plies - 1) for child in children]
+            phi = min(entry[1] for entry in entries)
+            delta = min(self.INFINITY, sum(entry[0] for entry in entries))
+            if phi >= th_phi or delta >= th_delta:
+                break
+            best = min(range(len(entries)), key=lambda i: entries[i][1])
+            second = min((entries[i][1] for i in range(len(entries)) if i != best), default=self.INFINITY)
+            child_th_phi = min(self.INFINITY, th_delta - delta + entries[best][0])
+            child_th_delta = min(th_phi, second + 1)
+            self.board.make_move(moves[best], True)
+            self.mid(plies - 1, child_th_phi, child_th_delta)
+            self.board.undo_move(moves[best])
+
+        distance = None
+        if phi == 0 and attacker:
+            distance = 1 + min(entry[2] for entry in entries if entry[1] == 0)
+        elif delta == 0 and not attacker:
+            distance = 1 + max(entry[2] for entry in entries)
+        self.store(key, plies, phi, delta, distance)
+
+    def principal_variation(self, plies):
+        """
+        Reads the mating line back from the stored distances.
+
+        Returns:
+        The list of moves, attacker first, ending in mate.
+        """
+        line = []
+        while plies and self.board.get_legal_moves():
+            attacker = plies % 2 == 1
+            choices = []
+            for move in self.board.get_legal_moves():
+                self.board.make_move(move, True)
+                phi, delta, distance = self.lookup(self.position(), plies - 1)
+                self.board.undo_move(move)
+                if distance is not None and (delta == 0 if attacker else phi == 0):
+                    choices.append((distance if attacker else -distance, len(choices), move))
+            if not choices:
+                break
+            move = min(choices)[2]
+            self.board.make_move(move, True)
+            line.append(move)
+            plies -= 1
+        for move in reversed(line):
+            self.board.undo_move(move)
+        return line
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search a position for a forced mate.")
+    parser.add_argument("fen", help="the position, with the attacker to move")
+    parser.add_argument("moves", type=int, help="the most moves the mate may take")
+    parser.add_argument("--nodes", type=int, default=1_000_000, help="node budget")
+    parser.add_argument("--entries", type=int, default=2_000_000, help="memory budget in stored positions")
+    args = parser.parse_args()
+
+    board = Board.from_fen(args.fen)
+    solver = MateSolver(board, args.nodes, args.entries)
+    result = solver.solve(args.moves)
+    if result:
+        print("mate in %d: %s" % ((len(solver.pv) + 1) // 2, " ".join(
+            board.square_name(move.start_square) + board.square_name(move.end_square) +
+            ("q" if move.is_promotion else "") for move in solver.pv)))
+    elif result is False:
+        print("no mate in %d" % args.moves)
+    else:
+        print("unknown, budget exhausted")
+    print("nodes", solver.nodes)
@@ -3,7 +3,8 @@ from Pieces import Pieces
 
 class Move:
     def __init__(self, start_square: int, end_square: int, piece_type: Pieces, is_capture: bool = False,
-                 en_passant: bool = False, is_castle: bool = False, is_promotion: bool = False):
+                 en_passant: bool = False, is_castle: bool = False, is_promotion: bool = False,
+                 promotion: Pieces = None):
         self.start_square = start_square
         self.end_square = end_square
         self.piece_type = piece_type
@@ -11,6 +12,7 @@ class Move:
         self.en_passant = en_passant
         self.is_castle = is_castle
         self.is_promotion = is_promotion
+        self.promotion = promotion  # The piece a promotion chooses, a queen if None
         self.captured = None
 
     def __eq__(self, other):
@@ -0,0 +1,192 @@
+import copy
+import os
+
+import numpy as np
+
+from Pieces import Pieces
+
+
+class NNUE:
+    """
+    Efficiently updatable neural network evaluation, an optional alternative to the engine's piece-square
+    evaluation.
+
+    The input features are king-relative: for each perspective, one feature per (own king square, piece,
+    square) for every piece other than the kings, 64 * 10 * 64 in all. The black perspective sees the board
+    mirrored vertically with the colours swapped, so both perspectives share one feature transformer.
+
+    The first layer's output for each perspective, the accumulator, is kept up to date by the board: make_move
+    calls push with the pieces the move added and removed, and only the features of the pieces that moved or
+    were captured are added to or removed from a copy of the previous accumulator. A king move changes every
+    feature of its own perspective, so that perspective is recomputed. undo_move calls pop.
+
+    The rest of the network is evaluated with integer arithmetic: the two accumulators, side to move first,
+    are clipped to [0, CLIP] and fed through a hidden layer (shifted right by HIDDEN_SHIFT and clipped again)
+    to a single output, divided by OUTPUT_DIVISOR to give centipawns.
+
+    Attributes:
+    - ft_weights: The (FEATURES, H) int16 feature transformer weights.
+    - ft_bias: The (H,) int16 feature transformer bias.
+    - l1_weights: The (2H, L) hidden layer weights.
+    - l1_bias: The (L,) hidden layer bias.
+    - out_weights: The (L,) output weights.
+    - out_bias: The output bias.
+    - stack: The accumulators of the positions on the current line, each a (2, H) int16 array holding the
+      white and black perspectives.
+    """
+
+    WEIGHTS_FILE = "nnue.npz"
+    TYPE_INDEX = {Pieces.PAWN: 0, Pieces.KNIGHT: 1, Pieces.BISHOP: 2, Pieces.ROOK: 3, Pieces.QUEEN: 4}
+    FEATURES = 64 * 10 * 64
+    CLIP = 127
+    HIDDEN_SHIFT = 6
+    OUTPUT_DIVISOR = 16
+
+    def __init__(self, ft_weights, ft_bias, l1_weights, l1_bias, out_weights, out_bias):
+        """
+        Initializes the network from its weights.
+        """
+        self.ft_weights = np.asarray(ft_weights, dtype=np.int16)
+        self.ft_bias = np.asarray(ft_bias, dtype=np.int16)
+        self.l1_weights = np.asarray(l1_weights, dtype=np.int32)
+        self.l1_bias = np.asarray(l1_bias, dtype=np.int32)
+        self.out_weights = np.asarray(out_weights, dtype=np.int32)
+        self.out_bias = int(out_bias)
+        self.stack = []
+        self.offsets = None
+        self.king_indices = None
+
+    @classmethod
+    def load(cls, path=WEIGHTS_FILE):
+        """
+        Loads a network saved by save.
+
+        Parameters:
+        - path: The .npz file holding the weights.
+
+        Returns:
+        The network, or None if the file does not exist.
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as weights:
+            return cls(weights["ft_weights"], weights["ft_bias"], weights["l1_weights"], weights["l1_bias"],
+                       weights["out_weights"], weights["out_bias"])
+
+    def save(self, path=WEIGHTS_FILE):
+        """
+        Saves the weights in the format read by load.
+        """
+        np.savez(path, ft_weights=self.ft_weights, ft_bias=self.ft_bias, l1_weights=self.l1_weights,
+                 l1_bias=self.l1_bias, out_weights=self.out_weights, out_bias=self.out_bias)
+
+    def copy(self):
+        """
+        Copies the accumulator stack for use on a cloned board. The weights are shared.
+        """
+        network = copy.copy(self)
+        network.stack = list(self.stack)
+        return network
+
+    def king_squares(self, board):
+        """
+        Finds the king square of each perspective, as seen from that perspective.
+        """
+        white_king = board.lsb(board.pieces[self.king_indices[0]].get_board())
+        black_king = board.lsb(board.pieces[self.king_indices[1]].get_board())
+        return white_king, black_king ^ 56
+
+    def feature(self, perspective, king_square, index, sq):
+        """
+        Computes the feature index of a piece.
+
+        Parameters:
+        - perspective: 0 for white, 1 for black.
+        - king_square: The perspective's king square, from king_squares.
+        - index: The index of the piece's bitboard in Board.pieces.
+        - sq: The square of the piece.
+        """
+        return king_square * 640 + self.offsets[perspective][index] + (sq ^ 56 if perspective else sq)
+
+    def accumulate(self, board, perspective, king_square):
+        """
+        Computes one perspective's accumulator from scratch.
+        """
+        features = []
+        for index, bitboard in enumerate(board.pieces):
+            if self.offsets[perspective][index] is None:
+                continue
+            pieces = bitboard.get_board()
+            while pieces:
+                features.append(self.feature(perspective, king_square, index, board.lsb(pieces)))
+                pieces &= pieces - 1
+        return self.ft_bias + self.ft_weights[features].sum(axis=0, dtype=np.int16)
+
+    def refresh(self, board):
+        """
+        Recomputes the accumulators of the board's current position and starts a new stack with them.
+        """
+        self.offsets = [[], []]
+        self.king_indices = [None, None]
+        for index, bitboard in enumerate(board.pieces):
+            piece_type, is_white = bitboard.get_piece_type(), bitboard.is_white()
+            if piece_type == Pieces.KING:
+                self.king_indices[0 if is_white else 1] = index
+            for perspective in (0, 1):
+                own = is_white == (perspective == 0)
+                self.offsets[perspective].append(
+                    None if piece_type == Pieces.KING else (self.TYPE_INDEX[piece_type] * 2 + (0 if own else 1)) * 64)
+        kings = self.king_squares(board)
+        self.stack = [np.stack([self.accumulate(board, perspective, kings[perspective]) for perspective in (0, 1)])]
+
+    def push(self, board, changes):
+        """
+        Computes the accumulators after a move from those before it.
+
+        Parameters:
+        - board: The board, after the move was made.
+        - changes: The pieces the move added and removed, from Board.get_move_changes.
+        """
+        accumulator = self.stack[-1].copy()
+        kings = self.king_squares(board)
+        moved = {index for index, _, _ in changes}
+        updated = []
+        for perspective in (0, 1):
+            if self.king_indices[perspective] in moved:
+                accumulator[perspective] = self.accumulate(board, perspective, kings[perspective])
+            else:
+                updated.append(perspective)
+        if updated:
+            added, removed = ([], []), ([], [])
+            for index, sq, is_added in changes:
+                if self.offsets[0][index] is None:
+                    continue
+                for perspective in updated:
+                    features = added if is_added else removed
+                    features[perspective].append(self.feature(perspective, kings[perspective], index, sq))
+            for perspective in updated:
+                if added[perspective]:
+                    accumulator[perspective] += self.ft_weights[added[perspective]].sum(axis=0, dtype=np.int16)
+                if removed[perspective]:
+                    accumulator[perspective] -= self.ft_weights[removed[perspective]].sum(axis=0, dtype=np.int16)
+        self.stack.append(accumulator)
+
+    def pop(self):
+        """
+        Returns to the accumulators from before the last push.
+        """
+        self.stack.pop()
+
+    def evaluate(self, board):
+        """
+        Scores the board's current position from the side to move's point of view.
+
+        Returns:
+        The score in centipawns.
+        """
+        accumulator = self.stack[-1]
+        order = (0, 1) if board.is_white_turn else (1, 0)
+        hidden = np.clip(np.concatenate([accumulator[order[0]], accumulator[order[1]]]), 0, self.CLIP)
+        hidden = np.clip((hidden.astype(np.int32) @ self.l1_weights + self.l1_bias) >> self.HIDDEN_SHIFT, 0,
+                         self.CLIP)
+        return int(hidden @ self.out_weights + self.out_bias) // self.OUTPUT_DIVISOR
@@ -0,0 +1,204 @@
+import re
+
+from Board import Board
+from Pieces import Pieces
+
+
+class PGN:
+    """
+    Reads and writes games in Portable Game Notation.
+
+    games splits a stream of PGN text into games one at a time, without parsing them, so that large archives
+    are never held in memory and the parsing can be left to worker processes. parse reads one game's tags and
+    moves. Moves are replayed from Standard Algebraic Notation (SAN) with a lookup table of the position's
+    legal moves, keyed by piece and destination, instead of scanning the move list for every move.
+    """
+
+    START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+    LETTERS = {"N": Pieces.KNIGHT, "B": Pieces.BISHOP, "R": Pieces.ROOK, "Q": Pieces.QUEEN, "K": Pieces.KING}
+    PIECE_LETTERS = {piece_type: letter for letter, piece_type in LETTERS.items()}
+    # Some writers leave quotes inside tag values unescaped, so the value runs to the last quote
+    TAG = re.compile(r'^\[(\w+)\s+"(.*)"\]\s*$')
+    # Comments, variations and NAGs are skipped. Variations may nest, so they are removed innermost first.
+    COMMENT = re.compile(r"\{[^}]*\}|;[^\n]*")
+    VARIATION = re.compile(r"\([^()]*\)")
+    SAN = re.compile(r"^([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?[+#]?[!?]*$")
+    LINE_LENGTH = 80
+
+    @classmethod
+    def games(cls, lines):
+        """
+        Splits PGN text into games.
+
+        Parameters:
+        - lines: Any iterable of lines, such as an open file.
+
+        Returns:
+        A generator of the text of each game.
+        """
+        game = []
+        in_moves = False
+        for line in lines:
+            if line.startswith("[") and in_moves:
+                yield "".join(game)
+                game = []
+                in_moves = False
+            if line.strip() and not line.startswith("["):
+                in_moves = True
+            if game or line.strip():
+                game.append(line)
+        if any(line.strip() for line in game):
+            yield "".join(game)
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Reads a game's tags, moves and result.
+
+        Returns:
+        A tuple (tags, moves, result): the list of (name, value) tag pairs in order, the moves in SAN, and the
+        result, "*" if the game text has none.
+        """
+        tags = []
+        movetext = []
+        for line in text.splitlines():
+            match = cls.TAG.match(line.strip())
+            if match:
+                tags.append((match.group(1), match.group(2).replace('\\"', '"').replace("\\\\", "\\")))
+            elif not line.startswith("%"):
+                movetext.append(line)
+        movetext = cls.COMMENT.sub(" ", "\n".join(movetext))
+        while True:
+            stripped = cls.VARIATION.sub(" ", movetext)
+            if stripped == movetext:
+                break
+            movetext = stripped
+        moves = []
+        result = dict(tags).get("Result", "*")
+        for token in movetext.replace(".", ". ").split():
+            if token in cls.RESULTS:
+                result = token
+            elif not token.startswith("$") and not token.rstrip(".").isdigit() and token != ".":
+                moves.append(token)
+        return tags, moves, result
+
+    @classmethod
+    def start_board(cls, tags):
+        """
+        Creates the board a game starts from, the FEN tag's position if it has one.
+        """
+        return Board.from_fen(dict(tags).get("FEN", cls.START_FEN))
+
+    @staticmethod
+    def lookup(moves):
+        """
+        Indexes legal moves by (piece type, destination square). Castling moves are indexed by the squares the
+        king lands on, under the keys "O-O" and "O-O-O".
+        """
+        table = {}
+        for move in moves:
+            if move.is_castle:
+                table["O-O" if move.end_square > move.start_square else "O-O-O"] = [move]
+            else:
+                table.setdefault((move.piece_type, move.end_square), []).append(move)
+        return table
+
+    @classmethod
+    def parse_san(cls, board, san, table):
+        """
+        Finds the legal move a SAN string stands for.
+
+        Parameters:
+        - board: The position.
+        - san: The move, like Nbd7, exd6, e8=Q+ or O-O.
+        - table: The position's legal moves indexed by lookup.
+
+        Returns:
+        The Move, with its promotion piece set, or None if the move is not legal or not valid SAN.
+        """
+        san = san.rstrip("+#!?")
+        if san in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            candidates = table.get(san.replace("0", "O"), [])
+            return candidates[0] if candidates else None
+        match = cls.SAN.match(san)
+        if not match:
+            return None
+        letter, file, rank, square, promotion = match.groups()
+        piece_type = cls.LETTERS[letter] if letter else Pieces.PAWN
+        if piece_type == Pieces.PAWN and not file:
+            # A pawn move without a file is a push, never a capture
+            file = square[0]
+        end = board.SQUARE_NAMES.index(square)
+        candidates = [move for move in table.get((piece_type, end), [])
+                      if (not file or board.FILE_NAMES[board.get_file(move.start_square)] == file) and
+                      (not rank or board.RANK_NAMES[board.get_rank(move.start_square)] == rank)]
+        if len(candidates) != 1:
+            return None
+        move = candidates[0]
+        if move.is_promotion:
+            move.promotion = cls.LETTERS[promotion] if promotion else Pieces.QUEEN
+        return move
+
+    @classmethod
+    def to_san(cls, board, move, moves):
+        """
+        Writes a move in SAN.
+
+        Parameters:
+        - board: The position before the move.
+        - move: The move.
+        - moves: The position's legal moves, to disambiguate.
+        """
+        if move.is_castle:
+            san = "O-O" if move.end_square > move.start_square else "O-O-O"
+        else:
+            capture = "x" if move.is_capture or move.en_passant else ""
+            target = board.square_name(move.end_square)
+            if move.piece_type == Pieces.PAWN:
+                san = (board.FILE_NAMES[board.get_file(move.start_square)] + capture if capture else "") + target
+                if move.is_promotion:
+                    san += "=" + cls.PIECE_LETTERS[move.promotion or Pieces.QUEEN]
+            else:
+                others = [other.start_square for other in moves if other.piece_type == move.piece_type and
+                          other.end_square == move.end_square and other.start_square != move.start_square]
+                origin = ""
+                if others:
+                    file, rank = board.get_file(move.start_square), board.get_rank(move.start_square)
+                    if all(board.get_file(square) != file for square in others):
+                        origin = board.FILE_NAMES[file]
+                    elif all(board.get_rank(square) != rank for square in others):
+                        origin = board.RANK_NAMES[rank]
+                    else:
+                        origin = board.square_name(move.start_square)
+                san = cls.PIECE_LETTERS[move.piece_type] + origin + capture + target
+        board.make_move(move, True)
+        king = board.wk if board.is_white_turn else board.bk
+        if board.get_checkers(king):
+            san += "+" if board.get_legal_moves() else "#"
+        board.undo_move(move)
+        return san
+
+    @classmethod
+    def write(cls, tags, movetext):
+        """
+        Writes a game as PGN text.
+
+        Parameters:
+        - tags: The list of (name, value) tag pairs.
+        - movetext: The tokens of the movetext: move numbers, moves, NAGs, comments and the result.
+
+        Returns:
+        The game's text, ending in a blank line.
+        """
+        lines = ['[%s "%s"]' % (name, value.replace("\\", "\\\\").replace('"', '\\"')) for name, value in tags]
+        lines.append("")
+        line = ""
+        for token in movetext:
+            if line and len(line) + 1 + len(token) > cls.LINE_LENGTH:
+                lines.append(line)
+                line = token
+            else:
+                line = line + " " + token if line else token
+        lines.append(line)
+        return "\n".join(lines) + "\n\n"
@@ -0,0 +1,166 @@
+import argparse
+import sys
+import time
+
+from Engine import Engine, SearchAborted
+from PGN import PGN
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class PGNAnnotator:
+    """
+    Annotates the games of a PGN file with the engine, on a pool of worker processes.
+
+    Games are split off the input one at a time and sent to the workers as raw text, so the workers do the
+    parsing too. Every position of a game is searched within the limits. Each move gets a comment with the
+    evaluation after it, from white's point of view in pawns. A move that loses more than the blunder threshold
+    against the engine's best move is marked ?? and the best move is named. The loss is the best move's score
+    minus the played move's, which is read from the search of the next position, so every position is searched
+    once.
+
+    Games are written in input order. They are read only a few games per worker ahead of the output, by a
+    WorkerPool, so memory stays bounded however large the archive is.
+    """
+
+    DEFAULT_DEPTH = 2
+    BLUNDER = 200
+    # Scores are capped at this many centipawns when comparing moves, so that choosing a slower mate or a
+    # large material win over a mate does not count as a blunder
+    SCORE_CAP = 1000
+
+    @classmethod
+    def search(cls, engine):
+        """
+        Searches the engine's position within the worker's limits.
+
+        Returns:
+        A tuple (score, best move) from the side to move's point of view. The best move is None if the
+        position has no legal moves, and both are None if the limits ran out before the first iteration
+        completed.
+        """
+        board = engine.board
+        if not board.get_legal_moves():
+            king = board.wk if board.is_white_turn else board.bk
+            return (-Engine.CHECKMATE_VALUE if board.get_checkers(king) else Engine.DRAW_VALUE), None
+        worker = WorkerPool.worker
+        engine.stop.clear()
+        engine.max_nodes = worker["nodes"]
+        engine.deadline = time.monotonic() + worker["movetime"] / 1000 if worker["movetime"] else None
+        try:
+            engine.search(worker["depth"])
+        except SearchAborted:
+            pass
+        if not engine.best_move:
+            return None, None
+        return engine.best_score, engine.best_move
+
+    @classmethod
+    def annotate(cls, text):
+        """
+        Runs in a worker: replays a game and annotates its moves.
+
+        Parameters:
+        - text: The game's PGN text.
+
+        Returns:
+        The annotated game's PGN text.
+        """
+        tags, sans, result = PGN.parse(text)
+        tags = [(name, value) for name, value in tags if name != "Annotator"] + [("Annotator", "Chesster")]
+        try:
+            board = PGN.start_board(tags)
+        except (ValueError, IndexError):
+            return PGN.write(tags, ["{invalid FEN tag}", result])
+        engine = WorkerPool.engine(board)
+        blunder = WorkerPool.worker["blunder"]
+
+        movetext = []
+        fields = dict(tags).get("FEN", PGN.START_FEN).split()
+        number = int(fields[5]) if len(fields) > 5 and fields[5].isdigit() else 1
+        best_score, best_move = cls.search(engine)
+        for index, san in enumerate(sans):
+            moves = board.get_legal_moves()
+            move = PGN.parse_san(board, san, PGN.lookup(moves))
+            if not move:
+                movetext.append("{illegal move %s}" % san)
+                break
+            white = board.is_white_turn
+            if white or index == 0:
+                movetext.append("%d.%s" % (number, "" if white else ".."))
+            played = PGN.to_san(board, move, moves)
+            best = PGN.to_san(board, best_move, moves) if best_move else None
+            board.make_move(move, True)
+            score, next_best = cls.search(engine)
+            if score is None:
+                movetext.append(played)
+            else:
+                comment = cls.format_score(-score, white)
+                if best_move and best != played:
+                    capped = max(-cls.SCORE_CAP, min(cls.SCORE_CAP, -score))
+                    if max(-cls.SCORE_CAP, min(cls.SCORE_CAP, best_score)) - capped >= blunder:
+                        played += "??"
+                        comment += " Blunder, best was " + best
+                movetext += [played, "{%s}" % comment]
+            best_score, best_move = score, next_best
+            if not white:
+                number += 1
+        movetext.append(result)
+        return PGN.write(tags, movetext)
+
+    @staticmethod
+    def format_score(score, white):
+        """
+        Writes a score from the mover's point of view as white's evaluation, in pawns or as a mate count.
+        """
+        score = score if white else -score
+        if abs(score) > Engine.MATE_BOUND:
+            moves = (Engine.CHECKMATE_VALUE - abs(score) + 1) // 2
+            return "#%s%d" % ("" if score > 0 else "-", moves) if moves else "#"
+        return "%+.2f" % (score / 100)
+
+    @classmethod
+    def run(cls, lines, output, workers=None, depth=None, nodes=None, movetime=None, blunder=BLUNDER, hash_mb=16):
+        """
+        Annotates every game of the input and writes them in input order.
+
+        Parameters:
+        - lines: The PGN input, any iterable of lines.
+        - output: The stream to write the annotated games to.
+        - workers: The number of worker processes, all cores if None.
+        - depth: The depth limit per position. Without any limit, DEFAULT_DEPTH.
+        - nodes: The node limit per position, or None.
+        - movetime: The time limit per position in milliseconds, or None.
+        - blunder: The loss in centipawns from which a move is marked as a blunder.
+        - hash_mb: The transposition table size of each worker in megabytes.
+
+        Returns:
+        The number of games written.
+        """
+        if depth is None:
+            depth = UCI.MAX_DEPTH if nodes or movetime else cls.DEFAULT_DEPTH
+        count = 0
+        for game in WorkerPool.map(cls.annotate, PGN.games(lines), workers, hash_mb, {
+                "depth": depth, "nodes": nodes, "movetime": movetime, "blunder": blunder}, ordered=True):
+            output.write(game)
+            output.flush()
+            count += 1
+        return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotate PGN games with engine evaluations and blunders.")
+    parser.add_argument("input", nargs="?", default="-", help="PGN file, - for stdin")
+    parser.add_argument("--depth", type=int, help="depth limit per position")
+    parser.add_argument("--nodes", type=int, help="node limit per position")
+    parser.add_argument("--movetime", type=int, help="time limit per position in milliseconds")
+    parser.add_argument("--blunder", type=int, default=PGNAnnotator.BLUNDER, help="blunder threshold in centipawns")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size per worker in MB")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    source = sys.stdin if args.input == "-" else open(args.input)
+    WorkerPool.use_engine_directory()
+    with source:
+        PGNAnnotator.run(source, sys.stdout, args.workers, args.depth, args.nodes, args.movetime, args.blunder,
+                         args.hash)
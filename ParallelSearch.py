@@ -0,0 +1,122 @@
+import multiprocessing
+import queue
+import sys
+import threading
+
+from Bitbases import Bitbases
+from Board import Board
+from Engine import Engine, SearchAborted
+from TranspositionTable import TranspositionTable
+
+
+class ParallelSearch:
+    """
+    Lazy SMP: helper processes that search the same root as an engine and share its transposition table.
+
+    The helpers do not divide the work between them. Each runs its own iterative deepening on the root
+    position: every other helper goes one ply deeper than the engine, and each orders the root moves after
+    the first one differently. They drift apart and fill the shared table with results the others can reuse.
+    The engine's own search runs in the calling process as usual. When it finishes, the helpers are
+    stopped, and a helper's move replaces the engine's only if it completed a deeper iteration.
+
+    The engine's table must be a SharedTranspositionTable. On free-threaded CPython builds the helpers can be
+    threads instead of processes, sharing the same table.
+
+    Attributes:
+    - use_threads: Whether the helpers are threads rather than processes.
+    - workers: The helper processes or threads.
+    - tasks: One queue per helper, carrying the positions to search.
+    - results: The queue the helpers report to.
+    - stop: The event that stops the helpers' searches.
+    """
+
+    def __init__(self, engine, helpers, use_threads=None):
+        """
+        Starts the helpers. They wait for positions until close is called.
+
+        Parameters:
+        - engine: The engine to help. Its table, network and bitbases are used by the helpers too.
+        - helpers: The number of helpers.
+        - use_threads: Whether to use threads, by default only when the interpreter runs without the GIL.
+        """
+        if use_threads is None:
+            use_threads = not getattr(sys, "_is_gil_enabled", lambda: True)()
+        self.use_threads = use_threads
+        context = threading if use_threads else multiprocessing
+        self.stop = context.Event()
+        self.results = queue.Queue() if use_threads else multiprocessing.Queue()
+        self.tasks = []
+        self.workers = []
+        bitbases = engine.bitbases.directory if engine.bitbases else None
+        for index in range(helpers):
+            tasks = queue.Queue() if use_threads else multiprocessing.Queue()
+            worker = (threading.Thread if use_threads else multiprocessing.Process)(
+                target=self.helper, args=(index, engine.tt, engine.board.accumulator, bitbases, tasks, self.results,
+                                          self.stop, not use_threads), daemon=True)
+            worker.start()
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+
+    @staticmethod
+    def helper(index, tt, nnue, bitbases, tasks, results, stop, detach):
+        """
+        Runs in each helper: searches the positions it is sent until it receives None. Helper processes then
+        detach from the shared table, helper threads leave it to the engine.
+
+        Every search reports (index, depth completed, score, encoded best move, nodes) once it is stopped or
+        reaches its last depth.
+        """
+        while True:
+            job = tasks.get()
+            if job is None:
+                if detach:
+                    tt.close()
+                return
+            state, depth = job
+            engine = Engine(Board.from_state(state), tt, nnue.copy() if nnue else None,
+                            Bitbases(bitbases) if bitbases else None)
+            engine.stop = stop
+            engine.root_rotation = index + 1
+            engine.root_material = engine.get_material()
+            completed, score, move = 0, 0, TranspositionTable.NO_MOVE
+            try:
+                for current_depth in range(1, depth + 1 + (index % 2 == 0)):
+                    engine.search_root(current_depth)
+                    if engine.best_move:
+                        completed, score = current_depth, engine.best_score
+                        move = TranspositionTable.encode_move(engine.best_move)
+            except SearchAborted:
+                pass
+            results.put((index, completed, score, move, engine.nodes))
+
+    def start(self, board, depth):
+        """
+        Sends the helpers a position to search.
+
+        Parameters:
+        - board: The board holding the position.
+        - depth: The depth the engine itself searches to.
+        """
+        self.stop.clear()
+        state = board.get_state()
+        for tasks in self.tasks:
+            tasks.put((state, depth))
+
+    def finish(self):
+        """
+        Stops the helpers' searches.
+
+        Returns:
+        The list of the helpers' reports.
+        """
+        self.stop.set()
+        return [self.results.get() for _ in self.workers]
+
+    def close(self):
+        """
+        Shuts the helpers down.
+        """
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join()
@@ -0,0 +1,185 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from BatchAnalysis import BatchAnalysis
+from Board import Board
+from Pieces import Pieces
+from UCI import UCI
+from WorkerPool import WorkerPool
+
+
+class RemoteWorker:
+    """
+    Works on the units of a Coordinator's job, on this machine or another one, over a TCP connection.
+
+    The worker pulls one unit at a time, works on it and sends its result back. A thread sends a heartbeat
+    while it works, so that the coordinator can tell a long unit from a lost worker. A worker uses one core; run
+    one process per core to use a whole machine.
+
+    Attributes:
+    - connection: The socket to the coordinator.
+    - stream: The socket's file, read for the coordinator's messages.
+    - lock: Guards writes to the socket, shared with the heartbeat thread.
+    - options: The job's options from the coordinator.
+    - heartbeat: The heartbeat interval in seconds.
+    """
+
+    PROMOTIONS = (Pieces.QUEEN, Pieces.ROOK, Pieces.BISHOP, Pieces.KNIGHT)
+
+    def __init__(self, host, port):
+        """
+        Connects to the coordinator and receives the job's options.
+        """
+        self.connection = socket.create_connection((host, port))
+        # Every message is a short line answered by the other side, which Nagle's algorithm would hold back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = self.connection.makefile("rb")
+        self.lock = threading.Lock()
+        self.send({"type": "hello", "host": socket.gethostname(), "pid": os.getpid()})
+        welcome = self.receive()
+        self.options = welcome["options"]
+        self.heartbeat = welcome["heartbeat"]
+        if self.options["kind"] == "analyse":
+            WorkerPool.init_worker(self.options["hash_mb"], {name: self.options[name]
+                                                             for name in ("depth", "nodes", "movetime")})
+
+    def send(self, message):
+        with self.lock:
+            self.connection.sendall((json.dumps(message) + "\n").encode())
+
+    def receive(self):
+        """
+        Reads the coordinator's next message.
+
+        Raises:
+        ConnectionError: If the coordinator closed the connection.
+        """
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("the coordinator closed the connection")
+        return json.loads(line)
+
+    def run(self):
+        """
+        Works on units until the job is done.
+
+        Returns:
+        The number of units completed.
+        """
+        count = 0
+        while True:
+            self.send({"type": "request"})
+            message = self.receive()
+            if message["type"] == "done":
+                return count
+            if message["type"] == "wait":
+                time.sleep(message["seconds"])
+                continue
+            unit = message["unit"]
+            working = threading.Event()
+            beat = threading.Thread(target=self.beat, args=(working,), daemon=True)
+            beat.start()
+            try:
+                result = self.work(unit)
+            except Exception as error:
+                # Issued again, the unit would fail the same way on every worker
+                result = {"error": "%s: %s" % (type(error).__name__, error)}
+            finally:
+                working.set()
+                beat.join()
+            self.send({"type": "result", "id": unit["id"], "result": result})
+            count += 1
+
+    def beat(self, finished):
+        """
+        Runs in the heartbeat thread: sends a heartbeat every interval until the unit is finished.
+        """
+        while not finished.wait(self.heartbeat):
+            try:
+                self.send({"type": "heartbeat"})
+            except OSError:
+                return
+
+    def work(self, unit):
+        """
+        Works on a unit.
+
+        Returns:
+        The result: BatchAnalysis's result dict for an analyse unit, the leaf count for a perft unit. A unit that
+        fails has a dict with the error as its result.
+        """
+        if unit["kind"] == "analyse":
+            return BatchAnalysis.analyse((unit["line"], unit["text"]))
+        board = Board.from_fen(unit["fen"])
+        for text in unit["moves"]:
+            move = UCI.parse_move(board, text)
+            board.make_move(move, True)
+        return self.perft(board, unit["depth"])
+
+    @classmethod
+    def perft(cls, board, depth):
+        """
+        Counts the leaves of the legal move tree to a depth, every promotion piece counted as a move of its own.
+        """
+        if depth == 0:
+            return 1
+        moves = board.get_legal_moves()
+        if depth == 1:
+            return sum(len(cls.PROMOTIONS) if move.is_promotion else 1 for move in moves)
+        count = 0
+        for move in moves:
+            for promotion in cls.PROMOTIONS if move.is_promotion else (None,):
+                move.promotion = promotion
+                board.make_move(move, True)
+                count += cls.perft(board, depth - 1)
+                board.undo_move(move)
+        return count
+
+    @classmethod
+    def connect(cls, host, port, retries):
+        """
+        Runs a worker, retrying the connection while the coordinator is not up yet.
+
+        Returns:
+        The number of units completed.
+        """
+        for attempt in range(retries + 1):
+            try:
+                worker = cls(host, port)
+            except ConnectionRefusedError:
+                if attempt == retries:
+                    raise
+                time.sleep(1)
+                continue
+            try:
+                return worker.run()
+            except ConnectionError:
+                return 0
+            finally:
+                worker.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Work on a coordinator's analysis or perft job.")
+    parser.add_argument("address", help="the coordinator's host:port")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="worker processes to run")
+    parser.add_argument("--retries", type=int, default=30, help="seconds to wait for the coordinator")
+    args = parser.parse_args()
+
+    host, _, port = args.address.rpartition(":")
+    WorkerPool.use_engine_directory()
+    if args.processes == 1:
+        RemoteWorker.connect(host or "localhost", int(port), args.retries)
+    else:
+        processes = [multiprocessing.Process(target=RemoteWorker.connect, args=(host or "localhost", int(port),
+                                                                                 args.retries))
+                     for _ in range(args.processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
@@ -0,0 +1,213 @@
+import multiprocessing
+import os
+import time
+
+from Bitbases import Bitbases
+from Board import Board
+from Engine import Engine, SearchAborted
+from TranspositionTable import TranspositionTable
+
+
+class RootSplitSearch:
+    """
+    Splits the root moves of an engine's search across a pool of worker processes.
+
+    The first root move, the best one from the previous iteration, is searched serially by the engine to get
+    a good alpha bound. The other moves are then handed out to the workers one at a time, each with a pickled
+    copy of the position. The best score found so far is shared through a small shared value: a worker reads
+    it when it starts a move and raises it when it finds a better one.
+
+    A worker searches its move with a window that starts one below the shared bound. A move that ties the
+    best score therefore always gets an exact score, whatever order the workers finish in, so the best move
+    is always the earliest of the best-scoring moves, as in a serial search. The workers
+    search with the engine's transposition table, which must be a SharedTranspositionTable as for
+    ParallelSearch, so every move is ordered by what the engine and the other workers have already searched.
+
+    The workers keep to the engine's limits: each move gets the engine's deadline, the nodes of every worker
+    count against the engine's node budget through a shared counter, and a shared stop event aborts them all.
+    The event is set when the engine is stopped or runs out of time or nodes, or when a worker does, and the
+    iteration is then aborted with SearchAborted like a serial one.
+
+    Attributes:
+    - pool: The worker processes.
+    - alpha: The shared best score of the current iteration.
+    - stop: The shared event that aborts the workers' searches.
+    - nodes: The shared count of the engine's nodes and those the workers searched so far in this iteration.
+    - worker_nodes: The nodes searched by each process in the last iteration, by process id.
+    - worker: The state of a worker process: its position, engine and the shared bound.
+    """
+
+    # Seconds between checks of the engine's limits while waiting for the workers
+    POLL = 0.01
+    worker = {}
+
+    def __init__(self, engine, workers=None):
+        """
+        Starts the worker pool.
+
+        Parameters:
+        - engine: The engine whose root moves are split. Its table, network and bitbases are used by the workers
+          too.
+        - workers: The number of worker processes, all cores if None.
+        """
+        self.alpha = multiprocessing.Value('i', -Engine.INFINITY)
+        self.stop = multiprocessing.Event()
+        self.nodes = multiprocessing.Value('q', 0)
+        bitbases = engine.bitbases.directory if engine.bitbases else None
+        self.pool = multiprocessing.Pool(workers, initializer=self.init_worker,
+                                         initargs=(self.alpha, self.stop, self.nodes, engine.tt,
+                                                   engine.board.accumulator, bitbases))
+        self.worker_nodes = {}
+
+    @classmethod
+    def init_worker(cls, alpha, stop, nodes, tt, nnue, bitbases):
+        cls.worker = {"alpha": alpha, "stop": stop, "nodes": nodes, "tt": tt, "nnue": nnue, "bitbases": bitbases,
+                      "state": None, "engine": None}
+
+    @classmethod
+    def search_move(cls, task):
+        """
+        Runs in a worker: searches one root move.
+
+        Parameters:
+        - task: A tuple (position from Board.get_state, index of the move, encoded move, depth, deadline in
+          seconds since the epoch or None, the engine's node budget or None).
+
+        Returns:
+        A tuple (index, score, whether the score is exact, encoded replies of the principal variation if it is,
+        nodes searched, process id). The score is None if the search was aborted.
+        """
+        state, index, move, depth, deadline, max_nodes = task
+        worker = cls.worker
+        if worker["state"] != state:
+            nnue, bitbases = worker["nnue"], worker["bitbases"]
+            worker["engine"] = Engine(Board.from_state(state), worker["tt"], nnue.copy() if nnue else None,
+                                      Bitbases(bitbases) if bitbases else None)
+            worker["engine"].stop = worker["stop"]
+            worker["engine"].shared_nodes = worker["nodes"]
+            worker["engine"].root_material = worker["engine"].get_material()
+            worker["state"] = state
+        engine = worker["engine"]
+        engine.nodes = 0
+        # The deadline is sent as wall-clock time, since every process has a monotonic clock of its own
+        engine.deadline = time.monotonic() + deadline - time.time() if deadline else None
+        engine.max_nodes = max_nodes
+        move = next(legal for legal in engine.board.get_legal_moves() if TranspositionTable.matches(legal, move))
+        alpha = worker["alpha"].value - 1
+        engine.board.make_move(move, True)
+        try:
+            score = -engine.alphabeta(-Engine.INFINITY, -alpha, depth - 1, 1)
+        except SearchAborted:
+            worker["stop"].set()
+            return index, None, False, [], engine.nodes, os.getpid()
+        finally:
+            engine.board.undo_move(move)
+            # Engine.check_stop adds to the shared count 32 nodes at a time, the rest is added here
+            with worker["nodes"].get_lock():
+                worker["nodes"].value += engine.nodes & 31
+        line = []
+        if score > alpha:
+            with worker["alpha"].get_lock():
+                if score > worker["alpha"].value:
+                    worker["alpha"].value = score
+            engine.board.make_move(move, True)
+            line = [TranspositionTable.encode_move(reply) for reply in engine.get_pv(depth - 1)]
+            engine.board.undo_move(move)
+        return index, score, score > alpha, line, engine.nodes, os.getpid()
+
+    def search_root(self, engine, depth):
+        """
+        Searches every root move of an engine's position to the given depth, like Engine.search_root.
+
+        Raises:
+        SearchAborted: If the engine or a worker was stopped or ran out of time or nodes.
+        """
+        board = engine.board
+        key = board.get_key()
+        entry = engine.tt.probe(key)
+        moves = engine.order_moves(engine.keep_bitbase_result(board.get_legal_moves()),
+                                   entry[3] if entry else TranspositionTable.NO_MOVE)
+        moves = [move for move in moves if 1 << move.end_square != board.wk.get_board() and
+                 1 << move.end_square != board.bk.get_board()]
+        if not moves:
+            return
+
+        # PV first: the first move is searched here with the full window to get a bound for the rest
+        start = engine.nodes
+        board.make_move(moves[0], True)
+        try:
+            best_score = -engine.alphabeta(-Engine.INFINITY, Engine.INFINITY, depth - 1, 1)
+        finally:
+            board.undo_move(moves[0])
+        best_index, best_line = 0, []
+        self.alpha.value = best_score
+        self.worker_nodes = {os.getpid(): engine.nodes - start}
+
+        self.stop.clear()
+        self.nodes.value = engine.nodes
+        state = board.get_state()
+        deadline = time.time() + engine.deadline - time.monotonic() if engine.deadline else None
+        tasks = [(state, index, TranspositionTable.encode_move(move), depth, deadline, engine.max_nodes)
+                 for index, move in enumerate(moves)][1:]
+        results = self.pool.imap_unordered(self.search_move, tasks)
+        aborted = False
+        while True:
+            # The engine's own limits are watched while waiting, and passed on to the workers through the event
+            if engine.stop.is_set() or engine.max_nodes and self.nodes.value >= engine.max_nodes or \
+                    engine.deadline and time.monotonic() >= engine.deadline:
+                self.stop.set()
+            try:
+                index, score, exact, line, nodes, pid = results.next(self.POLL)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            self.worker_nodes[pid] = self.worker_nodes.get(pid, 0) + nodes
+            engine.nodes += nodes
+            aborted = aborted or score is None
+            if exact and (score > best_score or score == best_score and index < best_index):
+                best_score, best_index, best_line = score, index, line
+        if aborted:
+            raise SearchAborted()
+
+        self.store_line(engine, moves[best_index], best_line, best_score, depth)
+        engine.tt.store(key, depth, TranspositionTable.EXACT, engine.score_to_tt(best_score, 0), moves[best_index])
+        engine.best_move = moves[best_index]
+        engine.best_score = best_score
+
+    @staticmethod
+    def store_line(engine, move, line, score, depth):
+        """
+        Stores a worker's principal variation in the engine's transposition table, so that Engine.get_pv can
+        follow it past the root move.
+
+        Parameters:
+        - engine: The engine at the root position.
+        - move: The root move.
+        - line: The encoded replies after the root move.
+        - score: The root score.
+        - depth: The depth of the root search.
+        """
+        made = [move]
+        engine.board.make_move(move, True)
+        try:
+            for ply, encoded in enumerate(line, 1):
+                reply = next((legal for legal in engine.board.get_legal_moves()
+                              if TranspositionTable.matches(legal, encoded)), None)
+                if not reply:
+                    break
+                score = -score
+                engine.tt.store(engine.board.get_key(), depth - ply, TranspositionTable.EXACT,
+                                engine.score_to_tt(score, ply), reply)
+                engine.board.make_move(reply, True)
+                made.append(reply)
+        finally:
+            for made_move in reversed(made):
+                engine.board.undo_move(made_move)
+
+    def close(self):
+        """
+        Shuts the worker pool down.
+        """
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,123 @@
+import math
+
+
+class SPRT:
+    """
+    Sequential probability ratio test of an Elo difference between two engines, over pairs of games played from
+    the same opening with the colours reversed.
+
+    The test weighs the hypothesis that the first engine is elo1 stronger than the second against the hypothesis
+    that it is only elo0 stronger, using the generalized SPRT on the pair scores (the pentanomial model). Scoring
+    pairs rather than single games cancels most of the bias of unbalanced openings. After every pair the log
+    likelihood ratio (LLR) is compared with bounds set by the error rates: the test accepts H1 above the upper
+    bound, H0 below the lower bound, and goes on in between.
+
+    Attributes:
+    - elo0, elo1: The Elo differences of H0 and H1.
+    - lower, upper: The LLR bounds.
+    - pairs: The number of pairs that scored 0, 1/2, 1, 3/2 and 2 points for the first engine.
+    - results: The first engine's wins, draws and losses over all games.
+    """
+
+    def __init__(self, elo0=0.0, elo1=5.0, alpha=0.05, beta=0.05):
+        """
+        Parameters:
+        - elo0, elo1: The Elo differences of H0 and H1.
+        - alpha: The probability of accepting H1 when H0 holds.
+        - beta: The probability of accepting H0 when H1 holds.
+        """
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower = math.log(beta / (1 - alpha))
+        self.upper = math.log((1 - beta) / alpha)
+        self.pairs = [0] * 5
+        self.results = [0, 0, 0]
+
+    def add_game(self, score):
+        """
+        Counts a game's score for the first engine: 1, 0.5 or 0.
+        """
+        self.results[{1: 0, 0.5: 1, 0: 2}[score]] += 1
+
+    def add_pair(self, first, second):
+        """
+        Counts the scores of the first engine in the two games of a pair.
+        """
+        self.pairs[int((first + second) * 2)] += 1
+
+    @staticmethod
+    def expected_score(elo):
+        return 1 / (1 + 10 ** (-elo / 400))
+
+    @staticmethod
+    def to_elo(score):
+        score = min(max(score, 1e-6), 1 - 1e-6)
+        return -400 * math.log10(1 / score - 1)
+
+    def statistics(self):
+        """
+        Works out the mean and the variance of the pair scores, scaled to 0..1.
+
+        Returns:
+        A tuple (pairs, mean, variance), or None before the first pair.
+        """
+        count = sum(self.pairs)
+        if not count:
+            return None
+        mean = sum(index / 4 * pairs for index, pairs in enumerate(self.pairs)) / count
+        variance = sum((index / 4 - mean) ** 2 * pairs for index, pairs in enumerate(self.pairs)) / count
+        return count, mean, variance
+
+    def llr(self):
+        """
+        Works out the log likelihood ratio of H1 against H0, 0 while the pair scores do not vary yet.
+        """
+        statistics = self.statistics()
+        if not statistics or not statistics[2]:
+            return 0.0
+        count, mean, variance = statistics
+        score0, score1 = self.expected_score(self.elo0), self.expected_score(self.elo1)
+        return count * (score1 - score0) * (2 * mean - score0 - score1) / (2 * variance)
+
+    def elo(self):
+        """
+        Estimates the Elo difference from the pair scores.
+
+        Returns:
+        A tuple (elo, margin), the margin being the half-width of the 95% confidence interval, or None before the
+        first pair.
+        """
+        statistics = self.statistics()
+        if not statistics:
+            return None
+        count, mean, variance = statistics
+        deviation = 1.96 * math.sqrt(variance / count)
+        low, high = self.to_elo(mean - deviation), self.to_elo(mean + deviation)
+        return self.to_elo(mean), (high - low) / 2
+
+    def decision(self):
+        """
+        Returns "H1" or "H0" once the LLR has crossed a bound, otherwise None.
+        """
+        llr = self.llr()
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+    def status(self):
+        """
+        Describes the state of the test in one line.
+        """
+        wins, draws, losses = self.results
+        line = "Games %d: +%d -%d =%d" % (wins + draws + losses, wins, losses, draws)
+        elo = self.elo()
+        if elo:
+            line += "  Elo %.1f +/- %.1f" % elo
+        line += "  LLR %.2f [%.2f, %.2f]  Pairs %s" % (self.llr(), self.lower, self.upper,
+                                                        " ".join(map(str, self.pairs)))
+        decision = self.decision()
+        if decision:
+            line += "  %s accepted" % decision
+        return line
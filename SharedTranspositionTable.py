@@ -0,0 +1,101 @@
+import os
+from multiprocessing import shared_memory
+
+from TranspositionTable import TranspositionTable
+
+
+class SharedTranspositionTable(TranspositionTable):
+    """
+    Transposition table in shared memory, for several processes searching at once without locks.
+
+    Every slot is two 64-bit words: the key XORed with the packed entry, then the packed entry. A probe only
+    accepts a slot whose two words XOR back to the key it is looking for. A slot half written by another
+    process, or holding another position, fails that check and reads as a miss, so no lock is needed.
+
+    The table is created by one process and attached by the others. Pickling it, as multiprocessing does for
+    the arguments of spawned processes, only sends the shared memory's name. Every process detaches with close,
+    and the memory is removed when the process that created it does.
+
+    Attributes:
+    - size: The number of entries, always a power of two.
+    - memory: The SharedMemory block.
+    - slots: The block as an array of unsigned 64-bit words.
+    - owner_pid: The process that created the block.
+    """
+
+    def __init__(self, size_mb=16, name=None):
+        """
+        Creates a shared table, or attaches to an existing one.
+
+        Parameters:
+        - size_mb: The approximate memory budget in megabytes, rounded down to a power of two entries.
+        - name: The name of a table created by another process, or None to create a new one.
+        """
+        size = max(1, size_mb * 2 ** 20 // self.ENTRY_BYTES)
+        self.size = 1 << (size.bit_length() - 1)
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=self.size * self.ENTRY_BYTES)
+            self.memory.buf[:] = bytes(self.memory.size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.owner_pid = os.getpid() if name is None else None
+        self.slots = self.memory.buf.cast('Q')
+
+    def __getstate__(self):
+        return {"size": self.size, "name": self.memory.name, "owner_pid": self.owner_pid}
+
+    def __setstate__(self, state):
+        self.size = state["size"]
+        self.owner_pid = state["owner_pid"]
+        self.memory = shared_memory.SharedMemory(name=state["name"])
+        self.slots = self.memory.buf.cast('Q')
+
+    def clear(self):
+        """
+        Removes every entry from the table, for every process using it.
+        """
+        self.memory.buf[:self.size * self.ENTRY_BYTES] = bytes(self.size * self.ENTRY_BYTES)
+
+    def close(self):
+        """
+        Detaches from the shared memory, and frees it if this process created it.
+        """
+        self.slots.release()
+        self.memory.close()
+        if self.owner_pid == os.getpid():
+            self.memory.unlink()
+
+    def probe(self, key):
+        """
+        Looks up a position.
+
+        Parameters:
+        - key: The Zobrist key of the position.
+
+        Returns:
+        A tuple (score, depth, flag, move) if the position is stored, None otherwise.
+        """
+        index = (key & (self.size - 1)) << 1
+        entry = self.slots[index + 1]
+        if self.slots[index] ^ entry != key:
+            return None
+        return self.unpack(entry)
+
+    def store(self, key, depth, flag, score, move):
+        """
+        Stores a search result, replacing the slot's entry unless it holds a deeper result for the same position.
+
+        Parameters:
+        - key: The Zobrist key of the position.
+        - depth: The remaining search depth of the result.
+        - flag: The bound type of the score.
+        - score: The score, already converted with Engine.score_to_tt.
+        - move: The best move found, or None.
+        """
+        index = (key & (self.size - 1)) << 1
+        entry = self.slots[index + 1]
+        if self.slots[index] ^ entry == key and self.unpack(entry)[1] > depth:
+            return
+        entry = self.pack(score, depth, flag, self.encode_move(move))
+        self.slots[index] = key ^ entry
+        self.slots[index + 1] = entry
@@ -0,0 +1,112 @@
+class TranspositionTable:
+    """
+    Fixed-size hash table of search results, indexed by the Zobrist key of a position.
+
+    Every entry is packed into a single integer:
+    - bits 0-15: the score, as produced by Engine.score_to_tt and offset to be unsigned.
+    - bits 16-23: the remaining search depth of the result.
+    - bits 24-25: the bound type (EXACT, LOWER or UPPER).
+    - bits 26-37: the best move, start square in the low six bits and end square in the high six bits.
+
+    Attributes:
+    - size: The number of entries, always a power of two.
+    - keys: The full key stored with each entry, used to verify hits.
+    - entries: The packed entries.
+    """
+
+    EXACT, LOWER, UPPER = 0, 1, 2
+    ENTRY_BYTES = 16
+    NO_MOVE = 0
+
+    def __init__(self, size_mb=16):
+        """
+        Initializes an empty transposition table.
+
+        Parameters:
+        - size_mb: The approximate memory budget in megabytes, rounded down to a power of two entries.
+        """
+        size = max(1, size_mb * 2 ** 20 // self.ENTRY_BYTES)
+        self.size = 1 << (size.bit_length() - 1)
+        self.keys = [0] * self.size
+        self.entries = [0] * self.size
+
+    def clear(self):
+        """
+        Removes every entry from the table.
+        """
+        self.keys = [0] * self.size
+        self.entries = [0] * self.size
+
+    @staticmethod
+    def pack(score, depth, flag, move):
+        """
+        Packs the fields of an entry into one integer.
+
+        Parameters:
+        - score: The score in the signed 16-bit range.
+        - depth: The remaining search depth, capped at 255.
+        - flag: The bound type.
+        - move: The best move encoded by encode_move, or NO_MOVE.
+
+        Returns:
+        The packed entry.
+        """
+        return (score + 0x8000) | min(depth, 255) << 16 | flag << 24 | move << 26
+
+    @staticmethod
+    def unpack(entry):
+        """
+        Unpacks an entry created by pack.
+
+        Returns:
+        A tuple (score, depth, flag, move).
+        """
+        return (entry & 0xFFFF) - 0x8000, entry >> 16 & 0xFF, entry >> 24 & 0x3, entry >> 26 & 0xFFF
+
+    @staticmethod
+    def encode_move(move):
+        """
+        Encodes the start and end squares of a move in twelve bits.
+        """
+        if move is None:
+            return TranspositionTable.NO_MOVE
+        return move.start_square | move.end_square << 6
+
+    @staticmethod
+    def matches(move, encoded):
+        """
+        Checks if a move is the one encoded in an entry.
+        """
+        return encoded != TranspositionTable.NO_MOVE and move.start_square | move.end_square << 6 == encoded
+
+    def probe(self, key):
+        """
+        Looks up a position.
+
+        Parameters:
+        - key: The Zobrist key of the position.
+
+        Returns:
+        A tuple (score, depth, flag, move) if the position is stored, None otherwise.
+        """
+        index = key & (self.size - 1)
+        if self.keys[index] != key:
+            return None
+        return self.unpack(self.entries[index])
+
+    def store(self, key, depth, flag, score, move):
+        """
+        Stores a search result, replacing the slot's entry unless it holds a deeper result for the same position.
+
+        Parameters:
+        - key: The Zobrist key of the position.
+        - depth: The remaining search depth of the result.
+        - flag: The bound type of the score.
+        - score: The score, already converted with Engine.score_to_tt.
+        - move: The best move found, or None.
+        """
+        index = key & (self.size - 1)
+        if self.keys[index] == key and self.unpack(self.entries[index])[1] > depth:
+            return
+        self.keys[index] = key
+        self.entries[index] = self.pack(score, depth, flag, self.encode_move(move))
@@ -0,0 +1,281 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+
+import numpy as np
+
+from BatchEvaluator import BatchEvaluator
+from Engine import Engine
+from Pieces import Pieces
+
+
+class Tuner:
+    """
+    Texel-style tuning of the piece values and piece-square tables.
+
+    Every labelled position is scored with the same material and piece-square evaluation as the engine, and
+    the score is mapped to an expected game result with sigmoid(score) = 1 / (1 + 10 ^ (-k * score / 400)).
+    The parameters are fitted by mini-batch gradient descent (Adam) on the mean squared error between the
+    expected and the actual results. Each mini-batch is split into shards whose gradients are computed in
+    parallel by a pool of worker processes.
+
+    Positions are read from a text file of lines "<FEN> <result>", where the result is from white's point of
+    view ("1-0", "0-1", "1/2-1/2", or 1, 0, 0.5). They are converted once into a binary cache of
+    BatchEvaluator rows followed by the result in half points, which the workers memory-map.
+
+    Evaluation is linear in the parameters. With C the signed count of every piece type on every table
+    square (black's squares mirrored as in Engine.build_psqt) and w the phase weight, the white-relative score
+    is C . values + w * (C . mg) + (1 - w) * (C . eg). C is never built: the parameters are scattered onto the
+    768 bitboard columns instead, and the gradient is folded back from them.
+
+    Attributes:
+    - values: The material value of every type in TYPES.
+    - mg: A (6, 64) array of middlegame tables, one row per type in TYPES.
+    - eg: A (6, 64) array of endgame tables.
+    - k: The scaling constant of the sigmoid.
+    """
+
+    TYPES = [Pieces.PAWN, Pieces.KNIGHT, Pieces.BISHOP, Pieces.ROOK, Pieces.QUEEN, Pieces.KING]
+    RESULTS = {"1-0": 2, "0-1": 0, "1/2-1/2": 1, "1": 2, "0": 0, "0.5": 1, "1.0": 2, "0.0": 0}
+    COLUMNS = 14
+    SHARD_SIZE = 4096
+    K_SAMPLE = 262144
+
+    # Bitboard columns of every feature: C[:, f] = bits[:, WHITE_COLUMNS[f]] - bits[:, BLACK_COLUMNS[f]]
+    # with bits the unpacked bitboards of a position
+    WHITE_COLUMNS = np.array([BatchEvaluator.PIECES.index((piece_type, True)) * 64 + sq
+                              for piece_type in TYPES for sq in range(64)])
+    BLACK_COLUMNS = np.array([BatchEvaluator.PIECES.index((piece_type, False)) * 64
+                              + (63 - sq if piece_type in Engine.MIRRORED_TABLES else sq)
+                              for piece_type in TYPES for sq in range(64)])
+    PHASE_COLUMNS = np.repeat([Engine.PHASE_WEIGHTS.get(piece_type, 0) for piece_type, _ in BatchEvaluator.PIECES],
+                              64).astype(np.float32)
+
+    # The memory-mapped cache of a worker process, opened by init_worker
+    worker_data = None
+
+    def __init__(self):
+        """
+        Initializes the parameters from the engine's current tables.
+        """
+        self.values = np.array([Engine.VALUES.get(piece_type, 0) for piece_type in self.TYPES], dtype=np.float64)
+        self.mg = np.array([getattr(Engine, Engine.TABLE_NAMES[piece_type][0]) for piece_type in self.TYPES],
+                           dtype=np.float64)
+        self.eg = np.array([getattr(Engine, Engine.TABLE_NAMES[piece_type][1]) for piece_type in self.TYPES],
+                           dtype=np.float64)
+        self.k = 1.0
+
+    @classmethod
+    def parse_line(cls, line):
+        """
+        Splits a line of the position file into its FEN and result.
+
+        Returns:
+        A tuple (fen, result in half points), or None if the line has no recognised result.
+        """
+        fields = line.strip().rsplit(None, 1)
+        if len(fields) != 2:
+            return None
+        result = cls.RESULTS.get(fields[1].strip('[]";'))
+        if result is None:
+            return None
+        return fields[0].rstrip(' ;'), result
+
+    @classmethod
+    def build_cache(cls, text_path, cache_path, chunk_lines=65536):
+        """
+        Streams a position file into a binary cache, a chunk of lines at a time.
+
+        Parameters:
+        - text_path: The file of "<FEN> <result>" lines.
+        - cache_path: The cache file to write.
+        - chunk_lines: The number of lines converted at a time.
+
+        Returns:
+        The number of positions written.
+        """
+        count = 0
+        with open(text_path) as text, open(cache_path, "wb") as cache:
+            while True:
+                lines = [text.readline() for _ in range(chunk_lines)]
+                parsed = [entry for entry in map(cls.parse_line, lines) if entry is not None]
+                if parsed:
+                    rows = BatchEvaluator.positions_from_fens([fen for fen, _ in parsed])
+                    results = np.array([[result] for _, result in parsed], dtype=np.uint64)
+                    np.hstack([rows, results]).astype('<u8').tofile(cache)
+                    count += len(parsed)
+                if not lines[-1]:
+                    return count
+
+    @classmethod
+    def load_cache(cls, cache_path):
+        """
+        Memory-maps a cache written by build_cache.
+
+        Returns:
+        A read-only uint64 array of shape (N, 14).
+        """
+        return np.memmap(cache_path, dtype='<u8', mode='r').reshape(-1, cls.COLUMNS)
+
+    @classmethod
+    def scatter(cls, weights):
+        """
+        Maps per-feature parameters onto bitboard columns, negated for black, with the phase weights appended.
+
+        Parameters:
+        - weights: The (384, 3) matrix returned by weight_matrix.
+
+        Returns:
+        A (768, 4) float32 matrix.
+        """
+        columns = np.zeros((768, 4), dtype=np.float32)
+        columns[cls.WHITE_COLUMNS, :3] = weights
+        columns[cls.BLACK_COLUMNS, :3] = -weights
+        columns[:, 3] = cls.PHASE_COLUMNS
+        return columns
+
+    @classmethod
+    def init_worker(cls, cache_path):
+        """
+        Opens the cache in a worker process.
+        """
+        cls.worker_data = cls.load_cache(cache_path)
+
+    @classmethod
+    def shard_gradient(cls, args):
+        """
+        Computes the summed loss and gradient of a shard of positions in a worker process.
+
+        Parameters:
+        - args: A tuple (indices, weights, k, need_gradient), where weights is the (384, 3) matrix of the
+          per-feature value, middlegame and endgame parameters.
+
+        Returns:
+        A tuple (loss, gradient), the gradient being a (384, 3) array or None.
+        """
+        indices, weights, k, need_gradient = args
+        rows = cls.worker_data[np.sort(indices)]
+        bits = np.unpackbits(np.ascontiguousarray(rows[:, :12], dtype='<u8').view(np.uint8), axis=1,
+                             bitorder='little').astype(np.float32)
+        terms = bits @ cls.scatter(weights)
+        phase = np.minimum(terms[:, 3], Engine.MAX_PHASE) / Engine.MAX_PHASE
+        score = terms[:, 0] + phase * terms[:, 1] + (1 - phase) * terms[:, 2]
+        expected = 1 / (1 + np.power(10.0, -k * score.astype(np.float64) / 400))
+        error = expected - rows[:, 13] / 2
+        loss = float(np.sum(error ** 2))
+        if not need_gradient:
+            return loss, None
+        slope = (2 * error * expected * (1 - expected) * k * math.log(10) / 400).astype(np.float32)
+        gradient = bits.T @ np.stack([slope, slope * phase, slope * (1 - phase)], axis=1)
+        return loss, gradient[cls.WHITE_COLUMNS] - gradient[cls.BLACK_COLUMNS]
+
+    def weight_matrix(self):
+        """
+        Lays the parameters out per feature, as a (384, 3) matrix of value, middlegame and endgame.
+        """
+        return np.stack([np.repeat(self.values, 64), self.mg.ravel(), self.eg.ravel()], axis=1)
+
+    def loss(self, pool, indices, k, shard_size):
+        """
+        Computes the mean squared error over a set of positions.
+
+        Parameters:
+        - pool: The worker pool.
+        - indices: The indices of the positions in the cache.
+        - k: The sigmoid scaling constant to evaluate.
+        - shard_size: The number of positions per worker task.
+        """
+        weights = self.weight_matrix()
+        shards = [(indices[start:start + shard_size], weights, k, False) for start in range(0, len(indices), shard_size)]
+        return sum(loss for loss, _ in pool.imap_unordered(self.shard_gradient, shards)) / len(indices)
+
+    def fit_k(self, pool, indices, shard_size, low=0.1, high=4.0, iterations=16):
+        """
+        Finds the sigmoid scaling constant that best fits the current parameters, by golden-section search.
+        """
+        ratio = (math.sqrt(5) - 1) / 2
+        for _ in range(iterations):
+            left, right = high - ratio * (high - low), low + ratio * (high - low)
+            if self.loss(pool, indices, left, shard_size) < self.loss(pool, indices, right, shard_size):
+                high = right
+            else:
+                low = left
+        self.k = (low + high) / 2
+        return self.k
+
+    def tune(self, cache_path, epochs=10, batch_size=16384, learning_rate=1.0, workers=None, log=print):
+        """
+        Fits the parameters to a cache of labelled positions.
+
+        Parameters:
+        - cache_path: The cache written by build_cache.
+        - epochs: The number of passes over the positions.
+        - batch_size: The number of positions per gradient step.
+        - learning_rate: The Adam step size, in centipawns.
+        - workers: The number of worker processes, all cores if None.
+        - log: Called with a progress line after every epoch.
+        """
+        size = len(self.load_cache(cache_path))
+        everything = np.arange(size)
+        workers = workers or os.cpu_count()
+        shard_size = max(1, min(self.SHARD_SIZE, -(-batch_size // workers)))
+        moments = np.zeros((2, len(self.values) + self.mg.size + self.eg.size))
+        beta1, beta2, step = 0.9, 0.999, 0
+        with multiprocessing.Pool(workers, self.init_worker, (cache_path,)) as pool:
+            self.fit_k(pool, np.random.permutation(size)[:self.K_SAMPLE], shard_size)
+            log(f"k = {self.k:.4f}, loss = {self.loss(pool, everything, self.k, shard_size):.6f}")
+            for epoch in range(epochs):
+                order = np.random.permutation(size)
+                for start in range(0, size, batch_size):
+                    batch = order[start:start + batch_size]
+                    weights = self.weight_matrix()
+                    shards = [(batch[i:i + shard_size], weights, self.k, True)
+                              for i in range(0, len(batch), shard_size)]
+                    gradient = sum(gradient for _, gradient in pool.imap_unordered(self.shard_gradient, shards))
+                    # A piece's value applies to all 64 of its features
+                    gradient = np.concatenate([gradient[:, 0].reshape(6, 64).sum(axis=1), gradient[:, 1],
+                                               gradient[:, 2]]) / len(batch)
+                    step += 1
+                    moments[0] = beta1 * moments[0] + (1 - beta1) * gradient
+                    moments[1] = beta2 * moments[1] + (1 - beta2) * gradient ** 2
+                    update = learning_rate * (moments[0] / (1 - beta1 ** step)) / (
+                            np.sqrt(moments[1] / (1 - beta2 ** step)) + 1e-8)
+                    self.values -= update[:6]
+                    self.mg -= update[6:390].reshape(6, 64)
+                    self.eg -= update[390:].reshape(6, 64)
+                log(f"epoch {epoch + 1}: loss = {self.loss(pool, everything, self.k, shard_size):.6f}")
+
+    def save_weights(self, path=Engine.WEIGHTS_FILE):
+        """
+        Writes the parameters, rounded to integers, in the format read by Engine.load_weights.
+        """
+        weights = {"VALUES": {piece_type.name: int(round(value)) for piece_type, value in zip(self.TYPES, self.values)
+                              if piece_type != Pieces.KING}}
+        for piece_type, mg, eg in zip(self.TYPES, self.mg, self.eg):
+            mg_name, eg_name = Engine.TABLE_NAMES[piece_type]
+            weights[mg_name] = [int(round(value)) for value in mg]
+            weights[eg_name] = [int(round(value)) for value in eg]
+        with open(path, "w") as file:
+            json.dump(weights, file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune the evaluation tables on labelled positions.")
+    parser.add_argument("positions", help='file of "<FEN> <result>" lines')
+    parser.add_argument("--cache", help="binary cache of the positions, built if missing")
+    parser.add_argument("--output", default=Engine.WEIGHTS_FILE, help="where to write the tuned tables")
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=16384)
+    parser.add_argument("--learning-rate", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    cache_path = args.cache or args.positions + ".bin"
+    if not os.path.exists(cache_path):
+        print(f"cached {Tuner.build_cache(args.positions, cache_path)} positions")
+    Engine.load_weights(args.output)
+    tuner = Tuner()
+    tuner.tune(cache_path, args.epochs, args.batch_size, args.learning_rate, args.workers)
+    tuner.save_weights(args.output)
@@ -0,0 +1,401 @@
+import sys
+import threading
+import time
+
+from Bitbases import Bitbases
+from Board import Board
+from Engine import Engine, SearchAborted
+from NNUE import NNUE
+from ParallelSearch import ParallelSearch
+from Pieces import Pieces
+from SharedTranspositionTable import SharedTranspositionTable
+from TranspositionTable import TranspositionTable
+from WorkerPool import WorkerPool
+
+
+class UCI:
+    """
+    Headless front end speaking the Universal Chess Interface, for GUIs, match runners and analysis tools.
+
+    Commands are read and handled on the calling thread. Every search runs on a thread of its own, so that
+    stop, ponderhit and isready are answered while it runs. Commands that change the position or the engine
+    wait for the current search to finish first. An info line is sent after every completed iteration, and
+    bestmove when the search ends. In infinite and ponder mode, bestmove waits for stop or ponderhit even if
+    the search reaches its last depth.
+
+    With Threads above one, the extra threads are Lazy SMP helper processes sharing a transposition table of
+    Hash megabytes, as in the GUI.
+
+    Attributes:
+    - output: The stream the replies are written to.
+    - hash_mb: The transposition table size in megabytes.
+    - threads: The number of search threads, the engine's own included.
+    - nnue: The network, or None to evaluate with the piece-square tables.
+    - bitbases: The endgame bitbases.
+    - tt: The transposition table, kept from one search to the next.
+    - helpers: The Lazy SMP helpers, or None.
+    - board: The position set by the last position command.
+    - engine: The engine searching the current or last position.
+    - search_thread: The thread of the running search, or None.
+    - release: Set when bestmove may be sent, cleared while pondering or searching infinitely.
+    - pondering: Whether the running search is pondering.
+    - time_limits: The (soft, hard) time allocation in seconds of the running search, or None.
+    - iteration_deadline: The time after which the search starts no new iteration, or None.
+    - start_time: When the running search, or its normal time control after ponderhit, started.
+    """
+
+    NAME = "Chesster"
+    AUTHOR = "the Chesster developers"
+    START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    MAX_DEPTH = 64
+    DEFAULT_HASH, MAX_HASH = 16, 1024
+    MAX_THREADS = 64
+    # Time control: the share of the remaining time per move when the number of moves to go is unknown, and the
+    # time each move loses outside the search, to communication and the interpreter, which is kept back
+    MOVES_TO_GO = 30
+    MOVE_OVERHEAD = 0.1
+    PROMOTION_PIECES = {"q": Pieces.QUEEN, "r": Pieces.ROOK, "b": Pieces.BISHOP, "n": Pieces.KNIGHT}
+
+    def __init__(self, output=sys.stdout):
+        """
+        Loads the evaluation and the bitbases and sets up the starting position.
+
+        Parameters:
+        - output: The stream to write the replies to.
+        """
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.hash_mb = self.DEFAULT_HASH
+        self.threads = 1
+        Engine.load_weights()
+        self.nnue = NNUE.load()
+        self.bitbases = Bitbases()
+        self.tt = None
+        self.helpers = None
+        self.board = None
+        self.engine = None
+        self.search_thread = None
+        self.release = threading.Event()
+        self.pondering = False
+        self.time_limits = None
+        self.iteration_deadline = None
+        self.start_time = 0
+        self.set_position(self.START_FEN, [])
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def run(self, lines=sys.stdin):
+        """
+        Handles commands until quit or the end of the input.
+
+        Parameters:
+        - lines: The input, one command per line.
+        """
+        for line in lines:
+            if not self.handle(line):
+                break
+        self.close()
+
+    def handle(self, line):
+        """
+        Handles one command. Unknown commands are ignored, as the protocol asks.
+
+        Returns:
+        False once the command is quit, True otherwise.
+        """
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        match command:
+            case "uci":
+                self.send("id name " + self.NAME)
+                self.send("id author " + self.AUTHOR)
+                self.send("option name Hash type spin default %d min 1 max %d" % (self.DEFAULT_HASH, self.MAX_HASH))
+                self.send("option name Threads type spin default 1 min 1 max %d" % self.MAX_THREADS)
+                self.send("option name Ponder type check default false")
+                self.send("uciok")
+            case "isready":
+                self.send("readyok")
+            case "setoption":
+                self.wait()
+                self.set_option(args)
+            case "ucinewgame":
+                self.wait()
+                self.tt.clear()
+            case "position":
+                self.wait()
+                self.position(args)
+            case "go":
+                self.wait()
+                self.go(args)
+            case "stop":
+                self.wait(stop=True)
+            case "ponderhit":
+                self.ponder_hit()
+            case "quit":
+                self.wait(stop=True)
+                return False
+        return True
+
+    def set_option(self, args):
+        """
+        Handles setoption name <name> value <value> for Hash and Threads.
+        """
+        text = " ".join(args)
+        name, _, value = text.partition(" value ")
+        name = name.removeprefix("name ").strip().lower()
+        try:
+            value = int(value)
+        except ValueError:
+            return
+        if name == "hash":
+            self.hash_mb = max(1, min(self.MAX_HASH, value))
+        elif name == "threads":
+            self.threads = max(1, min(self.MAX_THREADS, value))
+        else:
+            return
+        self.close()
+        self.engine = self.create_engine(self.board)
+
+    def create_engine(self, board):
+        """
+        Creates an engine for a position, creating the transposition table and the helpers first if the options
+        changed.
+        """
+        if self.tt is None:
+            self.tt = SharedTranspositionTable(self.hash_mb) if self.threads > 1 else TranspositionTable(self.hash_mb)
+        engine = Engine(board, self.tt, self.nnue, self.bitbases)
+        if self.threads > 1 and self.helpers is None:
+            self.helpers = ParallelSearch(engine, self.threads - 1)
+        engine.helpers = self.helpers
+        return engine
+
+    def position(self, args):
+        """
+        Handles position [startpos | fen <fen>] [moves <move> ...].
+        """
+        moves = args.index("moves") if "moves" in args else len(args)
+        if args and args[0] == "fen":
+            fen = " ".join(args[1:moves])
+        elif args and args[0] == "startpos":
+            fen = self.START_FEN
+        else:
+            return
+        self.set_position(fen, args[moves + 1:])
+
+    def set_position(self, fen, moves):
+        """
+        Sets up a position and plays moves from it. The moves stop at the first illegal one.
+
+        Parameters:
+        - fen: The FEN of the position.
+        - moves: The moves in UCI notation.
+        """
+        board = Board.from_fen(fen)
+        for text in moves:
+            move = self.parse_move(board, text)
+            if not move:
+                self.send("info string illegal move " + text)
+                break
+            board.make_move(move, True)
+        self.board = board
+        self.engine = self.create_engine(board)
+
+    @classmethod
+    def parse_move(cls, board, text):
+        """
+        Finds the legal move written in UCI notation, like e2e4, e7e8n or e1g1.
+
+        Returns:
+        The Move, or None if it is not legal.
+        """
+        if len(text) < 4 or text[:2] not in board.SQUARE_NAMES or text[2:4] not in board.SQUARE_NAMES:
+            return None
+        start, end = board.SQUARE_NAMES.index(text[:2]), board.SQUARE_NAMES.index(text[2:4])
+        for move in board.get_legal_moves():
+            if move.start_square == start and end in (move.end_square, cls.king_destination(move)):
+                if move.is_promotion:
+                    move.promotion = cls.PROMOTION_PIECES.get(text[4:5], Pieces.QUEEN)
+                return move
+        return None
+
+    @staticmethod
+    def king_destination(move):
+        """
+        Gets the square the king lands on for a castling move, which the board stores as king takes rook.
+        """
+        if not move.is_castle:
+            return None
+        return move.start_square + 2 if move.end_square > move.start_square else move.start_square - 2
+
+    @classmethod
+    def format_move(cls, board, move):
+        """
+        Writes a move in UCI notation.
+
+        Parameters:
+        - board: Any board, for the square names.
+        - move: The move.
+        """
+        end = cls.king_destination(move) if move.is_castle else move.end_square
+        text = board.square_name(move.start_square) + board.square_name(end)
+        if move.is_promotion:
+            text += board.PIECE_SYMBOLS[move.promotion or Pieces.QUEEN]
+        return text
+
+    def go(self, args):
+        """
+        Handles go with depth, nodes, movetime, wtime, btime, winc, binc, movestogo, infinite and ponder, and
+        starts the search thread.
+        """
+        options = {}
+        flags = set()
+        for index, token in enumerate(args):
+            if token in ("infinite", "ponder"):
+                flags.add(token)
+            elif index + 1 < len(args) and args[index + 1].lstrip("-").isdigit():
+                options[token] = int(args[index + 1])
+
+        engine = self.engine
+        engine.stop.clear()
+        engine.max_nodes = options.get("nodes")
+        engine.deadline = None
+        self.pondering = "ponder" in flags
+        self.time_limits = self.allocate_time(options)
+        self.iteration_deadline = None
+        self.start_time = time.monotonic()
+        if self.time_limits and not self.pondering:
+            self.start_clock()
+        if flags:
+            self.release.clear()
+        else:
+            self.release.set()
+        depth = max(1, min(self.MAX_DEPTH, options.get("depth", self.MAX_DEPTH)))
+        self.search_thread = threading.Thread(target=self.search, args=(engine, depth), daemon=True)
+        self.search_thread.start()
+
+    def allocate_time(self, options):
+        """
+        Works out how long to search from the go parameters.
+
+        Returns:
+        A tuple (soft, hard) in seconds, or None if the search has no time limit. No iteration is started once
+        half of the soft limit has passed, and the search is aborted at the hard limit.
+        """
+        if "movetime" in options:
+            limit = max(0.01, options["movetime"] / 1000 - self.MOVE_OVERHEAD)
+            return limit, limit
+        time_left = options.get("wtime" if self.board.is_white_turn else "btime")
+        if time_left is None:
+            return None
+        time_left /= 1000
+        increment = options.get("winc" if self.board.is_white_turn else "binc", 0) / 1000
+        moves_to_go = options.get("movestogo") or self.MOVES_TO_GO
+        soft = time_left / moves_to_go + increment * 3 / 4
+        # Short of time the hard limit stays below the increment plus a quarter of what is left beyond the
+        # overhead, so that the clock is not run down however short it gets
+        hard = max(0.01, min(soft * 3, (time_left - self.MOVE_OVERHEAD) / 4 + increment * 3 / 4))
+        return min(soft, hard), hard
+
+    def start_clock(self):
+        """
+        Starts the time limits of the running search from now.
+        """
+        soft, hard = self.time_limits
+        self.start_time = time.monotonic()
+        self.iteration_deadline = self.start_time + soft / 2
+        self.engine.deadline = self.start_time + hard
+
+    def ponder_hit(self):
+        """
+        Handles ponderhit: the predicted move was played, so the ponder search becomes a normal search.
+        """
+        if not self.pondering:
+            return
+        self.pondering = False
+        if self.time_limits:
+            self.start_clock()
+        self.release.set()
+
+    def search(self, engine, depth):
+        """
+        Runs in the search thread: searches the position and sends bestmove.
+        """
+        engine.on_iteration = self.report
+        try:
+            engine.search(depth)
+        except SearchAborted:
+            pass
+        self.release.wait()
+        move = engine.best_move
+        if not move:
+            moves = engine.board.get_legal_moves()
+            move = moves[0] if moves else None
+        if not move:
+            self.send("bestmove 0000")
+        elif len(engine.pv) > 1 and engine.pv[0] == move:
+            self.send("bestmove %s ponder %s" % (self.format_move(self.board, move),
+                                                 self.format_move(self.board, engine.pv[1])))
+        else:
+            self.send("bestmove " + self.format_move(self.board, move))
+
+    def report(self, depth):
+        """
+        Sends the info line of a completed iteration, and stops the search if another iteration would not
+        finish in time.
+        """
+        engine = self.engine
+        elapsed = time.monotonic() - self.start_time
+        self.send("info depth %d score %s nodes %d nps %d time %d pv %s" % (
+            depth, self.format_score(engine.best_score), engine.nodes, engine.nodes / max(elapsed, 0.001),
+            elapsed * 1000, " ".join(self.format_move(self.board, move) for move in engine.pv)))
+        if self.iteration_deadline and time.monotonic() >= self.iteration_deadline:
+            engine.stop.set()
+
+    @staticmethod
+    def format_score(score):
+        """
+        Writes a score as cp <centipawns> or mate <moves>, negative when the engine is being mated.
+        """
+        if score > Engine.MATE_BOUND:
+            return "mate %d" % ((Engine.CHECKMATE_VALUE - score + 1) // 2)
+        if score < -Engine.MATE_BOUND:
+            return "mate -%d" % ((Engine.CHECKMATE_VALUE + score + 1) // 2)
+        return "cp %d" % score
+
+    def wait(self, stop=False):
+        """
+        Waits for the running search to end and send bestmove.
+
+        Parameters:
+        - stop: Whether to stop the search rather than let it run to its limits.
+        """
+        if not self.search_thread:
+            return
+        if stop:
+            self.engine.stop.set()
+            self.pondering = False
+            self.release.set()
+        self.search_thread.join()
+        self.search_thread = None
+
+    def close(self):
+        """
+        Stops the helpers and frees the transposition table, which is created again for the next search.
+        """
+        self.wait(stop=True)
+        if self.helpers:
+            self.helpers.close()
+            self.helpers = None
+        if isinstance(self.tt, SharedTranspositionTable):
+            self.tt.close()
+        self.tt = None
+
+
+if __name__ == "__main__":
+    WorkerPool.use_engine_directory()
+    UCI().run()
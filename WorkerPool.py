@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import threading
+
+from Bitbases import Bitbases
+from Engine import Engine
+from NNUE import NNUE
+from TranspositionTable import TranspositionTable
+
+
+class WorkerPool:
+    """
+    The worker processes shared by the analysis tools, each with an engine's evaluation, bitbases and table.
+
+    map runs a function over a stream of tasks on a pool of workers. Tasks are read on the pool's own thread,
+    which waits until results have been consumed, so that at most IN_FLIGHT tasks per worker are read ahead of
+    the results. Memory stays bounded however long the input is, and every worker always has a task waiting.
+
+    Attributes:
+    - worker: The state of a worker process: its engine's network, bitbases and table, and the tool's options.
+    """
+
+    IN_FLIGHT = 4
+    worker = {}
+
+    @staticmethod
+    def use_engine_directory():
+        """
+        Changes to the engine's directory, where the images, opening book, weights and bitbases are found, so that
+        the tools can be run from anywhere.
+        """
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    @classmethod
+    def init_worker(cls, hash_mb, options=None):
+        """
+        Loads the evaluation and the bitbases in a worker process.
+
+        Parameters:
+        - hash_mb: The transposition table size in megabytes.
+        - options: The tool's options, such as its search limits, kept in the worker's state.
+        """
+        Engine.load_weights()
+        cls.worker = {"nnue": NNUE.load(), "bitbases": Bitbases(), "tt": TranspositionTable(hash_mb),
+                      **(options or {})}
+
+    @classmethod
+    def engine(cls, board):
+        """
+        Creates an engine for a position in a worker process. Its table is cleared first, so that a result does
+        not depend on which positions the worker searched before.
+        """
+        worker = cls.worker
+        worker["tt"].clear()
+        return Engine(board, worker["tt"], worker["nnue"].copy() if worker["nnue"] else None, worker["bitbases"])
+
+    @classmethod
+    def map(cls, function, tasks, workers=None, hash_mb=16, options=None, ordered=False):
+        """
+        Runs a function over every task on a pool of worker processes.
+
+        Parameters:
+        - function: The function a worker calls on each task, which must be picklable.
+        - tasks: Any iterable of tasks.
+        - workers: The number of worker processes, all cores if None.
+        - hash_mb: The transposition table size of each worker in megabytes.
+        - options: The tool's options, kept in every worker's state.
+        - ordered: Whether the results come in the order of the tasks rather than as they complete.
+
+        Returns:
+        A generator of the results. Closing it, or an exception where it is consumed, shuts the pool down.
+        """
+        workers = workers or os.cpu_count() or 1
+        slots = threading.Semaphore(workers * cls.IN_FLIGHT)
+        stopped = threading.Event()
+
+        def bounded():
+            for task in tasks:
+                slots.acquire()
+                if stopped.is_set():
+                    return
+                yield task
+
+        with multiprocessing.Pool(workers, cls.init_worker, (hash_mb, options)) as pool:
+            try:
+                for result in (pool.imap if ordered else pool.imap_unordered)(function, bounded()):
+                    yield result
+                    slots.release()
+            finally:
+                # Lets the reading thread finish if the results are not consumed, so that the pool can shut down
+                stopped.set()
+                slots.release(workers * cls.IN_FLIGHT)
@@ -1,3 +1,4 @@
+import argparse
 import math
 
 import pygame
@@ -6,24 +7,56 @@ import sys
 from BitBoard import BitBoard
 from Move import Move
 from Pieces import Pieces
+from Bitbases import Bitbases
 from Board import Board
 from Engine import Engine
+from EngineWorker import EngineWorker
+from NNUE import NNUE
+from ParallelSearch import ParallelSearch
 from PromotionPopup import PromotionPopup
+from SharedTranspositionTable import SharedTranspositionTable
 
 
 class ChessGUI:
     WIDTH, HEIGHT, SQUARE_SIZE = 800, 800, 100
     FPS = 60
     HIGHLIGHT_COLOR = (224, 244, 64, 100)
+    # The status bar below the board shows the engine's progress, with a button that makes it move now
+    STATUS_HEIGHT = 40
+    STATUS_COLOR = (40, 40, 40)
+    TEXT_COLOR = (230, 230, 230)
+    STOP_BUTTON = pygame.Rect(700, 805, 90, 30)
     Square = int
 
     board_img = pygame.image.load('images/board.png')
 
-    def __init__(self):
+    def __init__(self, threads=1):
+        """
+        Opens the window and starts the engine.
+
+        Parameters:
+        - threads: The number of search threads. Beyond the first, each runs a Lazy SMP helper process.
+        """
+        self.board = Board(self)
+        Engine.load_weights()
+        # The helpers are started before pygame so that the helper processes do not inherit it
+        helpers = max(1, threads) - 1
+        self.engine = Engine(self.board, SharedTranspositionTable() if helpers else None, nnue=NNUE.load(),
+                             bitbases=Bitbases())
+        if helpers:
+            self.engine.helpers = ParallelSearch(self.engine, helpers)
+        self.worker = EngineWorker(self.engine)
+        # The engine searches on a thread. Switching threads every millisecond rather than every five lets the
+        # frame loop take the interpreter back in time for every frame.
+        sys.setswitchinterval(0.001)
+        self.status = "Your move"
+        self.running = True  # Cleared by the board when the game ends
+
         pygame.init()
-        self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT))
+        self.screen = pygame.display.set_mode((self.WIDTH, self.HEIGHT + self.STATUS_HEIGHT))
         pygame.display.set_caption("Chester the Chess Engine")
         self.clock = pygame.time.Clock()
+        self.font = pygame.font.Font(None, 28)
 
         pygame.mixer.init()
         self.capture_sound = pygame.mixer.Sound("sounds/capture.ogg")
@@ -32,41 +65,89 @@ class ChessGUI:
         self.move_sound = pygame.mixer.Sound("sounds/move-self.ogg")
         self.promote_sound = pygame.mixer.Sound("sounds/promote.ogg")
 
-        self.board = Board(self)
-        self.engine = Engine(self.board)
+
+    def close_engine(self):
+        """
+        Stops the engine's background work and frees the shared transposition table.
+        """
+        self.worker.close()
+        if self.engine.helpers:
+            self.engine.helpers.close()
+            self.engine.tt.close()
 
     def run(self):
         """
         Main game loop responsible for running the chess GUI.
 
         This function initializes the game, handles user input, and updates the display.
+        The engine searches in the background: every frame the loop only polls it for progress and its move.
         """
         running = True
         self.draw_board(None)  # Initial drawing of the chess board
         while running:
-            if not self.board.is_white_turn:
-                move = chess_gui.engine.select_move(3)
-                chess_gui.board.make_move(move, False)
-                self.draw_board(None)
-                print(self.move_notation())
-                # print(self.export_fen())
+            self.poll_engine()
+            if not self.running:
+                self.status = "Game over"
+            elif not self.board.is_white_turn and not self.worker.busy:
+                self.worker.start(self.board)
+                self.status = "Thinking..."
             self.clock.tick(self.FPS)
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     # Clean up and exit the game
+                    self.close_engine()
                     pygame.quit()
                     sys.exit()
                 elif event.type == pygame.MOUSEBUTTONDOWN:
-                    self.handle_mouse_click(pygame.mouse.get_pos())
+                    position = pygame.mouse.get_pos()
+                    if position[1] >= self.HEIGHT:
+                        if self.worker.busy and self.STOP_BUTTON.collidepoint(position):
+                            self.worker.stop()
+                    else:
+                        self.handle_mouse_click(position)
                 elif event.type == pygame.KEYDOWN:
-                    if event.key == pygame.K_z:
+                    if event.key == pygame.K_z and not self.worker.busy:
                         self.board.undo_move(self.board.last_move)
                         self.draw_board(None)
 
+            self.draw_status()
             pygame.display.flip()
 
         self.draw_board(None)
 
+    def poll_engine(self):
+        """
+        Handles the engine's progress reports and plays its move once it arrives.
+        """
+        for message in self.worker.poll():
+            if message[0] == "info":
+                _, depth, score, pv = message
+                self.status = "Depth %d  score %+.2f  %s" % (depth, score / 100,
+                                                             " ".join(self.algebraic_notation(move) for move in pv))
+            elif message[1]:
+                self.board.make_move(message[1], False)
+                self.draw_board(None)
+                print(self.move_notation())
+                # Search the predicted reply while the player thinks
+                self.worker.ponder(self.board)
+                self.status = "Your move"
+            else:
+                self.running = False
+
+    def draw_status(self):
+        """
+        Draws the status bar: the engine's latest progress, and the stop button while it searches.
+        """
+        pygame.draw.rect(self.screen, self.STATUS_COLOR, (0, self.HEIGHT, self.WIDTH, self.STATUS_HEIGHT))
+        text = self.font.render(self.status, True, self.TEXT_COLOR)
+        # Long principal variations are cut off before the button
+        self.screen.blit(text, (10, self.HEIGHT + (self.STATUS_HEIGHT - text.get_height()) // 2),
+                         pygame.Rect(0, 0, self.STOP_BUTTON.left - 20, text.get_height()))
+        if self.worker.busy:
+            pygame.draw.rect(self.screen, (150, 40, 40), self.STOP_BUTTON, border_radius=5)
+            label = self.font.render("Stop", True, self.TEXT_COLOR)
+            self.screen.blit(label, label.get_rect(center=self.STOP_BUTTON.center))
+
     def draw_highlighted_piece(self):
         """
         Draws a highlighted box around the selected piece on the chess board.
@@ -202,13 +283,8 @@ class ChessGUI:
             # If no piece is selected, set the selected piece and display valid moves
             self.board.selected = clicked_piece, clicked_square
 
-            # Determine available moves based on the selected piece and update the displayed board
-            short_castle, long_castle = self.board.white_can_castle if self.board.selected[
-                0].is_white() else self.board.black_can_castle
-            king = self.board.wk if self.board.is_white_turn else self.board.bk
-            moves = self.board.get_moves(self.board.selected[0], (short_castle, long_castle))
-            moves = self.board.remove_check_moves(moves, king)
-            self.draw_board(moves)
+            # Highlight the legal moves, of which draw_board shows the selected piece's
+            self.draw_board(self.board.get_legal_moves())
 
     def handle_second_click(self, clicked_piece: BitBoard, clicked_square: Square):
         """
@@ -232,10 +308,7 @@ class ChessGUI:
                 and clicked_square != self.board.selected[1]:
             # If the clicked square is a different friendly piece, update the selected piece and display valid moves
             self.board.selected = clicked_piece, clicked_square
-            can_castle = self.board.white_can_castle if clicked_piece.is_white() else self.board.black_can_castle
-            king = self.board.wk if self.board.is_white_turn else self.board.bk
-            moves = self.board.get_moves(clicked_piece, can_castle)
-            moves = self.board.remove_check_moves(moves, king)
+            moves = self.board.get_legal_moves()
         else:
             # If the same piece is clicked a second time, unhighlight the piece and moves
             self.board.selected = None
@@ -286,6 +359,7 @@ class ChessGUI:
         while True:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
+                    self.close_engine()
                     pygame.quit()
                     sys.exit()
                 elif event.type == pygame.MOUSEBUTTONDOWN:
@@ -299,96 +373,7 @@ class ChessGUI:
             promotion_popup.draw()
 
     def import_fen(self, fen: str):
-        for piece in self.board.pieces:
-            piece.clear_board()
-        self.board.white_can_castle = (False, False)
-        self.board.black_can_castle = (False, False)
-
-        curr_char = 0
-        board_idx = 56
-        while fen[curr_char] != ' ':
-            match fen[curr_char]:
-                case 'P':
-                    self.board.wp.occupy_square(board_idx)
-                    board_idx += 1
-                case 'p':
-                    self.board.bp.occupy_square(board_idx)
-                    board_idx += 1
-                case 'N':
-                    self.board.wkn.occupy_square(board_idx)
-                    board_idx += 1
-                case 'n':
-                    self.board.bkn.occupy_square(board_idx)
-                    board_idx += 1
-                case 'R':
-                    self.board.wr.occupy_square(board_idx)
-                    board_idx += 1
-                case 'r':
-                    self.board.br.occupy_square(board_idx)
-                    board_idx += 1
-                case 'B':
-                    self.board.wb.occupy_square(board_idx)
-                    board_idx += 1
-                case 'b':
-                    self.board.bb.occupy_square(board_idx)
-                    board_idx += 1
-                case 'Q':
-                    self.board.wq.occupy_square(board_idx)
-                    board_idx += 1
-                case 'q':
-                    self.board.bq.occupy_square(board_idx)
-                    board_idx += 1
-                case 'K':
-                    self.board.wk.occupy_square(board_idx)
-                    board_idx += 1
-                case 'k':
-                    self.board.bk.occupy_square(board_idx)
-                    board_idx += 1
-                case '/':
-                    board_idx -= 16
-                case '1':
-                    board_idx += 1
-                case '2':
-                    board_idx += 2
-                case '3':
-                    board_idx += 3
-                case '4':
-                    board_idx += 4
-                case '5':
-                    board_idx += 5
-                case '6':
-                    board_idx += 6
-                case '7':
-                    board_idx += 7
-                case '8':
-                    board_idx += 8
-            curr_char += 1
-
-        curr_char += 1
-        self.board.is_white_turn = fen[curr_char] == 'w'
-        curr_char += 2
-        while fen[curr_char] != ' ':
-            match fen[curr_char]:
-                case '-':
-                    curr_char += 1
-                case 'K':
-                    self.board.white_can_castle = (True, self.board.white_can_castle[1])
-                case 'Q':
-                    self.board.white_can_castle = (self.board.white_can_castle[0], True)
-                case 'k':
-                    self.board.black_can_castle = (True, self.board.black_can_castle[1])
-                case 'q':
-                    self.board.black_can_castle = (self.board.black_can_castle[0], True)
-            curr_char += 1
-
-        curr_char += 1
-        if fen[curr_char] != '-':
-            file = fen[curr_char].lower()
-            file_idx = ord(file) - ord('a')
-            if self.board.is_white_turn:
-                self.board.last_move = Move(48 + file_idx, 32 + file_idx, Pieces.PAWN)
-            else:
-                self.board.last_move = Move(8 + file_idx, 24 + file_idx, Pieces.PAWN)
+        self.board.import_fen(fen)
 
     def move_notation(self):
         move = ""
@@ -420,5 +405,8 @@ class ChessGUI:
 
 
 if __name__ == "__main__":
-    chess_gui = ChessGUI()
+    parser = argparse.ArgumentParser(description="Play against the engine.")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="search threads, each one beyond the first a helper process sharing the table")
+    chess_gui = ChessGUI(parser.parse_args().threads)
     chess_gui.run()
@@ -0,0 +1,30 @@
+import unittest
+
+from Board import Board
+from RemoteWorker import RemoteWorker
+
+
+class TestPerft(unittest.TestCase):
+    """
+    Move generation regression test: counts the legal move tree of the standard perft positions to depth 3 and
+    compares with the published counts. Castling, en passant, promotions, pins and checks all appear in them.
+    Run with python -m pytest or python -m unittest.
+    """
+
+    POSITIONS = [
+        ("startpos", "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1", 8902),
+        ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1", 97862),
+        ("position 3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1", 2812),
+        ("position 4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1", 9467),
+        ("position 5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8", 62379),
+    ]
+    DEPTH = 3
+
+    def test_perft(self):
+        for name, fen, expected in self.POSITIONS:
+            with self.subTest(name):
+                self.assertEqual(RemoteWorker.perft(Board.from_fen(fen), self.DEPTH), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()